@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+# Measure how many msgC rows per second the mailbox server can queue, with
+# and without group commit. Run from a source tree, e.g.:
+#
+#  PYTHONPATH=src python misc/bench_ingest.py [NUM_MESSAGES] [MESSAGE_SIZE]
+
+import os, sys, time, shutil, tempfile
+from petmail.database import make_observable_db
+from petmail.mailbox.ingest import GroupCommitter
+from petmail.mailbox.store import SQLiteMessageStore
+
+def run(num_messages, msgC, max_messages):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db = make_observable_db(os.path.join(tmpdir, "petmail.db"))
+        # a very long window: we only want count-triggered flushes here, so
+        # we don't need a running reactor
+        gc = GroupCommitter(SQLiteMessageStore(db),
+                            max_messages=max_messages,
+                            max_delay_ms=3600*1000)
+        start = time.time()
+        for i in xrange(num_messages):
+            gc.add(i % 100, msgC)
+        gc.flush()
+        elapsed = time.time() - start
+        db.conn.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return elapsed
+
+def main():
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    msgC = "c0:" + os.urandom(size)
+    print "queueing %d messages of %d bytes each" % (num_messages, len(msgC))
+    for max_messages in [1, 10, 100, 1000]:
+        elapsed = run(num_messages, msgC, max_messages)
+        print " batch size %4d: %8.1f msgs/sec (%.3fs)" % (
+            max_messages, num_messages / elapsed, elapsed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Compare the mailbox server's message stores: queue a batch of messages,
+# list them, fetch every one, then delete them all. Run from a source tree,
+# e.g.:
+#
+#  PYTHONPATH=src python misc/bench_store.py [NUM_MESSAGES] [MESSAGE_SIZE]
+
+import os, sys, time, shutil, tempfile
+from petmail.database import make_observable_db
+from petmail.mailbox.store import SQLiteMessageStore, SegmentLogMessageStore
+
+NUM_TIDS = 100
+BATCH = 100 # messages per commit, like a busy group-committer
+
+def make_sqlite(tmpdir):
+    return SQLiteMessageStore(make_observable_db(os.path.join(tmpdir,
+                                                              "petmail.db")))
+
+def make_log(tmpdir):
+    return SegmentLogMessageStore(os.path.join(tmpdir, "spool"))
+
+def run(make_store, num_messages, msgC):
+    tmpdir = tempfile.mkdtemp()
+    times = []
+    try:
+        s = make_store(tmpdir)
+        start = time.time()
+        for i in xrange(num_messages):
+            s.add_message(i % NUM_TIDS, msgC)
+            if i % BATCH == BATCH-1:
+                s.commit()
+        s.commit()
+        times.append(time.time() - start)
+
+        start = time.time()
+        msgids = []
+        for tid in range(NUM_TIDS):
+            msgids.extend([msgid for (msgid, length)
+                           in s.list_messages(tid)])
+        times.append(time.time() - start)
+
+        start = time.time()
+        for msgid in msgids:
+            s.get_message(msgid)
+        times.append(time.time() - start)
+
+        start = time.time()
+        for i, msgid in enumerate(msgids):
+            s.delete_message(msgid)
+            if i % BATCH == BATCH-1:
+                s.commit()
+        s.commit()
+        times.append(time.time() - start)
+    finally:
+        shutil.rmtree(tmpdir)
+    return times
+
+def main():
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    msgC = "c0:" + os.urandom(size)
+    print "%d messages of %d bytes each, %d per commit" % (num_messages,
+                                                          len(msgC), BATCH)
+    print "%8s %12s %12s %12s %12s" % ("", "add/s", "list(s)",
+                                       "fetch/s", "delete/s")
+    for name, make_store in [("sqlite", make_sqlite), ("log", make_log)]:
+        add, list_, fetch, delete = run(make_store, num_messages, msgC)
+        print "%8s %12.1f %12.3f %12.1f %12.1f" % (
+            name, num_messages/add, list_, num_messages/fetch,
+            num_messages/delete)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+# Measure the last-resort path for inbound messages: trial decryption of
+# msgD against every channel key, as when neither the CIDToken nor the
+# CIDBox identifies the channel. The key that matches is the last one tried
+# (or none does), which is the worst case. Run from a source tree, e.g.:
+#
+#  PYTHONPATH=src python misc/bench_trial_decrypt.py [THREADS..]
+
+import sys, time
+from twisted.internet import defer, task
+from nacl.public import PrivateKey, Box
+from petmail.executor import CryptoExecutor
+from petmail.mailbox.channel import trial_decrypt_msgD
+
+SIZES = [100, 1000, 10000] # contacts, with two keys each
+ROUNDS = 3
+
+def make_msgD(pubkey):
+    privkey2 = PrivateKey.generate()
+    nonce = "\x00"*Box.NONCE_SIZE
+    return (privkey2.public_key.encode()
+            + Box(privkey2, pubkey).encrypt("msgE", nonce))
+
+@defer.inlineCallbacks
+def run(executor, keylist, msgD):
+    times = []
+    for i in range(ROUNDS):
+        start = time.time()
+        yield trial_decrypt_msgD(executor, msgD, keylist)
+        times.append(time.time() - start)
+    defer.returnValue(min(times))
+
+@defer.inlineCallbacks
+def main(reactor, *threads):
+    threads = [int(t) for t in threads] or [0, 2, 4]
+    print "%8s %8s %12s %12s" % ("contacts", "threads", "last (ms)",
+                                 "none (ms)")
+    for size in SIZES:
+        keylist = [(PrivateKey.generate(), i) for i in range(2*size)]
+        last = make_msgD(keylist[-1][0].public_key)
+        none = make_msgD(PrivateKey.generate().public_key)
+        for t in threads:
+            e = CryptoExecutor(t)
+            e.startService()
+            t_last = yield run(e, keylist, last)
+            t_none = yield run(e, keylist, none)
+            e.stopService()
+            print "%8d %8d %12.1f %12.1f" % (size, t, 1000*t_last,
+                                             1000*t_none)
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+# Measure how mailbox delivery throughput scales with the number of ingest
+# worker processes. For each worker count, this creates a throwaway node,
+# has several client processes POST pre-built msgAs at it over keep-alive
+# connections, and times how long it takes until every message has been
+# committed to the store. "0 workers" means the node's own web port. Run
+# from a source tree, e.g.:
+#
+#  PYTHONPATH=src python misc/load_ingest.py [NUM_MESSAGES] [CLIENTS] [WORKERS..]
+
+import os, sys, json, time, shutil, tempfile, subprocess, httplib, urlparse
+
+NUM_TIDS = 100
+
+def client(url, fn):
+    from petmail.netstring import split_netstrings
+    msgAs = split_netstrings(open(fn, "rb").read())
+    u = urlparse.urlparse(url)
+    conn = httplib.HTTPConnection(u.hostname, u.port)
+    for msgA in msgAs:
+        conn.request("POST", u.path, msgA)
+        resp = conn.getresponse()
+        resp.read()
+        assert resp.status == 200, resp.status
+    conn.close()
+
+def run(num_workers, num_messages, num_clients):
+    from twisted.internet import reactor, utils
+    from petmail import rrid, util, node
+    from petmail.netstring import netstring
+    from petmail.scripts import runner
+    from petmail.scripts.create_node import create_node
+    from petmail.mailbox.delivery import createMsgA
+
+    tmpdir = tempfile.mkdtemp()
+    basedir = os.path.join(tmpdir, "node")
+    so = runner.CreateNodeOptions()
+    so.parseOptions(["--listen",
+                     "tcp:%d:interface=127.0.0.1" % util.allocate_port(),
+                     "--relay-url", "http://localhost:1/", basedir])
+    out = open(os.devnull, "w")
+    create_node(so, out, out, ["agent"])
+    dbfile = os.path.join(basedir, "petmail.db")
+
+    # commit in groups, so the single writer isn't what we're measuring
+    n = node.Node(basedir, dbfile)
+    row = n.db.execute("SELECT * FROM mailbox_server_config").fetchone()
+    desc = json.loads(row["mailbox_config_json"])
+    desc["group_commit_max_messages"] = 100
+    desc["group_commit_max_delay_ms"] = 10
+    n.db.execute("UPDATE mailbox_server_config SET mailbox_config_json=?",
+                 (json.dumps(desc),))
+    n.db.commit()
+    n.db.conn.close()
+    ingest_port = util.allocate_port()
+    n = node.Node(basedir, dbfile, ingest_workers=num_workers,
+                  ingest_listen="tcp:%d:interface=127.0.0.1" % ingest_port)
+    ms = n.mailbox_server
+    if num_workers:
+        url = "http://127.0.0.1:%d/mailbox" % ingest_port
+    else:
+        url = n.baseurl + "mailbox"
+
+    trecs = []
+    for i in range(NUM_TIDS):
+        mbrec = ms.get_mailbox_record(ms.allocate_transport())
+        TT0 = mbrec["transport"]["sender"]["TT0"].decode("hex")
+        tpubkey = mbrec["transport"]["generic"]["transport_pubkey"]
+        trecs.append({"STT": rrid.randomize(TT0).encode("hex"),
+                      "transport_pubkey": tpubkey})
+    msgC = "c0:" + os.urandom(1000)
+    files = []
+    for c in range(num_clients):
+        fn = os.path.join(tmpdir, "msgA-%d" % c)
+        f = open(fn, "wb")
+        for i in range(c, num_messages, num_clients):
+            f.write(netstring(createMsgA(trecs[i % NUM_TIDS], msgC)))
+        f.close()
+        files.append(fn)
+
+    committed = []
+    result = []
+    def new_message(notice):
+        committed.append(notice.id)
+        if len(committed) == num_messages:
+            result.append(time.time() - start)
+            reactor.callLater(0, n.stopService)
+            reactor.callLater(0.5, reactor.stop)
+    ms.store.subscribe(new_message)
+
+    n.startService()
+    start = time.time()
+    for fn in files:
+        d = utils.getProcessOutput(sys.executable,
+                                   [__file__, "--client", url, fn],
+                                   env=os.environ, errortoo=True)
+        d.addCallback(lambda out: out and sys.stderr.write(out))
+    reactor.run()
+    shutil.rmtree(tmpdir)
+    print "%d" % num_workers, "%.3f" % result[0]
+
+def main():
+    if sys.argv[1:2] == ["--client"]:
+        return client(sys.argv[2], sys.argv[3])
+    if sys.argv[1:2] == ["--run"]:
+        return run(*[int(a) for a in sys.argv[2:5]])
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    num_clients = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    worker_counts = [int(a) for a in sys.argv[3:]] or [0, 1, 2, 4]
+    print "delivering %d messages from %d client processes" % (num_messages,
+                                                              num_clients)
+    for num_workers in worker_counts:
+        out = subprocess.check_output([sys.executable, __file__, "--run",
+                                       str(num_workers), str(num_messages),
+                                       str(num_clients)])
+        workers, elapsed = out.split()[-2:]
+        print " %2s workers: %8.1f msgs/sec (%ss)" % (
+            workers, num_messages/float(elapsed), elapsed)
+
+if __name__ == "__main__":
+    main()
@@ -7,13 +7,21 @@ from nacl.encoding import HexEncoder as Hex
 from . import invitation, rrid
 from .errors import CommandError, ContactNotReadyError
 from .mailbox import channel, retrieval
+from .mailbox.channel import build_CIDToken
 from .eventual import eventually
 
 class Agent(service.MultiService):
-    def __init__(self, db, basedir, mailbox_server):
+    def __init__(self, db, basedir, mailbox_server, executor=None,
+                 http=None, cidtoken_window=channel.DEFAULT_CIDTOKEN_WINDOW):
         service.MultiService.__init__(self)
         self.db = db
         self.mailbox_server = mailbox_server
+        self.executor = executor
+        self.http = http
+        # inbound messages mostly find their channel through this
+        self.cidindex = channel.CIDTokenIndex(db, cidtoken_window)
+        # and the rest by trying every channel's CIDKey
+        self.keyring = channel.CIDKeyring(db)
 
         self.mailbox_retrievers = set()
         c = self.db.execute("SELECT * FROM agent_profile").fetchone()
@@ -44,10 +52,13 @@ class Agent(service.MultiService):
     def build_retriever(self, mbid, rrec):
         # parse descriptor, import correct module and constructor
         def got_msgC(msgC):
-            self.msgC_received(mbid, msgC)
+            return self.msgC_received(mbid, msgC)
+        def got_msgCs(msgCs):
+            return self.msgCs_received(mbid, msgCs)
         retrieval_type = rrec["type"]
         if retrieval_type == "http":
-            return retrieval.HTTPRetriever(rrec, got_msgC)
+            return retrieval.HTTPRetriever(rrec, got_msgC, self.http,
+                                           got_msgCs)
         elif retrieval_type == "local":
             return retrieval.LocalRetriever(rrec, got_msgC, self.mailbox_server)
         else:
@@ -63,16 +74,37 @@ class Agent(service.MultiService):
 
     def msgC_received(self, tid, msgC):
         assert msgC.startswith("c0:")
-        cid, seqnum, payload_json = channel.process_msgC(self.db, msgC)
-        self.payload_received(cid, seqnum, payload_json)
+        # returns a Deferred that fires when the payload has been stored
+        d = channel.process_msgC(self.db, msgC, self.executor,
+                                 self.cidindex, self.keyring)
+        d.addCallback(lambda (cid, seqnum, payload_json):
+                      self.payload_received(cid, seqnum, payload_json))
+        return d
+
+    def msgCs_received(self, tid, msgCs):
+        # for retrievers with a backlog: returns a Deferred that fires with
+        # a result (or Failure) for each msgC once they are all stored, with
+        # one commit for the whole batch
+        for msgC in msgCs:
+            assert msgC.startswith("c0:")
+        return channel.process_msgCs(self.db, msgCs, self.executor,
+                                     self.cidindex, self.keyring,
+                                     before_commit=self.store_payloads)
+
+    def store_payloads(self, accepted):
+        for (cid, seqnum, payload_json) in accepted:
+            self.store_payload(cid, seqnum, payload_json)
 
     def payload_received(self, cid, seqnum, payload_json):
+        self.store_payload(cid, seqnum, payload_json)
+        self.db.commit()
+
+    def store_payload(self, cid, seqnum, payload_json):
         self.db.insert("INSERT INTO inbound_messages"
                         " (cid, seqnum, when_received, payload_json)"
                         " VALUES (?,?,?,?)",
                         (cid, seqnum, time.time(), payload_json),
                        "inbound_messages")
-        self.db.commit()
         #payload = json.loads(payload_json)
         #print "payload_received", cid, seqnum, payload
         #if payload.has_key("basic"):
@@ -97,6 +129,8 @@ class Agent(service.MultiService):
         my_signkey = SigningKey.generate()
         channel_key = PrivateKey.generate()
         my_CID_key = os.urandom(32)
+        # their first message to us will carry this CIDToken
+        first_CIDToken = build_CIDToken(my_CID_key, 1)
 
         base_transports = self.get_transports()
         if override_transports:
@@ -132,7 +166,8 @@ class Agent(service.MultiService):
              invitation.INVITE_WAITING_FOR_CODE, time.time(), maybe_code,
              sigkeypayload.encode("hex"),
              1, my_signkey.encode(Hex),
-             my_CID_key.encode("hex"), None,
+             my_CID_key.encode("hex"),
+             first_CIDToken.encode("hex"),
              0,
              channel_key.encode(Hex),
              channel_key.encode(Hex), # at beginning, old=new
@@ -242,7 +277,7 @@ class Agent(service.MultiService):
                        (cid, time.time(), json.dumps(payload)),
                        "outbound_messages")
         self.db.commit() # XXX ?. Or wait for c.send() to commit?
-        c = channel.OutboundChannel(self.db, cid)
+        c = channel.OutboundChannel(self.db, cid, self.executor, self.http)
         return c.send(payload)
 
     def get_transports(self):
@@ -299,6 +334,9 @@ class Agent(service.MultiService):
                        "addressbook", cid)
         self.db.commit()
 
+    def command_mailbox_usage(self):
+        return self.mailbox_server.get_quota_usage()
+
     def command_fetch_all_messages(self):
         c = self.db.execute("SELECT inbound_messages.*,addressbook.petname"
                             " FROM inbound_messages,addressbook"
@@ -4,16 +4,36 @@ from collections import defaultdict, namedtuple
 from pkg_resources import resource_string
 import sqlite3
 from .eventual import eventually
+from . import metrics
 
 Notice = namedtuple("Notice", ["table", "action", "id", "new_value", "tags"])
 
 class DBError(Exception):
     pass
 
+TARGET_VERSION = 5
+
 def get_schema(version):
     schema_bytes = resource_string("petmail", "db-schemas/v%d.sql" % version)
     return schema_bytes
 
+def get_upgrader(new_version):
+    schema_bytes = resource_string("petmail",
+                                   "db-schemas/upgrade-to-v%d.sql" % new_version)
+    return schema_bytes
+
+def unhex(s):
+    if s is None:
+        return None
+    return sqlite3.Binary(str(s).decode("hex"))
+
+def upgrade_db(db, version, target_version):
+    # each upgrade script runs in its own transaction, and ends by bumping
+    # the version number, so an interrupted upgrade can simply be restarted
+    db.create_function("unhex", 1, unhex)
+    for v in range(version, target_version):
+        db.executescript(get_upgrader(v+1))
+
 def serialize(row):
     if row is None:
         return None
@@ -22,6 +42,15 @@ def serialize(row):
         out[k] = row[k]
     return out
 
+DB_SECONDS = metrics.histogram("petmail_db_seconds",
+                               "time spent in database calls, by method",
+                               ["method"])
+DB_EXECUTE = DB_SECONDS.labels("execute")
+DB_INSERT = DB_SECONDS.labels("insert")
+DB_UPDATE = DB_SECONDS.labels("update")
+DB_DELETE = DB_SECONDS.labels("delete")
+DB_COMMIT = DB_SECONDS.labels("commit")
+
 class ObservableDatabase:
     def __init__(self, connection):
         self.conn = connection
@@ -37,21 +66,34 @@ class ObservableDatabase:
     # database methods
 
     def execute(self, sql, values=None):
+        started = DB_EXECUTE.start()
         if values:
-            return self.conn.execute(sql, values)
-        return self.conn.execute(sql)
-
-    def insert(self, sql, values, table=None, tags={}):
+            c = self.conn.execute(sql, values)
+        else:
+            c = self.conn.execute(sql)
+        DB_EXECUTE.stop(started)
+        return c
+
+    def insert(self, sql, values, table=None, tags={}, new_value=None):
+        # if the caller already knows every column of the new row, they can
+        # pass it as new_value (without 'id'), to save us from reading the
+        # row back out just to build the notification
+        started = DB_INSERT.start()
         new_id = self.conn.execute(sql, values).lastrowid
         if table:
-            c = self.conn.execute("SELECT * FROM `%s` WHERE id=?" % table,
-                                  (new_id,))
+            if new_value is None:
+                c = self.conn.execute("SELECT * FROM `%s` WHERE id=?" % table,
+                                      (new_id,))
+                new_value = serialize(c.fetchone())
+            else:
+                new_value = dict(new_value, id=new_id)
             self.pending_notifications.append(Notice(table, "insert", new_id,
-                                                     serialize(c.fetchone()),
-                                                     tags))
+                                                     new_value, tags))
+        DB_INSERT.stop(started)
         return new_id
 
     def update(self, sql, values, table=None, id=None, tags={}):
+        started = DB_UPDATE.start()
         self.conn.execute(sql, values)
         if table:
             c = self.conn.execute("SELECT * FROM `%s` WHERE id=?" % table,
@@ -60,19 +102,28 @@ class ObservableDatabase:
             if new_value:
                 self.pending_notifications.append(Notice(table, "update", id,
                                                          new_value, tags))
+        DB_UPDATE.stop(started)
 
     def delete(self, sql, values, table, id, tags={}):
+        started = DB_DELETE.start()
         self.conn.execute(sql, values)
         self.pending_notifications.append(Notice(table, "delete", id,
                                                  None, tags))
+        DB_DELETE.stop(started)
 
     def commit(self):
+        started = DB_COMMIT.start()
         self.conn.commit()
+        DB_COMMIT.stop(started)
         for event in self.pending_notifications:
             for o in self.observers[event.table]:
                 eventually(o, event)
         self.pending_notifications[:] = []
 
+    def rollback(self):
+        self.conn.rollback()
+        self.pending_notifications[:] = []
+
 def get_db(dbfile, stderr=sys.stderr):
     """Open or create the given db file. The parent directory must exist.
     Returns the db connection object, or raises DBError.
@@ -85,11 +136,11 @@ def get_db(dbfile, stderr=sys.stderr):
         raise DBError("Unable to create/open db file %s: %s" % (dbfile, e))
     db.row_factory = sqlite3.Row
 
-    VERSION = 1
     if must_create:
-        schema = get_schema(VERSION)
+        schema = get_schema(TARGET_VERSION)
         db.executescript(schema)
-        db.execute("INSERT INTO version (version) VALUES (?)", (VERSION,))
+        db.execute("INSERT INTO version (version) VALUES (?)",
+                   (TARGET_VERSION,))
         db.commit()
 
     try:
@@ -99,8 +150,14 @@ def get_db(dbfile, stderr=sys.stderr):
         # Perhaps it was created with an old version, or it might be junk.
         raise DBError("db file is unusable: %s" % e)
 
-    if version != VERSION:
+    if version > TARGET_VERSION:
         raise DBError("Unable to handle db version %s" % version)
+    if version < TARGET_VERSION:
+        try:
+            upgrade_db(db, version, TARGET_VERSION)
+        except (EnvironmentError, sqlite3.DatabaseError), e:
+            raise DBError("Unable to upgrade db from version %s: %s"
+                          % (version, e))
 
     return db
 
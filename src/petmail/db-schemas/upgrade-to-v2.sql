@@ -0,0 +1,41 @@
+
+-- v2 stores queued message bodies as raw bytes instead of hex. SQLite can't
+-- change a column type in place, so we rebuild the table. unhex() is a
+-- python function, registered by database.py just for this upgrade.
+
+BEGIN TRANSACTION;
+
+DROP INDEX `tid_token`;
+DROP INDEX `fetch_token`;
+DROP INDEX `delete_token`;
+ALTER TABLE `mailbox_server_messages` RENAME TO `mailbox_server_messages_v1`;
+
+CREATE TABLE `mailbox_server_messages`
+(
+ `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+ `tid` INTEGER,
+ `fetch_token` VARCHAR,
+ `delete_token` VARCHAR,
+ `length` INTEGER,
+ `msgC` BLOB -- raw bytes, not hex
+);
+CREATE INDEX `tid_token` ON `mailbox_server_messages` (`tid`);
+CREATE UNIQUE INDEX `fetch_token` ON `mailbox_server_messages` (`fetch_token`);
+CREATE UNIQUE INDEX `delete_token` ON `mailbox_server_messages` (`delete_token`);
+
+INSERT INTO `mailbox_server_messages`
+ (`id`, `tid`, `fetch_token`, `delete_token`, `length`, `msgC`)
+ SELECT `id`, `tid`, `fetch_token`, `delete_token`, `length`, unhex(`msgC`)
+ FROM `mailbox_server_messages_v1`;
+-- The copy leaves the new table's AUTOINCREMENT counter at the highest id
+-- that survived, but message ids must never be reused (list cursors and
+-- clients remember them), so carry the old counter over.
+DELETE FROM `sqlite_sequence` WHERE `name`='mailbox_server_messages';
+INSERT INTO `sqlite_sequence` (`name`, `seq`)
+ SELECT 'mailbox_server_messages', `seq` FROM `sqlite_sequence`
+ WHERE `name`='mailbox_server_messages_v1';
+DROP TABLE `mailbox_server_messages_v1`;
+
+UPDATE `version` SET `version`=2;
+
+COMMIT TRANSACTION;
@@ -0,0 +1,16 @@
+
+-- v3 fixes the indexes on retrieval_replay_tokens, which (before v3) allowed
+-- only one token per timestamp. Nothing used the table before v3, so there
+-- are no rows to keep.
+
+BEGIN TRANSACTION;
+
+DROP INDEX `timestamp`;
+DROP INDEX `token`;
+DELETE FROM `retrieval_replay_tokens`;
+CREATE INDEX `timestamp` ON `retrieval_replay_tokens` (`timestamp`);
+CREATE UNIQUE INDEX `token` ON `retrieval_replay_tokens` (`pubkey`);
+
+UPDATE `version` SET `version`=3;
+
+COMMIT TRANSACTION;
@@ -0,0 +1,11 @@
+
+-- v4 adds per-transport quota overrides to mailbox_server_transports.
+
+BEGIN TRANSACTION;
+
+ALTER TABLE `mailbox_server_transports` ADD COLUMN `max_messages` INTEGER;
+ALTER TABLE `mailbox_server_transports` ADD COLUMN `max_bytes` INTEGER;
+
+UPDATE `version` SET `version`=4;
+
+COMMIT TRANSACTION;
@@ -0,0 +1,16 @@
+
+-- v5 records when each queued message arrived, so old ones can expire, and
+-- adds a per-transport retention override. Messages that were already
+-- queued get a full retention period, starting now.
+
+BEGIN TRANSACTION;
+
+ALTER TABLE `mailbox_server_transports` ADD COLUMN `retention` INTEGER;
+ALTER TABLE `mailbox_server_messages` ADD COLUMN `arrived` INTEGER;
+UPDATE `mailbox_server_messages`
+ SET `arrived`=CAST(strftime('%s','now') AS INTEGER);
+CREATE INDEX `arrived` ON `mailbox_server_messages` (`arrived`);
+
+UPDATE `version` SET `version`=5;
+
+COMMIT TRANSACTION;
@@ -1,10 +1,10 @@
 from twisted.python import log, failure
-from twisted.internet import reactor, defer, protocol
+from twisted.internet import defer, protocol
 from twisted.application import service
 from twisted.protocols import basic
-from twisted.web.client import Agent, ResponseDone
-from twisted.web.http_headers import Headers
+from twisted.web.client import ResponseDone
 from .eventual import eventually
+from .httpclient import HTTPClient
 
 class EventSourceParser(basic.LineOnlyReceiver):
     delimiter = "\n"
@@ -56,10 +56,11 @@ class EventSourceError(Exception):
 # es.cancel()
 
 class EventSource: # TODO: service.Service
-    def __init__(self, url, handler, when_connected=None):
+    def __init__(self, url, handler, when_connected=None, http=None):
         self.url = url
         self.handler = handler
         self.when_connected = when_connected
+        self.http = http or HTTPClient(persistent=False)
         self.started = False
         self.cancelled = False
         self.proto = EventSourceParser(self.handler)
@@ -67,9 +68,8 @@ class EventSource: # TODO: service.Service
     def start(self):
         assert not self.started, "single-use"
         self.started = True
-        a = Agent(reactor)
-        d = a.request("GET", self.url,
-                      Headers({"accept": ["text/event-stream"]}))
+        d = self.http.request("GET", self.url,
+                              {"accept": "text/event-stream"})
         d.addCallback(self._connected)
         return d
 
@@ -125,7 +125,7 @@ class Connector:
 
 class ReconnectingEventSource(service.MultiService,
                               protocol.ReconnectingClientFactory):
-    def __init__(self, baseurl, connection_starting, handler):
+    def __init__(self, baseurl, connection_starting, handler, http=None):
         service.MultiService.__init__(self)
         # we don't use any of the basic Factory/ClientFactory methods of
         # this, just the ReconnectingClientFactory.retry, stopTrying, and
@@ -134,6 +134,7 @@ class ReconnectingEventSource(service.MultiService,
         self.baseurl = baseurl
         self.connection_starting = connection_starting
         self.handler = handler
+        self.http = http
         # IService provides self.running, toggled by {start,stop}Service.
         # self.active is toggled by {,de}activate. If both .running and
         # .active are True, then we want to have an outstanding EventSource
@@ -172,7 +173,7 @@ class ReconnectingEventSource(service.MultiService,
             return
         self.continueTrying = True
         url = self.connection_starting()
-        self.es = EventSource(url, self.handler, self.resetDelay)
+        self.es = EventSource(url, self.handler, self.resetDelay, self.http)
         d = self.es.start()
         d.addBoth(self._stopped)
 
@@ -2,6 +2,7 @@
 
 from twisted.internet import reactor, defer
 from twisted.python import log
+from . import metrics
 
 class _SimpleCallQueue(object):
     # XXX TODO: merge epsilon.cooperator in, and make this more complete.
@@ -43,6 +44,10 @@ class _SimpleCallQueue(object):
 
 _theSimpleQueue = _SimpleCallQueue()
 
+metrics.gauge("petmail_eventual_queue_depth",
+              "calls waiting in the eventual-send queue",
+              fn=lambda: len(_theSimpleQueue._events))
+
 def eventually(cb, *args, **kwargs):
     """This is the eventual-send operation, used as a plan-coordination
     primitive. The callable will be invoked (with args and kwargs) in a later
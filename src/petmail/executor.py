@@ -0,0 +1,80 @@
+import threading
+from twisted.application import service
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+class CryptoExecutor(service.Service):
+    """I run CPU-heavy crypto (Box/SecretBox, signatures, trial decryption)
+    on a pool of worker threads. PyNaCl releases the GIL while it works, so
+    this spreads the load over several cores and keeps the reactor free to
+    serve HTTP and event streams.
+
+    run(f, *args, **kwargs) returns a Deferred that fires (in the reactor
+    thread) with f's result. Functions handed to me must not touch the
+    database or any other reactor-owned state: do the lookups first, then
+    pass me plain values.
+
+    With threads=0, or when I'm not running, f is called inline (in the
+    caller's thread) and the Deferred has already fired by the time run()
+    returns. That is the default, and what unit tests use.
+    """
+
+    def __init__(self, threads=0):
+        self.threads = threads
+        self.pool = None
+        self.lock = threading.Lock()
+        self.queued = 0 # waiting for a worker
+        self.max_queued = 0
+        self.active = 0 # running on a worker right now
+        self.completed = 0
+        self.inline = 0
+
+    def startService(self):
+        service.Service.startService(self)
+        if self.threads:
+            self.pool = ThreadPool(self.threads, self.threads,
+                                   name="petmail-crypto")
+            self.pool.start()
+
+    def stopService(self):
+        if self.pool:
+            self.pool.stop()
+            self.pool = None
+        return service.Service.stopService(self)
+
+    def get_workers(self):
+        # how many calls can run at the same time
+        return self.threads if self.pool else 1
+
+    def run(self, f, *args, **kwargs):
+        if not self.pool:
+            self.inline += 1
+            return defer.maybeDeferred(f, *args, **kwargs)
+        with self.lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        from twisted.internet import reactor
+        return threads.deferToThreadPool(reactor, self.pool,
+                                         self._call, f, args, kwargs)
+
+    def _call(self, f, args, kwargs):
+        # this runs in a worker thread
+        with self.lock:
+            self.queued -= 1
+            self.active += 1
+        try:
+            return f(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.completed += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {"threads": self.threads if self.pool else 0,
+                    "queued": self.queued,
+                    "max_queued": self.max_queued,
+                    "active": self.active,
+                    "completed": self.completed,
+                    "inline": self.inline,
+                    }
@@ -0,0 +1,129 @@
+from StringIO import StringIO
+from urlparse import urlparse
+from twisted.application import service
+from twisted.internet import defer
+from twisted.python import failure
+from twisted.web import error
+from twisted.web.client import (Agent, HTTPConnectionPool, FileBodyProducer,
+                                readBody)
+from twisted.web.http_headers import Headers
+
+class _CountingPool(HTTPConnectionPool):
+    # HTTPConnectionPool doesn't report how often it had to connect, nor
+    # how many connections it is keeping, so we peek
+    def __init__(self, reactor, persistent, client):
+        HTTPConnectionPool.__init__(self, reactor, persistent)
+        self.client = client
+
+    def _newConnection(self, key, endpoint):
+        self.client.connections_opened += 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+    def _putConnection(self, key, connection):
+        if not self.client.running:
+            # a request that finished after we were stopped: don't keep it
+            connection.transport.loseConnection()
+            return
+        HTTPConnectionPool._putConnection(self, key, connection)
+
+    def idle_connections(self):
+        return sum([len(conns) for conns in self._connections.values()])
+
+class HTTPClient(service.Service):
+    """I make all of a node's outbound HTTP requests (message delivery,
+    retrieval, and event streams), over a pool of persistent connections, so
+    that talking to the same server again doesn't cost a new TCP (or TLS)
+    handshake.
+
+    At most max_per_host getPage() requests run at once to any one server,
+    and the rest wait their turn. Event streams (started with request())
+    are not counted, since they stay open indefinitely. Idle connections are
+    kept for idle_timeout seconds, and closed when I am stopped (which
+    waits for any getPage() requests still in progress). With
+    persistent=False, every request gets a new connection (which is closed
+    afterwards), so nothing needs to be stopped.
+    """
+
+    def __init__(self, persistent=True, max_per_host=4, idle_timeout=240,
+                 reactor=None):
+        if not reactor:
+            from twisted.internet import reactor
+        self.pool = _CountingPool(reactor, persistent, self)
+        self.pool.maxPersistentPerHost = max_per_host
+        self.pool.cachedConnectionTimeout = idle_timeout
+        self.agent = Agent(reactor, pool=self.pool)
+        self.max_per_host = max_per_host
+        self.hosts = {} # (scheme, host, port) -> DeferredSemaphore
+        self.requests = 0
+        self.active = 0
+        self.failed = 0
+        self.connections_opened = 0
+        self.when_idle = [] # Deferreds, fired when active drops to 0
+
+    def stopService(self):
+        service.Service.stopService(self)
+        d = defer.succeed(None)
+        if self.active:
+            d = defer.Deferred()
+            self.when_idle.append(d)
+        d.addCallback(lambda _: self.pool.closeCachedConnections())
+        return d
+
+    def request(self, method, url, headers=None, body=None):
+        # returns a Deferred that fires with the twisted.web Response, whose
+        # body has not been read yet
+        self.requests += 1
+        producer = None
+        if body is not None:
+            producer = FileBodyProducer(StringIO(body))
+        h = Headers()
+        for (name, value) in (headers or {}).items():
+            h.addRawHeader(name, value)
+        return self.agent.request(method, url, h, producer)
+
+    def getPage(self, url, method="GET", postdata=None, headers=None):
+        """Like twisted.web.client.getPage: returns a Deferred that fires
+        with the response body, or errbacks with twisted.web.error.Error if
+        the response code was not 2xx (with the response's Headers attached
+        as .headers)."""
+        u = urlparse(url)
+        key = (u.scheme, u.hostname, u.port)
+        if key not in self.hosts:
+            self.hosts[key] = defer.DeferredSemaphore(self.max_per_host)
+        return self.hosts[key].run(self._getPage, url, method, postdata,
+                                   headers)
+
+    def _getPage(self, url, method, postdata, headers):
+        self.active += 1
+        d = self.request(method, url, headers, postdata)
+        def _got_response(resp):
+            d1 = readBody(resp)
+            if not 200 <= resp.code < 300:
+                def _error(body):
+                    e = error.Error(resp.code, resp.phrase, body)
+                    # so callers can see e.g. Retry-After
+                    e.headers = resp.headers
+                    return defer.fail(e)
+                d1.addCallback(_error)
+            return d1
+        d.addCallback(_got_response)
+        def _done(res):
+            self.active -= 1
+            if isinstance(res, failure.Failure):
+                self.failed += 1
+            if not self.active:
+                waiters, self.when_idle = self.when_idle, []
+                for w in waiters:
+                    w.callback(None)
+            return res
+        d.addBoth(_done)
+        return d
+
+    def get_stats(self):
+        return {"requests": self.requests,
+                "active": self.active,
+                "queued": sum([len(s.waiting) for s in self.hosts.values()]),
+                "failed": self.failed,
+                "connections_opened": self.connections_opened,
+                "idle_connections": self.pool.idle_connections(),
+                }
@@ -1,10 +1,13 @@
-import struct, json, os
+import struct, json, os, threading
 from hashlib import sha256
 from twisted.internet import defer
+from twisted.python import failure
 from ..errors import ReplayError, WrongVerfkeyError, UnknownChannelError
 from ..util import split_into, verify_with_prefix
 from ..hkdf import HKDF
 from ..netstring import netstring, split_netstrings_and_trailer
+from ..executor import CryptoExecutor
+from .. import metrics
 from .delivery import OutboundHTTPTransport, ReturnTransport
 from nacl.public import PrivateKey, PublicKey, Box
 from nacl.signing import SigningKey, VerifyKey
@@ -34,13 +37,230 @@ def parse_msgC(msgC):
     (CIDBox,), msgD = split_netstrings_and_trailer(msgC[32:])
     return CIDToken, CIDBox, msgD
 
-def find_channel_from_CIDToken(db, CIDToken):
-    # XXX not implemented
+DEFAULT_CIDTOKEN_WINDOW = 8
+
+CIDTOKEN_LOOKUPS = metrics.counter("petmail_channel_cidtoken_lookups_total",
+                                   "inbound msgCs looked up by CIDToken, by"
+                                   " result", ["result"])
+CIDTOKEN_HITS = CIDTOKEN_LOOKUPS.labels("hit")
+CIDTOKEN_MISSES = CIDTOKEN_LOOKUPS.labels("miss")
+CIDBOX_SCANS = metrics.counter("petmail_channel_cidbox_scans_total",
+                               "inbound msgCs that fell back to scanning"
+                               " every channel's CIDBox key")
+
+class CIDTokenIndex:
+    """I map the CIDTokens of each channel's next few inbound messages to
+    (cid, seqnum), so most messages find their channel with one dict lookup
+    instead of a CIDBox scan over the whole addressbook. Each channel gets a
+    window of tokens, for seqnums highest_inbound_seqnum+1 through
+    +window, so a lost or reordered message doesn't stop the ones behind it
+    from being found.
+
+    The token for the next seqnum is kept in addressbook.next_CID_token, and
+    is always in the index. The rest of a window is derived lazily: when a
+    channel is added or advances, it is only marked as needing a refill,
+    and every marked window is refilled (in one batch) the next time a
+    lookup misses. A channel that never skips a message never pays for its
+    lookahead.
+
+    I follow the addressbook's notices to stay current, so every write to
+    that table must send one (as db.insert/update/delete do when given the
+    table name). process_msgC() also tells me directly when a channel
+    advances, so a burst of messages doesn't have to wait for the notice.
+    """
+
+    def __init__(self, db, window=DEFAULT_CIDTOKEN_WINDOW):
+        assert window >= 1
+        self.window = window
+        self.tokens = {} # CIDToken -> (cid, seqnum)
+        self.channels = {} # cid -> (CIDKey, highest_inbound_seqnum)
+        self.windows = {} # cid -> {seqnum: CIDToken}
+        self.needs_refill = set() # cids
+        self.hits = 0
+        self.misses = 0
+        c = db.execute("SELECT id, my_CID_key, next_CID_token,"
+                       "       highest_inbound_seqnum"
+                       " FROM addressbook")
+        for row in c.fetchall():
+            self.update_from_row(row)
+        db.subscribe("addressbook", self.addressbook_changed)
+
+    def addressbook_changed(self, notice):
+        if notice.action == "delete":
+            self.forget(notice.id)
+        else:
+            self.update_from_row(notice.new_value)
+
+    def update_from_row(self, row):
+        if not row["my_CID_key"]:
+            return
+        next_CIDToken = None
+        if row["next_CID_token"]:
+            next_CIDToken = row["next_CID_token"].decode("hex")
+        self.set_channel(row["id"], row["my_CID_key"].decode("hex"),
+                         row["highest_inbound_seqnum"], next_CIDToken)
+
+    def set_channel(self, cid, CIDKey, highest, next_CIDToken=None):
+        old = self.channels.get(cid)
+        if old and old[0] == CIDKey and old[1] > highest:
+            return # a stale notice: we've already moved on
+        if old and old[0] != CIDKey:
+            self.forget(cid)
+        self.channels[cid] = (CIDKey, highest)
+        window = self.windows.setdefault(cid, {})
+        for seqnum in [seqnum for seqnum in window if seqnum <= highest]:
+            del self.tokens[window.pop(seqnum)]
+        if highest+1 not in window:
+            self.add_token(cid, highest+1,
+                           next_CIDToken or build_CIDToken(CIDKey, highest+1))
+        if len(window) < self.window:
+            self.needs_refill.add(cid)
+
+    def add_token(self, cid, seqnum, CIDToken):
+        self.windows[cid][seqnum] = CIDToken
+        self.tokens[CIDToken] = (cid, seqnum)
+
+    def refill(self):
+        for cid in self.needs_refill:
+            CIDKey, highest = self.channels[cid]
+            window = self.windows[cid]
+            for seqnum in range(highest+1, highest+1+self.window):
+                if seqnum not in window:
+                    self.add_token(cid, seqnum,
+                                   build_CIDToken(CIDKey, seqnum))
+        self.needs_refill.clear()
+
+    def forget(self, cid):
+        self.channels.pop(cid, None)
+        self.needs_refill.discard(cid)
+        for CIDToken in self.windows.pop(cid, {}).values():
+            del self.tokens[CIDToken]
+
+    def lookup(self, CIDToken):
+        # returns (cid, seqnum), or (None, None)
+        found = self.tokens.get(CIDToken)
+        if not found and self.needs_refill:
+            self.refill()
+            found = self.tokens.get(CIDToken)
+        if not found:
+            self.misses += 1
+            CIDTOKEN_MISSES.inc()
+            return None, None
+        self.hits += 1
+        CIDTOKEN_HITS.inc()
+        return found
+
+    def get_stats(self):
+        return {"channels": len(self.channels),
+                "tokens": len(self.tokens),
+                "needs_refill": len(self.needs_refill),
+                "hits": self.hits,
+                "misses": self.misses,
+                }
+
+def find_channel_from_CIDToken(cidindex, CIDToken):
     cid = None
     known_channel_pubkey = None # e.g. unknown
+    if cidindex:
+        cid, seqnum = cidindex.lookup(CIDToken)
     return cid, known_channel_pubkey
 
-def find_channel_from_CIDBox(db, CIDBox):
+class CIDKeyring:
+    """I keep every channel's CIDKey resident, as a ready-made SecretBox,
+    along with its highest_inbound_seqnum, so that the CIDBox scan (for
+    messages the CIDTokenIndex didn't recognize) costs one decryption
+    attempt per channel, and no SQL or key decoding. Like the index, I
+    follow the addressbook's notices, and process_msgC() updates me
+    directly when a channel advances.
+
+    I also hold each channel's private keys for trial decryption, built
+    the first time they are needed, since building a PrivateKey costs a
+    scalar multiplication of its own.
+    """
+
+    def __init__(self, db):
+        # cid -> [cid, SecretBox, highest, CIDKey, privkeys_hex, keylist]
+        self.channels = {}
+        self.entries = [] # the same lists, in the order they are tried
+        c = db.execute("SELECT id, my_CID_key, highest_inbound_seqnum,"
+                       "       my_old_channel_privkey, my_new_channel_privkey"
+                       " FROM addressbook")
+        for row in c.fetchall():
+            self.update_from_row(row)
+        db.subscribe("addressbook", self.addressbook_changed)
+
+    def addressbook_changed(self, notice):
+        if notice.action == "delete":
+            self.forget(notice.id)
+        else:
+            self.update_from_row(notice.new_value)
+
+    def update_from_row(self, row):
+        if row["my_CID_key"]:
+            self.set_channel(row["id"], row["my_CID_key"].decode("hex"),
+                             row["highest_inbound_seqnum"],
+                             (row["my_old_channel_privkey"],
+                              row["my_new_channel_privkey"]))
+
+    def set_channel(self, cid, CIDKey, highest, privkeys_hex):
+        entry = self.channels.get(cid)
+        if entry and entry[3] == CIDKey:
+            # notices can arrive after process_msgC() has moved us on
+            entry[2] = max(entry[2], highest)
+            if entry[4] != privkeys_hex:
+                entry[4:] = [privkeys_hex, None]
+            return
+        self.forget(cid)
+        entry = [cid, SecretBox(CIDKey), highest, CIDKey, privkeys_hex, None]
+        self.channels[cid] = entry
+        self.entries.append(entry)
+
+    def advance(self, cid, highest):
+        entry = self.channels.get(cid)
+        if entry:
+            entry[2] = max(entry[2], highest)
+
+    def forget(self, cid):
+        entry = self.channels.pop(cid, None)
+        if entry:
+            self.entries.remove(entry)
+
+    def find(self, CIDBox):
+        # returns (cid, channel_pubkey_s), or (None, None)
+        nonce = CIDBox[:SecretBox.NONCE_SIZE]
+        ciphertext = CIDBox[SecretBox.NONCE_SIZE:]
+        if len(nonce) != SecretBox.NONCE_SIZE:
+            return None, None
+        for entry in self.entries:
+            try:
+                m = entry[1].decrypt(ciphertext, nonce)
+            except CryptoError:
+                continue
+            seqnum, HmsgD, channel_pubkey_s = parse_CIDBox(m)
+            if seqnum <= entry[2]:
+                raise ReplayError("seqnum in CIDBox is too old")
+            return entry[0], channel_pubkey_s
+        return None, None
+
+    def get_keylist(self, cid=None):
+        # returns a list of (PrivateKey, (cid, which, PublicKey)) for one
+        # channel, or for all of them. Returns None for unknown channels.
+        if cid:
+            entries = [self.channels[cid]] if cid in self.channels else None
+        else:
+            entries = self.entries
+        if entries is None:
+            return None
+        keylist = []
+        for entry in entries:
+            if entry[5] is None:
+                entry[5] = list(make_channel_keylist(entry[0], *entry[4]))
+            keylist.extend(entry[5])
+        return keylist
+
+def find_channel_from_CIDBox(db, CIDBox, keyring=None):
+    if keyring:
+        return keyring.find(CIDBox)
     c = db.execute("SELECT id, my_CID_key, highest_inbound_seqnum"
                    " FROM addressbook")
     for row in c.fetchall():
@@ -56,9 +276,21 @@ def find_channel_from_CIDBox(db, CIDBox):
             pass
     return None, None
 
-def build_channel_keylist(db, known_cid):
+def make_channel_keylist(cid, old_privkey_hex, new_privkey_hex):
+    privkey = PrivateKey(old_privkey_hex.decode("hex"))
+    yield (privkey, (cid, "old", privkey.public_key))
+
+    privkey = PrivateKey(new_privkey_hex.decode("hex"))
+    yield (privkey, (cid, "new", privkey.public_key))
+
+def build_channel_keylist(db, known_cid, keyring=None):
     # generates list of (PrivateKey, (cid, which, PublicKey))
     # TODO: limit this by the transport the message arrived on
+    keylist = keyring and keyring.get_keylist(known_cid)
+    if keylist is not None:
+        for key in keylist:
+            yield key
+        return
     if known_cid:
         c = db.execute("SELECT id, my_old_channel_privkey, "
                        "       my_new_channel_privkey"
@@ -68,11 +300,10 @@ def build_channel_keylist(db, known_cid):
                        "       my_new_channel_privkey"
                        " FROM addressbook")
     for row in c.fetchall():
-        privkey = PrivateKey(row["my_old_channel_privkey"].decode("hex"))
-        yield (privkey, (row["id"], "old", privkey.public_key))
-
-        privkey = PrivateKey(row["my_new_channel_privkey"].decode("hex"))
-        yield (privkey, (row["id"], "new", privkey.public_key))
+        for key in make_channel_keylist(row["id"],
+                                        row["my_old_channel_privkey"],
+                                        row["my_new_channel_privkey"]):
+            yield key
 
 def filter_on_known_channel_pubkey(keylist, known_channel_pubkey_s):
     assert known_channel_pubkey_s
@@ -81,21 +312,28 @@ def filter_on_known_channel_pubkey(keylist, known_channel_pubkey_s):
             yield (privkey, keyid)
 
 # this builds a list of candidates, filtered with any hints we got
-def find_channel_list(db, CIDToken, CIDBox):
-    cid, known_channel_pubkey_s = find_channel_from_CIDToken(db, CIDToken)
+def find_channel_list(db, CIDToken, CIDBox, cidindex=None, keyring=None):
+    cid, known_channel_pubkey_s = find_channel_from_CIDToken(cidindex,
+                                                             CIDToken)
     if not cid:
-        cid, known_channel_pubkey_s = find_channel_from_CIDBox(db, CIDBox)
-    keylist = build_channel_keylist(db, cid)
+        CIDBOX_SCANS.inc()
+        cid, known_channel_pubkey_s = find_channel_from_CIDBox(db, CIDBox,
+                                                               keyring)
+    keylist = build_channel_keylist(db, cid, keyring)
     if known_channel_pubkey_s:
         keylist = filter_on_known_channel_pubkey(keylist,
                                                  known_channel_pubkey_s)
     return keylist
 
 # then we trial-decrypt with all candidates
-def decrypt_msgD(msgD, keylist):
+def decrypt_msgD(msgD, keylist, found=None):
+    # 'found' is a threading.Event that other workers, trying other parts
+    # of the same keylist, set when they succeed, so we can stop early
     pubkey2_s, enc = split_into(msgD, [32], True)
     pubkey2 = PublicKey(pubkey2_s)
     for (privkey, keyid) in keylist:
+        if found and found.is_set():
+            break
         try:
             msgE = Box(privkey, pubkey2).decrypt(enc)
             return keyid, pubkey2_s, msgE
@@ -103,9 +341,50 @@ def decrypt_msgD(msgD, keylist):
             pass
     return None, None, None
 
+# keylists are only split for trial decryption if each chunk gets at least
+# this many keys: smaller ones cost more in thread handoffs than they save
+MIN_TRIAL_CHUNK = 32
+CHUNKS_PER_WORKER = 4 # so workers that finish early can take another
+
+def trial_decrypt_msgD(executor, msgD, keylist):
+    # Like decrypt_msgD, but returns a Deferred. A long keylist (from a
+    # message that no hint could place) is split into chunks that the
+    # executor's workers try in parallel. The first match wins: it fires the
+    # Deferred, and the other chunks stop at their next key.
+    chunks = CHUNKS_PER_WORKER * executor.get_workers()
+    chunk_size = max(MIN_TRIAL_CHUNK, -(-len(keylist) // chunks))
+    if len(keylist) <= chunk_size:
+        return executor.run(decrypt_msgD, msgD, keylist)
+    starts = range(0, len(keylist), chunk_size)
+    found = threading.Event()
+    d = defer.Deferred()
+    remaining = [len(starts)]
+    def _tried(res):
+        remaining[0] -= 1
+        if d.called:
+            return
+        if res[0]:
+            found.set()
+            d.callback(res)
+        elif not remaining[0]:
+            d.callback((None, None, None))
+    def _failed(f):
+        remaining[0] -= 1
+        if not d.called:
+            found.set()
+            d.errback(f)
+    for start in starts:
+        d1 = executor.run(decrypt_msgD, msgD,
+                          keylist[start:start+chunk_size], found)
+        d1.addCallbacks(_tried, _failed)
+    return d
+
 def decrypt_CIDBox(CIDKey, CIDBox):
     sb = SecretBox(CIDKey)
     m = sb.decrypt(CIDBox) # may raise CryptoError
+    return parse_CIDBox(m)
+
+def parse_CIDBox(m):
     seqnum_s,HmsgD,channel_pubkey_s = split_into(m, [8, 32, 32])
     seqnum = struct.unpack(">Q", seqnum_s)[0]
     return seqnum, HmsgD, channel_pubkey_s
@@ -141,26 +420,159 @@ def validate_msgC(CIDKey, channel_pubkey,
     # ok, message is valid. Caller should update highest_seen_seqnum and
     # deliver the payload
 
-def process_msgC(db, msgC):
-    CIDToken, CIDBox, msgD = parse_msgC(msgC)
-    keylist = find_channel_list(db, CIDToken, CIDBox)
-    keyid, pubkey2_s, msgE = decrypt_msgD(msgD, keylist)
-    if not keyid:
-        raise UnknownChannelError()
-    cid, which_key, channel_pubkey = keyid
-    c = db.execute("SELECT my_CID_key, highest_inbound_seqnum, their_verfkey"
-                   " FROM addressbook WHERE id=?", (cid,))
-    row = c.fetchone()
-    seqnum, payload_s = check_msgE(msgE, pubkey2_s,
-                                   row["their_verfkey"].decode("hex"),
-                                   row["highest_inbound_seqnum"])
+def check_and_validate_msgC(msgE, pubkey2_s, sender_verfkey_s,
+                            highest_seqnum, CIDKey, channel_pubkey,
+                            CIDBox, CIDToken, msgD):
+    seqnum, payload_s = check_msgE(msgE, pubkey2_s, sender_verfkey_s,
+                                   highest_seqnum)
     # seqnum > highest_inbound_seqnum
-    validate_msgC(row["my_CID_key"].decode("hex"), channel_pubkey,
-                  seqnum, CIDBox, CIDToken, msgD)
-    db.update("UPDATE addressbook SET highest_inbound_seqnum=? WHERE id=?",
-              (seqnum, cid), "addressbook", cid)
-    db.commit() # TODO: allow caller to do the commit
-    return cid, seqnum, payload_s
+    validate_msgC(CIDKey, channel_pubkey, seqnum, CIDBox, CIDToken, msgD)
+    return seqnum, payload_s
+
+MSGC = metrics.counter("petmail_channel_msgC_total",
+                       "inbound msgCs processed, by outcome", ["outcome"])
+MSGC_DELIVERED = MSGC.labels("delivered")
+MSGC_UNKNOWN = MSGC.labels("unknown-channel")
+MSGC_REPLAYED = MSGC.labels("replay")
+MSGC_BAD = MSGC.labels("bad")
+MSGC_SECONDS = metrics.histogram("petmail_channel_process_msgC_seconds",
+                                 "time to decrypt, validate, and record a"
+                                 " batch of inbound msgCs")
+SEND_SECONDS = metrics.histogram("petmail_channel_send_seconds",
+                                 "time to build a msgC and hand it to every"
+                                 " transport")
+
+def process_msgC(db, msgC, executor=None, cidindex=None, keyring=None):
+    # Returns a Deferred that fires with (cid, seqnum, payload_s).
+    d = process_msgCs(db, [msgC], executor, cidindex, keyring)
+    d.addCallback(lambda (result,): result) # a Failure becomes an errback
+    return d
+
+def process_msgCs(db, msgCs, executor=None, cidindex=None, keyring=None,
+                  before_commit=None):
+    """Process a batch of inbound msgCs, e.g. a retriever's backlog.
+    Returns a Deferred that fires with one result for each msgC, in order:
+    (cid, seqnum, payload_s) if it was accepted, or a Failure if not.
+
+    Every accepted message is recorded in a single transaction, which
+    advances each channel's highest_inbound_seqnum once. Callers that store
+    the payloads can pass before_commit=, which is called with the list of
+    accepted results just before that commit, so their rows go into the
+    same one.
+
+    Messages are accepted in order, so one that is older than an earlier
+    message on the same channel is rejected as a replay, just as it would
+    be if they arrived one at a time.
+    """
+    executor = executor or CryptoExecutor()
+    started = MSGC_SECONDS.start()
+    rows = {} # cid -> addressbook row, looked up once for the whole batch
+    dl = [open_msgC(db, msgC, executor, cidindex, keyring, rows)
+          for msgC in msgCs]
+    d = defer.DeferredList(dl, consumeErrors=True)
+    d.addCallback(record_msgCs, db, cidindex, keyring, before_commit)
+    def _done(results):
+        MSGC_SECONDS.stop(started)
+        for res in results:
+            if not isinstance(res, failure.Failure):
+                MSGC_DELIVERED.inc()
+            elif res.check(UnknownChannelError):
+                MSGC_UNKNOWN.inc()
+            elif res.check(ReplayError):
+                MSGC_REPLAYED.inc()
+            else:
+                MSGC_BAD.inc()
+        return results
+    d.addCallback(_done)
+    return d
+
+def open_msgC(db, msgC, executor, cidindex, keyring, rows):
+    # Returns a Deferred that fires with (cid, seqnum, payload_s) if msgC is
+    # valid, without recording anything. We do the database work here in
+    # the reactor thread, and hand the public-key work (trial decryption,
+    # signature checking) to the executor.
+    try:
+        CIDToken, CIDBox, msgD = parse_msgC(msgC)
+        # the executor's threads must not touch the db
+        keylist = list(find_channel_list(db, CIDToken, CIDBox, cidindex,
+                                         keyring))
+    except:
+        return defer.fail()
+    d = trial_decrypt_msgD(executor, msgD, keylist)
+    def _decrypted((keyid, pubkey2_s, msgE)):
+        if not keyid:
+            raise UnknownChannelError()
+        cid, which_key, channel_pubkey = keyid
+        if cid not in rows:
+            c = db.execute("SELECT my_CID_key, highest_inbound_seqnum,"
+                           " their_verfkey"
+                           " FROM addressbook WHERE id=?", (cid,))
+            rows[cid] = c.fetchone()
+        row = rows[cid]
+        d2 = executor.run(check_and_validate_msgC,
+                          msgE, pubkey2_s, row["their_verfkey"].decode("hex"),
+                          row["highest_inbound_seqnum"],
+                          row["my_CID_key"].decode("hex"), channel_pubkey,
+                          CIDBox, CIDToken, msgD)
+        d2.addCallback(lambda (seqnum, payload_s): (cid, seqnum, payload_s))
+        return d2
+    d.addCallback(_decrypted)
+    return d
+
+def record_msgCs(opened, db, cidindex, keyring, before_commit):
+    # 'opened' is a DeferredList's list of (success, result). Returns the
+    # results, with late arrivals turned into ReplayErrors.
+    results = []
+    channels = {} # cid -> (CIDKey, highest_inbound_seqnum)
+    advanced = [] # cids, in order
+    for (success, res) in opened:
+        if not success:
+            results.append(res)
+            continue
+        cid, seqnum, payload_s = res
+        if cid not in channels:
+            # another copy of this message might have been accepted while
+            # the executor was working on it, so ask the database again
+            c = db.execute("SELECT highest_inbound_seqnum, my_CID_key"
+                           " FROM addressbook WHERE id=?", (cid,))
+            row = c.fetchone()
+            channels[cid] = (row["my_CID_key"].decode("hex"),
+                             row["highest_inbound_seqnum"])
+        CIDKey, highest = channels[cid]
+        if seqnum <= highest:
+            results.append(failure.Failure(ReplayError()))
+            continue
+        channels[cid] = (CIDKey, seqnum)
+        if cid not in advanced:
+            advanced.append(cid)
+        results.append(res)
+    if not advanced:
+        return results
+    next_CIDTokens = {}
+    try:
+        for cid in advanced:
+            CIDKey, highest = channels[cid]
+            # the next message on this channel will use this token
+            next_CIDTokens[cid] = build_CIDToken(CIDKey, highest+1)
+            db.update("UPDATE addressbook"
+                      " SET highest_inbound_seqnum=?, next_CID_token=?"
+                      " WHERE id=?",
+                      (highest, next_CIDTokens[cid].encode("hex"), cid),
+                      "addressbook", cid)
+        if before_commit:
+            before_commit([res for res in results
+                           if not isinstance(res, failure.Failure)])
+        db.commit()
+    except:
+        db.rollback()
+        raise
+    for cid in advanced:
+        CIDKey, highest = channels[cid]
+        if cidindex:
+            cidindex.set_channel(cid, CIDKey, highest, next_CIDTokens[cid])
+        if keyring:
+            keyring.advance(cid, highest)
+    return results
 
 def build_CIDToken(CIDKey, seqnum):
     seqnum_s = struct.pack(">Q", seqnum)
@@ -168,23 +580,65 @@ def build_CIDToken(CIDKey, seqnum):
 
 assert struct.calcsize(">Q")*8 == 64
 
+def build_msgC(next_outbound_seqnum, my_signkey, crec, payload):
+    seqnum_s = struct.pack(">Q", next_outbound_seqnum)
+    privkey2 = PrivateKey.generate()
+    pubkey2 = privkey2.public_key.encode()
+    assert len(pubkey2) == 32
+    channel_pubkey = crec["channel_pubkey"].decode("hex")
+    channel_box = Box(privkey2, PublicKey(channel_pubkey))
+    CIDKey = crec["CID_key"].decode("hex")
+
+    authenticator = b"ce0:"+pubkey2
+    msgE = "".join([seqnum_s,
+                    netstring(my_signkey.sign(authenticator)),
+                    json.dumps(payload).encode("utf-8"),
+                    ])
+    msgD = pubkey2 + channel_box.encrypt(msgE, os.urandom(Box.NONCE_SIZE))
+
+    HmsgD = sha256(msgD).digest()
+    CIDToken = build_CIDToken(CIDKey, next_outbound_seqnum)
+    sb = SecretBox(CIDKey)
+    CIDBox = sb.encrypt(seqnum_s+HmsgD+channel_pubkey,
+                        os.urandom(sb.NONCE_SIZE))
+
+    msgC = "".join([b"c0:",
+                    CIDToken,
+                    netstring(CIDBox),
+                    msgD])
+    return msgC
+
 class OutboundChannel:
     # I am created to send messages.
-    def __init__(self, db, cid):
+    def __init__(self, db, cid, executor=None, http=None):
         self.db = db
         self.cid = cid
+        self.executor = executor or CryptoExecutor()
+        self.http = http
 
     def send(self, payload):
         # returns a Deferred that fires when the delivery is complete, so
         # tests can synchronize
-        msgC = self.createMsgC(payload)
-        dl = []
-        for t in self.createTransports():
-            # now wrap msgC into a msgA for each transport they're using
-            dl.append(t.send(msgC))
-        return defer.DeferredList(dl)
+        started = SEND_SECONDS.start()
+        d = self.executor.run(build_msgC, *self.prepareMsgC(payload))
+        def _built(msgC):
+            dl = []
+            for t in self.createTransports():
+                # now wrap msgC into a msgA for each transport they're using
+                dl.append(t.send(msgC))
+            return defer.DeferredList(dl)
+        d.addCallback(_built)
+        def _sent(res):
+            SEND_SECONDS.stop(started)
+            return res
+        d.addBoth(_sent)
+        return d
 
     def createMsgC(self, payload):
+        return build_msgC(*self.prepareMsgC(payload))
+
+    def prepareMsgC(self, payload):
+        # allocate a seqnum and gather the keys, in the reactor thread
         c = self.db.execute("SELECT next_outbound_seqnum, my_signkey,"
                             " their_channel_record_json"
                             " FROM addressbook WHERE id=?", (self.cid,))
@@ -196,34 +650,9 @@ class OutboundChannel:
                        (next_outbound_seqnum+1, self.cid),
                        "addressbook", self.cid)
         self.db.commit()
-        seqnum_s = struct.pack(">Q", next_outbound_seqnum)
         my_signkey = SigningKey(res["my_signkey"].decode("hex"))
-        privkey2 = PrivateKey.generate()
-        pubkey2 = privkey2.public_key.encode()
-        assert len(pubkey2) == 32
         crec = json.loads(res["their_channel_record_json"])
-        channel_pubkey = crec["channel_pubkey"].decode("hex")
-        channel_box = Box(privkey2, PublicKey(channel_pubkey))
-        CIDKey = crec["CID_key"].decode("hex")
-
-        authenticator = b"ce0:"+pubkey2
-        msgE = "".join([seqnum_s,
-                        netstring(my_signkey.sign(authenticator)),
-                        json.dumps(payload).encode("utf-8"),
-                        ])
-        msgD = pubkey2 + channel_box.encrypt(msgE, os.urandom(Box.NONCE_SIZE))
-
-        HmsgD = sha256(msgD).digest()
-        CIDToken = build_CIDToken(CIDKey, next_outbound_seqnum)
-        sb = SecretBox(CIDKey)
-        CIDBox = sb.encrypt(seqnum_s+HmsgD+channel_pubkey,
-                            os.urandom(sb.NONCE_SIZE))
-
-        msgC = "".join([b"c0:",
-                        CIDToken,
-                        netstring(CIDBox),
-                        msgD])
-        return msgC
+        return next_outbound_seqnum, my_signkey, crec, payload
 
     def createTransports(self):
         c = self.db.execute("SELECT their_channel_record_json"
@@ -235,8 +664,9 @@ class OutboundChannel:
 
     def make_transport(self, trecord):
         if trecord["type"] == "test-return":
-            return ReturnTransport(self.db, trecord)
+            return ReturnTransport(self.db, trecord, self.executor)
         elif trecord["type"] == "http":
-            return OutboundHTTPTransport(self.db, trecord)
+            return OutboundHTTPTransport(self.db, trecord, self.executor,
+                                         self.http)
         else:
             raise ValueError("unknown transport '%s'" % trecord["type"])
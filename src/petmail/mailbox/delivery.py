@@ -1,8 +1,10 @@
 import os
-from twisted.internet import defer
-from twisted.web import client
+from twisted.internet import task
+from twisted.web import error, http
 from nacl.public import PrivateKey, PublicKey, Box
 from .. import rrid
+from ..executor import CryptoExecutor
+from ..httpclient import HTTPClient
 from ..netstring import netstring
 
 # msgA:
@@ -29,22 +31,58 @@ def createMsgA(trec, msgC):
 
 class ReturnTransport: # for tests
     """I call mailbox.transport to create msgA, then return it."""
-    def __init__(self, db, trecord):
+    def __init__(self, db, trecord, executor=None):
         self.db = db
         self.trecord = trecord
+        self.executor = executor or CryptoExecutor()
 
     def send(self, msgC):
-        msgA = createMsgA(self.trecord, msgC)
-        return defer.succeed(msgA)
+        return self.executor.run(createMsgA, self.trecord, msgC)
 
 class OutboundHTTPTransport:
     """I call mailbox.transport to create msgA, then perform an HTTP POST to a
-    mailbox server."""
-    def __init__(self, db, trecord):
+    mailbox server.
+
+    If the recipient's transport is full, the server answers 503 with a
+    Retry-After header. I wait that long (at most MAX_RETRY_DELAY seconds)
+    and try again, up to MAX_RETRIES times before giving up."""
+    MAX_RETRIES = 3
+    DEFAULT_RETRY_DELAY = 60 # when Retry-After is missing or an HTTP-date
+    MAX_RETRY_DELAY = 3600
+
+    def __init__(self, db, trecord, executor=None, http=None, clock=None):
         self.db = db
         self.trecord = trecord
+        self.executor = executor or CryptoExecutor()
+        # without a node's shared client, use a connection per request
+        self.http = http or HTTPClient(persistent=False)
+        if not clock:
+            from twisted.internet import reactor as clock
+        self.clock = clock
 
     def send(self, msgC):
-        msgA = createMsgA(self.trecord, msgC)
+        d = self.executor.run(createMsgA, self.trecord, msgC)
+        d.addCallback(self.post, self.MAX_RETRIES)
+        return d
+
+    def post(self, msgA, retries):
         url = str(self.trecord["url"])
-        return client.getPage(url, method="POST", postdata=msgA)
+        d = self.http.getPage(url, method="POST", postdata=msgA)
+        def _failed(f):
+            f.trap(error.Error)
+            if int(f.value.status) != http.SERVICE_UNAVAILABLE or not retries:
+                return f
+            delay = get_retry_delay(f.value, self.DEFAULT_RETRY_DELAY)
+            delay = min(delay, self.MAX_RETRY_DELAY)
+            return task.deferLater(self.clock, delay,
+                                   self.post, msgA, retries-1)
+        d.addErrback(_failed)
+        return d
+
+def get_retry_delay(e, default):
+    headers = getattr(e, "headers", None)
+    values = headers and headers.getRawHeaders("retry-after")
+    try:
+        return max(0, int(values[0]))
+    except (TypeError, IndexError, ValueError):
+        return default
@@ -0,0 +1,145 @@
+# I delete queued messages that their recipient never came back for. The
+# mailbox contract says how long unread messages are kept (see "Retention
+# Periods" in docs/mailbox.md), and this is where we honor it.
+
+import time
+from twisted.application import service, internet
+from twisted.internet import defer
+from twisted.python import log, failure
+
+class ExpirySweeper(service.MultiService):
+    """I periodically delete messages that have been queued for longer than
+    their transport's retention period (in seconds): each transport's own
+    'retention', or the server-wide one if it doesn't have one. A retention
+    of None means 'keep forever'.
+
+    Each sweep walks the message store's arrival index, oldest first, and
+    deletes expired messages batch_size at a time, committing after each
+    batch and going back to the reactor in between, so no single
+    transaction (or write lock) lasts long and deliveries can get in. The
+    deletes go through the store like any other, so quota counters and
+    retrieval tokens follow along.
+
+    sweep() fires with a report: {'messages': N, 'bytes': N, 'transports':
+    {tid: N}}. Non-empty reports are logged, and get_stats() has the
+    totals.
+    """
+
+    def __init__(self, store, db, transports, retention, interval=3600,
+                 batch_size=100, clock=time.time, reactor=None):
+        service.MultiService.__init__(self)
+        assert batch_size >= 1
+        self.store = store
+        self.db = db
+        self.transports = transports
+        self.retention = retention
+        self.batch_size = batch_size
+        self.clock = clock
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.report = None # while a sweep is running
+        self.waiting = [] # Deferreds for the running sweep
+        self.next_batch = None
+        self.sweeps = 0
+        self.expired_messages = 0
+        self.expired_bytes = 0
+        self.last_report = None
+        ts = internet.TimerService(interval, self.periodic_sweep)
+        ts.setServiceParent(self)
+
+    def stopService(self):
+        if self.next_batch and self.next_batch.active():
+            # the rest will have to wait for the next sweep
+            self.next_batch.cancel()
+            self.finish()
+        return service.MultiService.stopService(self)
+
+    def get_retention(self, tid):
+        t = self.transports.get(tid)
+        if t and t.retention is not None:
+            return t.retention
+        return self.retention
+
+    def shortest_retention(self):
+        row = self.db.execute("SELECT MIN(retention)"
+                              " FROM mailbox_server_transports").fetchone()
+        retentions = [r for r in (self.retention, row[0]) if r is not None]
+        return min(retentions) if retentions else None
+
+    def periodic_sweep(self):
+        d = self.sweep()
+        # failures were logged already, and shouldn't stop the timer
+        d.addErrback(lambda f: None)
+        return d
+
+    def sweep(self):
+        # returns a Deferred that fires with the report
+        d = defer.Deferred()
+        self.waiting.append(d)
+        if self.report is not None:
+            return d # joins the sweep that is already running
+        self.report = {"messages": 0, "bytes": 0, "transports": {}}
+        now = self.clock()
+        shortest = self.shortest_retention()
+        if shortest is None:
+            self.finish()
+            return d
+        # nothing younger than this can have expired, whatever its tid
+        self.sweep_batch(now, now - shortest, None)
+        return d
+
+    def sweep_batch(self, now, before, after):
+        self.next_batch = None
+        try:
+            old = self.store.list_old_messages(before, after, self.batch_size)
+            expired = []
+            for (arrived, msgid, tid, length) in old:
+                retention = self.get_retention(tid)
+                if retention is not None and arrived < now - retention:
+                    expired.append((msgid, tid, length))
+            for (msgid, tid, length) in expired:
+                self.store.delete_message(msgid)
+            if expired:
+                self.store.commit()
+        except:
+            f = failure.Failure()
+            log.err(f, "message expiry sweep failed")
+            self.store.rollback()
+            self.finish(f)
+            return
+        for (msgid, tid, length) in expired:
+            self.report["messages"] += 1
+            self.report["bytes"] += length
+            transports = self.report["transports"]
+            transports[tid] = transports.get(tid, 0) + 1
+        if len(old) < self.batch_size:
+            self.finish()
+            return
+        # let everybody else have a turn before the next batch
+        self.next_batch = self.reactor.callLater(0, self.sweep_batch, now,
+                                                 before, old[-1][:2])
+
+    def finish(self, f=None):
+        report, self.report = self.report, None
+        waiting, self.waiting = self.waiting, []
+        self.sweeps += 1
+        self.expired_messages += report["messages"]
+        self.expired_bytes += report["bytes"]
+        self.last_report = report
+        if report["messages"]:
+            log.msg("expired %d messages (%d bytes) from %d transports"
+                    % (report["messages"], report["bytes"],
+                       len(report["transports"])))
+        for d in waiting:
+            if f:
+                d.errback(f)
+            else:
+                d.callback(report)
+
+    def get_stats(self):
+        return {"sweeps": self.sweeps,
+                "expired_messages": self.expired_messages,
+                "expired_bytes": self.expired_bytes,
+                "sweeping": self.report is not None,
+                }
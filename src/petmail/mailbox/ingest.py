@@ -0,0 +1,234 @@
+# I hold the pieces of the mailbox server that sit between "we decrypted an
+# inbound msgB and know which transport it is for" and "the msgC is safely
+# on disk, waiting for the recipient to retrieve it".
+
+import os, sys, struct, socket
+from twisted.application import service
+from twisted.internet import defer, protocol, error
+from twisted.protocols.basic import NetstringReceiver
+from twisted.python import log, failure
+from ..netstring import netstring
+
+class GroupCommitter:
+    """I collect queued msgC rows and write them to the MessageStore in batches,
+    so that a burst of inbound messages costs one commit (and one fsync)
+    instead of one per message.
+
+    A batch is flushed when it holds max_messages rows, or when the oldest
+    row has been waiting for max_delay_ms milliseconds, whichever comes
+    first. The defaults (max_messages=1, max_delay_ms=0) flush every message
+    immediately, which is what we did before grouping existed.
+
+    Durability is explicit: add() returns a Deferred that fires (with the new
+    message id) only after the transaction containing that row has been
+    committed. Until then the message lives only in memory, and will be lost
+    if the process dies. Callers who need to know that a message is safe
+    must wait for that Deferred. Stopping the server flushes anything still
+    pending.
+    """
+
+    def __init__(self, store, max_messages=1, max_delay_ms=0, clock=None):
+        assert max_messages >= 1
+        self.store = store
+        self.max_messages = max_messages
+        self.max_delay = max_delay_ms / 1000.0
+        if not clock:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.pending = [] # list of (tid, msgC, Deferred)
+        self.timer = None
+
+    def add(self, tid, msgC):
+        d = defer.Deferred()
+        self.pending.append((tid, msgC, d))
+        if len(self.pending) >= self.max_messages or self.max_delay <= 0:
+            self.flush()
+        elif not self.timer:
+            self.timer = self.clock.callLater(self.max_delay, self.flush)
+        return d
+
+    def flush(self):
+        if self.timer:
+            if self.timer.active():
+                self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        try:
+            msgids = [self.store.add_message(tid, msgC)
+                      for (tid, msgC, d) in batch]
+            self.store.commit()
+        except:
+            f = failure.Failure()
+            log.err(f, "group commit failed, %d messages lost" % len(batch))
+            self.store.rollback()
+            for (tid, msgC, d) in batch:
+                d.errback(f)
+            return
+        for (tid, msgC, d), msgid in zip(batch, msgids):
+            d.callback(msgid)
+
+
+
+# Ingest workers are separate processes that share one listening socket
+# (handed to them as LISTEN_FD). Each one accepts POSTs of msgA, decrypts
+# them, and resolves the transport, then writes a record to its stdout
+# (which is a pipe to us) as a netstring:
+#
+#  "m" + tid (8 bytes) + msgC    : queue msgC for transport tid
+#  "u" + TTID                    : a message arrived for an unknown TTID
+#
+# We own the database: we validate the tid and queue the message, just as
+# if our own ServerResource had received it. We also own the quota
+# counters, so we tell each worker (on its stdin, also as netstrings) which
+# transports are full, and it turns their senders away:
+#
+#  "q" + tid (8 bytes)           : transport tid is full
+#  "r" + tid (8 bytes)           : transport tid has room again
+
+LISTEN_FD = 3
+WORKER_COMMAND = "from petmail.mailbox.ingestworker import main; main()"
+
+def create_listening_socket(listen):
+    # 'listen' looks like the node's --listen: tcp:PORT[:interface=ADDR]
+    parts = listen.split(":")
+    if parts[0] != "tcp":
+        raise ValueError("ingest listen address must start with tcp:")
+    port, interface = int(parts[1]), ""
+    for p in parts[2:]:
+        k, v = p.split("=", 1)
+        if k == "interface":
+            interface = v
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((interface, port))
+    s.listen(128)
+    s.setblocking(False)
+    return s
+
+class RecordReceiver(NetstringReceiver):
+    MAX_LENGTH = 64*1000*1000
+    def __init__(self, got_record):
+        self.got_record = got_record
+    def stringReceived(self, record):
+        self.got_record(record)
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    def __init__(self, pool):
+        self.pool = pool
+        self.records = RecordReceiver(pool.got_record)
+        self.exited = defer.Deferred()
+
+    def connectionMade(self):
+        self.pid = self.transport.pid
+        self.records.makeConnection(self.transport)
+
+    def childDataReceived(self, childFD, data):
+        if childFD == 1:
+            self.records.dataReceived(data)
+        else:
+            for line in data.splitlines():
+                log.msg("ingest worker %s: %s" % (self.pid, line))
+
+    def processEnded(self, reason):
+        self.pool.worker_exited(self, reason)
+        self.exited.callback(None)
+
+class IngestWorkerPool(service.Service):
+    """I run num_workers ingest worker processes, which accept and decrypt
+    inbound messages on a separate listening port, so that delivery can use
+    more than one core. I hand each (tid, msgC) they send me to
+    deliver(tid, msgC), and each unrecognized TTID to unrecognized(TTID).
+    Workers that die are restarted after RESTART_DELAY seconds. 'full' is
+    the set of tids that are over quota: new workers are told about all of
+    them, and set_full() tells the running ones about changes.
+    """
+    RESTART_DELAY = 1.0
+
+    def __init__(self, dbfile, listen, num_workers, deliver, unrecognized,
+                 full=()):
+        assert num_workers >= 1
+        self.dbfile = dbfile
+        self.listen = listen
+        self.num_workers = num_workers
+        self.deliver = deliver
+        self.unrecognized = unrecognized
+        self.full = full
+        self.workers = set()
+        self.records_received = 0
+
+    def startService(self):
+        service.Service.startService(self)
+        self.sock = create_listening_socket(self.listen)
+        for i in range(self.num_workers):
+            self.spawn()
+
+    def get_port(self):
+        return self.sock.getsockname()[1]
+
+    def spawn(self):
+        from twisted.internet import reactor
+        if not self.running:
+            return
+        p = WorkerProtocol(self)
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+        reactor.spawnProcess(p, sys.executable,
+                             [sys.executable, "-c", WORKER_COMMAND,
+                              self.dbfile],
+                             env=env,
+                             childFDs={0: "w", 1: "r", 2: "r",
+                                       LISTEN_FD: self.sock.fileno()})
+        self.workers.add(p)
+        for tid in self.full:
+            self.send_record(p, "q" + struct.pack(">Q", tid))
+
+    def send_record(self, p, record):
+        try:
+            p.transport.writeToChild(0, netstring(record))
+        except KeyError:
+            pass # its stdin is closed, so it is exiting, and will restart
+
+    def set_full(self, tid, full):
+        record = ("q" if full else "r") + struct.pack(">Q", tid)
+        for p in self.workers:
+            self.send_record(p, record)
+
+    def got_record(self, record):
+        self.records_received += 1
+        # an exception raised from here would make Twisted close the pipe
+        # from this worker, which would keep accepting messages that never
+        # reach us, so one bad record must not escape
+        try:
+            if record[0] == "m":
+                (tid,) = struct.unpack(">Q", record[1:9])
+                self.deliver(tid, record[9:])
+            elif record[0] == "u":
+                self.unrecognized(record[1:])
+            else:
+                log.msg("unknown record type from ingest worker: %r"
+                        % record[:1])
+        except Exception:
+            log.err(None, "error handling a record from an ingest worker")
+
+    def worker_exited(self, p, reason):
+        from twisted.internet import reactor
+        self.workers.discard(p)
+        if self.running:
+            log.msg("ingest worker %s exited (%s), restarting"
+                    % (p.pid, reason.value))
+            reactor.callLater(self.RESTART_DELAY, self.spawn)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        dl = []
+        for p in self.workers:
+            try:
+                p.transport.signalProcess("TERM")
+            except error.ProcessExitedAlready:
+                pass
+            dl.append(p.exited)
+        d = defer.DeferredList(dl)
+        d.addCallback(lambda _: self.sock.close())
+        return d
@@ -0,0 +1,94 @@
+# I am the main program of an ingest worker process, spawned by
+# petmail.mailbox.ingest.IngestWorkerPool . I accept msgA POSTs on the
+# listening socket that my parent handed me, decrypt them, figure out which
+# transport they are for, and send the results back to my parent over
+# stdout. I only read the database. My parent tells me (over stdin) which
+# transports are full, so I can turn their senders away.
+
+import sys, json, struct, socket
+from twisted.internet import stdio
+from twisted.protocols.basic import NetstringReceiver
+from twisted.python import log
+from twisted.web import resource
+from nacl.public import PrivateKey
+from .. import rrid
+from ..database import make_observable_db
+from ..web import LimitedSite
+from .server import (ServerResource, decryptMsgA, parseMsgB,
+                     DEFAULT_MAX_MSGA_SIZE, DEFAULT_QUOTA_RETRY_AFTER)
+from .quota import QuotaExceeded
+from .transports import TransportRegistry
+from .ingest import LISTEN_FD
+
+class ParentConnection(NetstringReceiver):
+    worker = None
+
+    def stringReceived(self, record):
+        self.worker.got_record(record)
+
+    def connectionLost(self, why):
+        # our parent went away, so there's nobody to deliver to
+        from twisted.internet import reactor
+        if reactor.running:
+            reactor.stop()
+
+class IngestWorker:
+    def __init__(self, db, desc, parent):
+        self.parent = parent
+        self.transport_privkey = PrivateKey(
+            desc["transport_privkey"].decode("hex"))
+        self.TT_privkey = desc["TT_private_key"].decode("hex")
+        self.transports = TransportRegistry(
+            db, max_entries=desc.get("transport_cache_size", 10000))
+        self.retry_after = desc.get("quota_retry_after",
+                                    DEFAULT_QUOTA_RETRY_AFTER)
+        self.full = set() # tids, as told by our parent
+
+    def got_record(self, record):
+        (tid,) = struct.unpack(">Q", record[1:9])
+        if record[0] == "q":
+            self.full.add(tid)
+        elif record[0] == "r":
+            self.full.discard(tid)
+        else:
+            log.msg("unknown record type from parent: %r" % record[:1])
+
+    def handle_msgA(self, msgA):
+        msgB = decryptMsgA(self.transport_privkey, msgA)
+        # like HTTPMailboxServer.admit_msgB, a full transport is the only
+        # other thing the sender hears about. This is quick enough to do
+        # before we answer them.
+        try:
+            MSTT, msgC = parseMsgB(msgB)
+            TTID = rrid.decrypt(self.TT_privkey, MSTT)
+        except Exception:
+            log.err(None, "unable to parse msgB")
+            return
+        t = self.transports.lookup_TTID(TTID)
+        if t and t.tid in self.full:
+            raise QuotaExceeded(self.retry_after)
+        if t:
+            self.parent.sendString("m" + struct.pack(">Q", t.tid) + msgC)
+        else:
+            self.parent.sendString("u" + TTID)
+
+def main(argv=None):
+    from twisted.internet import reactor
+    dbfile = (argv or sys.argv)[1]
+    # stdout is for records, so logs go to stderr, which our parent copies
+    # into its own log
+    log.startLogging(sys.stderr, setStdout=False)
+    db = make_observable_db(dbfile)
+    row = db.execute("SELECT * FROM mailbox_server_config").fetchone()
+    desc = json.loads(row["mailbox_config_json"])
+    parent = ParentConnection()
+    w = IngestWorker(db, desc, parent)
+    parent.worker = w
+    stdio.StandardIO(parent)
+    root = resource.Resource()
+    root.putChild("mailbox", ServerResource(w.handle_msgA))
+    site = LimitedSite(root)
+    site.limit_body("/mailbox",
+                    desc.get("max_msgA_size", DEFAULT_MAX_MSGA_SIZE), "a0:")
+    reactor.adoptStreamPort(LISTEN_FD, socket.AF_INET, site)
+    reactor.run()
@@ -0,0 +1,110 @@
+# I keep track of how much each transport has queued on the mailbox server,
+# so that one recipient who never retrieves their messages can't fill up
+# the disk for everybody else.
+
+class QuotaExceeded(Exception):
+    """The transport a message was aimed at is full. The sender should try
+    again after retry_after seconds."""
+    def __init__(self, retry_after):
+        Exception.__init__(self, retry_after)
+        self.retry_after = retry_after
+
+class QuotaTracker:
+    """I count the messages and bytes queued for each transport (tid), and
+    decide which transports are full.
+
+    The counts start from the MessageStore's usage() (the message store is
+    what makes them persistent), then follow along in memory: queued
+    messages are charged when they are handed to the committer (so messages
+    that are still waiting for a group commit count too), refunded if that
+    commit fails, and deleted messages are subtracted when the store tells
+    us about them, however they were deleted.
+
+    A transport is full when it holds max_messages messages or max_bytes
+    bytes, either of which can be None for 'unlimited'. Each transport can
+    override the server-wide limits with its own max_messages/max_bytes.
+    The check happens before a message is accepted, so a transport can end
+    up slightly over its limit, by the messages that were in flight when it
+    filled. Observers (see subscribe()) are told whenever a transport
+    becomes full or stops being full.
+    """
+
+    def __init__(self, store, transports, max_messages=None, max_bytes=None,
+                 retry_after=300):
+        self.transports = transports
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.retry_after = retry_after
+        self.usage = {} # tid -> [messages, bytes]
+        self.full = set() # tids
+        self.observers = []
+        for tid, (messages, size) in store.usage().items():
+            self.usage[tid] = [messages, size]
+            self.update(tid)
+        store.subscribe(self.message_changed)
+
+    def subscribe(self, observer):
+        # observer(tid, full) is called when a transport fills or empties
+        self.observers.append(observer)
+
+    def get_limits(self, tid):
+        max_messages, max_bytes = self.max_messages, self.max_bytes
+        t = self.transports.get(tid)
+        if t and t.max_messages is not None:
+            max_messages = t.max_messages
+        if t and t.max_bytes is not None:
+            max_bytes = t.max_bytes
+        return max_messages, max_bytes
+
+    def update(self, tid):
+        messages, size = self.usage.get(tid, (0, 0))
+        max_messages, max_bytes = self.get_limits(tid)
+        full = ((max_messages is not None and messages >= max_messages) or
+                (max_bytes is not None and size >= max_bytes))
+        if full == (tid in self.full):
+            return
+        if full:
+            self.full.add(tid)
+        else:
+            self.full.discard(tid)
+        for o in self.observers:
+            o(tid, full)
+
+    def check(self, tid):
+        if tid in self.full:
+            raise QuotaExceeded(self.retry_after)
+
+    def charge(self, tid, length):
+        u = self.usage.setdefault(tid, [0, 0])
+        u[0] += 1
+        u[1] += length
+        self.update(tid)
+
+    def refund(self, tid, length):
+        u = self.usage.get(tid)
+        if not u:
+            return
+        u[0] -= 1
+        u[1] -= length
+        if u[0] <= 0:
+            del self.usage[tid]
+        self.update(tid)
+
+    def message_changed(self, notice):
+        # subscribed to the message store
+        if notice.action == "delete" and "tid" in notice.tags:
+            self.refund(notice.tags["tid"], notice.tags["length"])
+
+    def get_usage(self, tid):
+        messages, size = self.usage.get(tid, (0, 0))
+        max_messages, max_bytes = self.get_limits(tid)
+        return {"messages": messages, "bytes": size,
+                "max_messages": max_messages, "max_bytes": max_bytes,
+                "full": tid in self.full}
+
+    def get_stats(self):
+        return {"transports": len(self.usage),
+                "messages": sum([u[0] for u in self.usage.values()]),
+                "bytes": sum([u[1] for u in self.usage.values()]),
+                "full": len(self.full),
+                }
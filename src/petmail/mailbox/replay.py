@@ -0,0 +1,83 @@
+# I remember which retrieval list requests the mailbox server has already
+# seen, so a captured request can't be replayed to learn about new messages
+# or to invalidate the tokens of the real session.
+
+import time
+
+class ReplayCacheFull(Exception):
+    pass
+
+class ReplayCache:
+    """I am a set of list-request pubkeys (tmppub), each remembered until its
+    request timestamp falls out of the server's clock window (after which
+    the request would be refused for clock skew anyway).
+
+    Pubkeys are filed in buckets of bucket_size seconds, by timestamp, so
+    adding one is a dict insertion and expiring them is done a whole bucket
+    at a time. At most max_entries are held: when that many unexpired
+    requests are outstanding, add() raises ReplayCacheFull rather than
+    forgetting any, so the server must refuse the request.
+
+    If given a database, I also record each pubkey in the
+    retrieval_replay_tokens table (and reload the unexpired ones when
+    created), so restarting the server doesn't reopen the window.
+    """
+
+    def __init__(self, window, bucket_size=60, max_entries=100000, db=None,
+                 now=None):
+        self.window = window
+        self.bucket_size = bucket_size
+        self.max_entries = max_entries
+        self.db = db
+        self.seen = {} # tmppub -> bucket number
+        self.buckets = {} # bucket number -> list of tmppubs
+        self.next_prune = None
+        if db:
+            self.load(now or time.time())
+
+    def __len__(self):
+        return len(self.seen)
+
+    def __contains__(self, tmppub):
+        return tmppub in self.seen
+
+    def load(self, now):
+        c = self.db.execute("SELECT * FROM retrieval_replay_tokens"
+                            " WHERE timestamp >= ?", (now-self.window,))
+        for row in c.fetchall():
+            self.remember(row["pubkey"].decode("hex"), row["timestamp"])
+        self.prune(now)
+
+    def remember(self, tmppub, ts):
+        b = int(ts // self.bucket_size)
+        self.seen[tmppub] = b
+        self.buckets.setdefault(b, []).append(tmppub)
+
+    def add(self, tmppub, ts, now=None):
+        now = now or time.time()
+        if self.next_prune is None or now >= self.next_prune:
+            self.prune(now)
+        if len(self.seen) >= self.max_entries:
+            raise ReplayCacheFull()
+        self.remember(tmppub, ts)
+        if self.db:
+            self.db.execute("INSERT INTO retrieval_replay_tokens"
+                            " (timestamp, pubkey) VALUES (?,?)",
+                            (int(ts), tmppub.encode("hex")))
+            self.db.commit()
+
+    def prune(self, now=None):
+        # a bucket can go once its newest possible timestamp is too old to
+        # be accepted
+        now = now or time.time()
+        oldest = now - self.window
+        for b in [b for b in self.buckets
+                  if (b+1)*self.bucket_size <= oldest]:
+            for tmppub in self.buckets.pop(b):
+                del self.seen[tmppub]
+        if self.db:
+            self.db.execute("DELETE FROM retrieval_replay_tokens"
+                            " WHERE timestamp < ?",
+                            (int(oldest // self.bucket_size) * self.bucket_size,))
+            self.db.commit()
+        self.next_prune = now + self.bucket_size
@@ -1,14 +1,17 @@
-import time, struct
+import time, struct, json
+from collections import deque
 from base64 import urlsafe_b64encode, b64decode
 from twisted.application import service
-from twisted.web import client
-from twisted.python import log
+from twisted.internet import defer
+from twisted.python import log, failure
 from nacl.secret import SecretBox
 from nacl.public import PrivateKey, PublicKey, Box
 from ..errors import ReplayError
 from ..eventual import fireEventually
+from ..netstring import split_netstrings
 from ..util import equal, remove_prefix
 from ..eventsource import ReconnectingEventSource
+from ..httpclient import HTTPClient
 
 class LocalRetriever(service.MultiService):
     """I can 'retrieve' messages from an in-process HTTPMailboxServer. This
@@ -21,13 +24,21 @@ class LocalRetriever(service.MultiService):
     """
     def __init__(self, descriptor, got_msgC, server):
         service.MultiService.__init__(self)
-        server.register_local_transport_handler(got_msgC)
+        def _got_msgC(msgC):
+            d = defer.maybeDeferred(got_msgC, msgC)
+            d.addErrback(log.err)
+        server.register_local_transport_handler(_got_msgC)
 
 ENABLE_POLLING = False
+# fetch (and then delete) up to this many messages per round trip
+FETCH_BATCH_SIZE = 50
+# and keep up to this many fetch requests in flight at once
+MAX_FETCH_WINDOW = 8
 
 # retrieval code
 
-def encrypt_list_request(serverpubkey, RT, offset=0, now=None, tmppriv=None):
+def encrypt_list_request(serverpubkey, RT, offset=0, now=None, tmppriv=None,
+                         options=None):
     if not now:
         now = int(time.time())
     now = now + offset
@@ -38,6 +49,8 @@ def encrypt_list_request(serverpubkey, RT, offset=0, now=None, tmppriv=None):
     nonce = "\x00"*24 # safe because we use a new random keypair each time
     assert len(RT) == 8
     m = struct.pack(">Q8s", now, RT)
+    if options:
+        m += json.dumps(options)
     boxed0 = Box(tmppriv, PublicKey(serverpubkey)).encrypt(m, nonce)
     assert boxed0[:24] == nonce
     boxed = boxed0[24:] # we elide the nonce, always 0
@@ -52,6 +65,8 @@ class NotFetchResponseError(Exception):
     pass
 class WrongFetchTokenError(Exception):
     pass
+class NotInlineEntryError(Exception):
+    pass
 
 def decrypt_list_entry(boxed, symkey, tmppub):
     sbox = SecretBox(symkey)
@@ -63,6 +78,15 @@ def decrypt_list_entry(boxed, symkey, tmppub):
         raise WrongPubkeyError
     return fetch_token, delete_token, length
 
+def decrypt_inline_entry(boxed, symkey, tmppub):
+    msg = remove_prefix(SecretBox(symkey).decrypt(boxed),
+                        "inline:", NotInlineEntryError)
+    if not equal(msg[:32], tmppub):
+        raise WrongPubkeyError
+    delete_token = msg[32:64]
+    msgC = msg[64:]
+    return delete_token, msgC
+
 def decrypt_fetch_response(symkey, fetch_token, boxed):
     msg = remove_prefix(SecretBox(symkey).decrypt(boxed),
                         "fetch:", NotFetchResponseError)
@@ -77,9 +101,20 @@ class HTTPRetriever(service.MultiService):
     defined in mailbox.server.RetrievalResource. I can either poll or use
     Server-Sent Events to discover new messages. Once I've retrieved them, I
     delete them from the server. I handle transport encryption to hide the
-    message contents as I grab them."""
-    def __init__(self, descriptor, got_msgC):
+    message contents as I grab them.
+
+    Each message is handed to got_msgC(msgC), in order. Callers that can
+    handle several at once (in one database transaction, say) can pass
+    got_msgCs(msgCs) too, which gets each fetched batch instead, and
+    returns a Deferred that fires with a result or Failure for each."""
+    def __init__(self, descriptor, got_msgC, http=None, got_msgCs=None):
         service.MultiService.__init__(self)
+        if not http:
+            # we still want to reuse our connection from one fetch to the
+            # next, so make our own pool, and close it when we stop
+            http = HTTPClient()
+            http.setServiceParent(self)
+        self.http = http
         self.descriptor = descriptor
         self.baseurl = str(descriptor["baseurl"])
         assert self.baseurl.endswith("/")
@@ -87,65 +122,342 @@ class HTTPRetriever(service.MultiService):
         self.symkey = descriptor["retrieval_symkey"].decode("hex")
         self.RT = descriptor["RT"].decode("hex")
         self.got_msgC = got_msgC
+        self.got_msgCs = got_msgCs
+        # with "autodelete", the server deletes each message once it has sent
+        # it to us, so we might see a message twice (if we lose the
+        # connection just as it finishes), but never have to delete anything
+        self.autodelete = bool(descriptor.get("autodelete", False))
         self.clock_offset = 0 # TODO
-        self.fetchable = [] # list of (fetch_token, delete_token, length)
+        # (fetch_token, delete_token, length, cursor), or (None,
+        # delete_token, msgC, cursor) for small messages that came with the
+        # list. 'cursor' is None except for the last entry of each event.
+        self.fetchable = deque()
+        # fetch requests in flight, oldest first: (generation, batch,
+        # Deferred that fires with the responses). At most self.window.
+        self.pipeline = deque()
+        self.generation = 0 # counts list sessions
+        self.fetching = None # Deferred, while the fetch loop runs
+        self.window = 2
+        self.base_latency = None # the quickest fetch we've seen
+        self.stats = {"messages": 0, "batches": 0, "bytes": 0,
+                      "busy_time": 0.0}
+        self.requests_in_flight = 0
+        self.busy_since = None
+        # delete tokens for messages we've handled, which ride along with
+        # our next fetch
+        self.acks = []
+        # delete tokens we've queued but the server hasn't yet confirmed,
+        # each mapped to a serial number that increases as we queue them
+        self.unconfirmed = {}
+        self.ack_serial = 0
+        # the server gives us a cursor with each batch of list entries. Once
+        # we've handled them, passing it back (when we reconnect) means we'll
+        # only hear about newer messages. "" means "tell me about
+        # everything". But a new list session revokes the old one's delete
+        # tokens, so we only adopt a cursor once the server has confirmed
+        # the deletes queued before it: (generation, ack_serial, cursor).
+        self.cursor = ""
+        self.pending_cursors = deque()
         self.source = ReconnectingEventSource(self.baseurl,
                                               self.start_source,
-                                              self.handle_SSE)
+                                              self.handle_SSE,
+                                              self.http)
         self.source.setServiceParent(self)
         self.source.activate()
 
     def start_source(self):
         # each time we start the EventSource, we must establish a new URL
         req, tmppub = encrypt_list_request(self.server_pubkey, self.RT,
-                                           offset=self.clock_offset)
+                                           offset=self.clock_offset,
+                                           options={"cursor": self.cursor,
+                                                    "inline": True})
         self.tmppub = tmppub
-        self.fetchable = []
+        # the new list session revokes the old one's tokens, so anything we
+        # haven't fetched (or deleted) yet will be listed again
+        self.generation += 1
+        self.fetchable.clear()
+        self.acks = []
+        self.unconfirmed.clear()
+        self.pending_cursors.clear()
         url = self.baseurl + "list?t=%s" % urlsafe_b64encode(req)
         return url
 
     def handle_SSE(self, name, data):
+        # We stay subscribed while we fetch, so new messages are announced
+        # (and fetched) on the same list session, with no reconnect.
         if name != "data":
             return
-        self.fetchable = [decrypt_list_entry(b64decode(boxed),
-                                             self.symkey, self.tmppub)
-                          for boxed in data.split()]
-
-        d = self.source.deactivate()
-        d.addCallback(self.fetch)
-        d.addErrback(log.err)
-        def _start_polling_again(_):
-            if not self.running:
+        entries = []
+        for word in data.split():
+            if word.startswith("cursor:"):
+                # this covers everything up to the last entry of the event,
+                # so we'll adopt it once that entry has been handled
+                cursor = word[len("cursor:"):]
+                entries[-1] = entries[-1][:3] + (cursor,)
+                continue
+            if word.startswith("msgC:"):
+                delete_t, msgC = decrypt_inline_entry(
+                    b64decode(word[len("msgC:"):]), self.symkey, self.tmppub)
+                entries.append((None, delete_t, msgC, None))
+                continue
+            entries.append(decrypt_list_entry(b64decode(word), self.symkey,
+                                              self.tmppub) + (None,))
+        self.fetchable.extend(entries)
+        if self.fetching:
+            # the running fetch loop will get to them, but it can start
+            # fetching them now
+            self.start_fetches()
+            return
+        self.fetching = d = self.fetch(None)
+        def _done(res):
+            self.fetching = None
+            return res
+        d.addBoth(_done)
+        def _failed(f):
+            # Something didn't get handled. Reconnect, which starts a new
+            # list session: our cursor only covers what we've handled, so
+            # everything else will be listed again.
+            log.err(f)
+            if not self.running or not self.source.active:
                 return
-            return self.source.activate()
-        d.addCallback(_start_polling_again)
+            d1 = self.source.deactivate()
+            d1.addCallback(lambda _: self.running and self.source.activate())
+            return d1
+        d.addErrback(_failed)
 
     def fetch(self, _):
-        if not self.running: return
-        if not self.fetchable:
-            return
-        fetch_t, delete_t, length = self.fetchable.pop(0)
-        url = self.baseurl + "fetch?t=%s" % urlsafe_b64encode(fetch_t)
-        d = client.getPage(url, method="GET")
-        def _fetched(page):
-            if not self.running: return
-            try:
-                msgC = decrypt_fetch_response(self.symkey, fetch_t, page)
-                self.got_msgC(msgC)
-            except ReplayError as e:
-                # catch this to avoid an infinite re-fetch loop. TODO: catch
-                # other decrypt errors too. Better yet, always delete the
-                # message, in spite of any sort of error during these two
-                # functions.
-                log.err(e)
-        d.addCallback(_fetched)
-        def _delete(_):
-            if not self.running: return
-            url = self.baseurl + "delete?t=%s" % urlsafe_b64encode(delete_t)
-            return client.getPage(url, method="POST")
-        d.addCallback(_delete)
+        # Keep up to self.window batch fetches in flight (each of which also
+        # deletes messages we've already handled), and hand their messages
+        # to got_msgC as they arrive. Responses can arrive out of order, but
+        # got_msgC must see messages in the order they were listed (the
+        # channel rejects seqnums older than one it has already seen), so a
+        # batch that arrives early waits for the ones before it.
+        if not self.running: return defer.succeed(None)
+        self.start_fetches()
+        if not self.pipeline:
+            d = self.send_acks()
+            def _more(_):
+                # handle_SSE only starts fetches while we run, so anything
+                # announced while the acks were in flight is ours to handle
+                if self.pipeline or self.fetchable:
+                    return self.fetch(None)
+            d.addCallback(_more)
+            return d
+        generation, batch, d = self.pipeline.popleft()
+        if generation == self.generation:
+            d.addCallback(self.handle_batch, batch)
+        else:
+            # fetched under a list session that has since been replaced,
+            # whose tokens the server forgot. They'll be listed again.
+            d.addCallbacks(lambda _: None, lambda f: None)
+        def _failed(f):
+            # abandon the rest: their messages will be listed again. But
+            # delete whatever we did handle before reporting the problem.
+            while self.pipeline:
+                self.pipeline.popleft()[2].addErrback(lambda _: None)
+            self.fetchable.clear()
+            d1 = self.send_acks()
+            d1.addBoth(lambda _: f)
+            return d1
+        d.addErrback(_failed)
         def _fetch_more(_):
             if not self.running: return
             return fireEventually().addCallback(self.fetch)
         d.addCallback(_fetch_more)
         return d
+
+    def start_fetches(self):
+        while self.fetchable and len(self.pipeline) < self.window:
+            # spread what's left over the window, so a modest backlog still
+            # gets fetched in parallel
+            slots = self.window - len(self.pipeline)
+            size = min(-(-len(self.fetchable) // slots), FETCH_BATCH_SIZE)
+            batch = [self.fetchable.popleft() for i in range(size)]
+            self.pipeline.append((self.generation, batch,
+                                  self.start_fetch(batch)))
+
+    def start_fetch(self, batch):
+        fetch_tokens = [entry[0] for entry in batch if entry[0]]
+        if not fetch_tokens:
+            # they all came inline
+            return defer.succeed([])
+        acks, self.acks = self.acks, []
+        url = self.baseurl + "fetch-batch?acks=%d" % len(acks)
+        if self.autodelete:
+            url += "&autodelete=1"
+        started = time.time()
+        if not self.requests_in_flight:
+            self.busy_since = started
+        self.requests_in_flight += 1
+        d = self.http.getPage(url, method="POST",
+                              postdata="".join(acks + fetch_tokens))
+        def _finished(res):
+            self.requests_in_flight -= 1
+            if not self.requests_in_flight:
+                self.stats["busy_time"] += time.time() - self.busy_since
+            return res
+        d.addBoth(_finished)
+        def _fetched(page):
+            self.fetch_finished(time.time() - started, len(fetch_tokens),
+                                len(page))
+            self.acks_confirmed(acks)
+            responses = split_netstrings(page)
+            if len(responses) != len(fetch_tokens):
+                raise ValueError("expected %d fetch responses, got %d"
+                                 % (len(fetch_tokens), len(responses)))
+            return responses
+        def _not_fetched(f):
+            # those acks might not have been seen, so send them again
+            self.acks[:0] = acks
+            return f
+        d.addCallbacks(_fetched, _not_fetched)
+        return d
+
+    def fetch_finished(self, latency, messages, size):
+        # Grow the window while fetches come back about as fast as the
+        # quickest one we've seen, and halve it when they start taking much
+        # longer (which means we're queueing at the server, or in the
+        # network, rather than filling an idle pipe).
+        if self.base_latency is None or latency < self.base_latency:
+            self.base_latency = latency
+        if latency <= 2*self.base_latency:
+            self.window = min(self.window+1, MAX_FETCH_WINDOW)
+        else:
+            self.window = max(1, self.window//2)
+        self.stats["messages"] += messages
+        self.stats["batches"] += 1
+        self.stats["bytes"] += size
+
+    def handle_batch(self, responses, batch):
+        if self.got_msgCs:
+            return self.handle_batch_at_once(responses, batch)
+        responses = iter(responses)
+        d = defer.succeed(None)
+        for (fetch_t, delete_t, x, cursor) in batch:
+            if fetch_t:
+                d.addCallback(self.handle_fetch_response, fetch_t,
+                              responses.next())
+            else:
+                d.addCallback(lambda _, msgC=x: self.handle_msgC(msgC))
+            if not (fetch_t and self.autodelete):
+                d.addCallback(lambda _, delete_t=delete_t: self.ack(delete_t))
+            if cursor:
+                d.addCallback(self.set_cursor, cursor)
+        return d
+
+    def handle_batch_at_once(self, responses, batch):
+        # like handle_batch, but with one call to got_msgCs
+        if not self.running: return
+        responses = iter(responses)
+        handled = [] # (fetch_t, delete_t, msgC or None, cursor)
+        error = None
+        for (fetch_t, delete_t, x, cursor) in batch:
+            msgC = x
+            if fetch_t:
+                # empty responses are for messages that were deleted already
+                resp = responses.next()
+                try:
+                    msgC = resp and decrypt_fetch_response(self.symkey,
+                                                           fetch_t, resp)
+                except Exception:
+                    # deliver the ones before it, then complain
+                    error = failure.Failure()
+                    break
+            handled.append((fetch_t, delete_t, msgC, cursor))
+        msgCs = [entry[2] for entry in handled if entry[2]]
+        d = defer.succeed([])
+        if msgCs:
+            d = defer.maybeDeferred(self.got_msgCs, msgCs)
+        def _handled(results):
+            results = iter(results)
+            for (fetch_t, delete_t, msgC, cursor) in handled:
+                if msgC:
+                    res = results.next()
+                    if isinstance(res, failure.Failure):
+                        # see handle_msgC about replays
+                        if not res.check(ReplayError):
+                            return res
+                        log.err(res)
+                if not (fetch_t and self.autodelete):
+                    self.ack(delete_t)
+                if cursor:
+                    self.set_cursor(None, cursor)
+            return error
+        d.addCallback(_handled)
+        return d
+
+    def ack(self, delete_t):
+        self.acks.append(delete_t)
+        self.ack_serial += 1
+        self.unconfirmed[delete_t] = self.ack_serial
+
+    def set_cursor(self, _, cursor):
+        self.pending_cursors.append((self.generation, self.ack_serial,
+                                     cursor))
+        self.adopt_cursors()
+
+    def acks_confirmed(self, acks):
+        for delete_t in acks:
+            self.unconfirmed.pop(delete_t, None)
+        self.adopt_cursors()
+
+    def adopt_cursors(self):
+        oldest = min(self.unconfirmed.values()) if self.unconfirmed else None
+        while self.pending_cursors:
+            (generation, serial, cursor) = self.pending_cursors[0]
+            if oldest is not None and serial >= oldest:
+                break # still waiting for a delete
+            self.pending_cursors.popleft()
+            if generation == self.generation:
+                self.cursor = cursor
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["window"] = self.window
+        stats["in_flight"] = self.requests_in_flight
+        stats["queued"] = len(self.fetchable)
+        # while at least one fetch was outstanding
+        stats["messages_per_second"] = 0.0
+        if stats["busy_time"]:
+            stats["messages_per_second"] = (stats["messages"]
+                                            / stats["busy_time"])
+        return stats
+
+    def send_acks(self):
+        # nothing left to fetch (or something went wrong), so delete the
+        # messages we've handled with a request of their own
+        if not self.running or not self.acks:
+            return defer.succeed(None)
+        # a fetch that starts meanwhile must not send these again
+        acks, self.acks = self.acks, []
+        d = self.http.getPage(self.baseurl + "delete-batch", method="POST",
+                              postdata="".join(acks))
+        def _deleted(_):
+            self.acks_confirmed(acks)
+        def _not_deleted(f):
+            self.acks[:0] = acks
+            return f
+        d.addCallbacks(_deleted, _not_deleted)
+        return d
+
+    def handle_fetch_response(self, _, fetch_t, resp):
+        if not self.running: return
+        if not resp:
+            # the server didn't know the fetch token: the message was
+            # deleted already
+            return
+        msgC = decrypt_fetch_response(self.symkey, fetch_t, resp)
+        return self.handle_msgC(msgC)
+
+    def handle_msgC(self, msgC):
+        if not self.running: return
+        d = defer.maybeDeferred(self.got_msgC, msgC)
+        def _replay(f):
+            # catch this to avoid an infinite re-fetch loop. TODO: catch
+            # other decrypt errors too. Better yet, always delete the
+            # message, in spite of any sort of error during these two
+            # functions.
+            f.trap(ReplayError)
+            log.err(f)
+        d.addErrback(_replay)
+        return d
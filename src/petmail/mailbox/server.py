@@ -3,22 +3,77 @@
 # petmail.mailbox.delivery.http . I define a ServerResource which accepts the
 # POSTs and delivers their msgA to a Mailbox.
 
-import os, struct, time, base64
+import os, struct, time, base64, json
+from collections import deque
 from twisted.application import service, internet
+from twisted.internet import defer
+from twisted.python import log
 from twisted.web import server, resource, http
 from nacl.public import PrivateKey, PublicKey, Box
 from nacl.secret import SecretBox
-from .. import rrid
+from nacl.exceptions import CryptoError
+from .. import rrid, metrics
+from ..executor import CryptoExecutor
 from ..eventual import eventually
-from ..util import remove_prefix, split_into, hex_or_none, unhex_or_none
-from ..netstring import split_netstrings_and_trailer
-from ..web import EventsProtocol
+from ..util import BadPrefixError, hex_or_none
+from ..netstring import netstring, split_netstrings_and_trailer
+from ..web import EventsProtocol, read_body
+from .expiry import ExpirySweeper
+from .ingest import GroupCommitter, IngestWorkerPool
+from .quota import QuotaTracker, QuotaExceeded
+from .replay import ReplayCache, ReplayCacheFull
+from .store import SQLiteMessageStore
+from .tokens import TokenTable
+from .transports import TransportRegistry
+
+# senders can't get a msgA bigger than this past the web server
+DEFAULT_MAX_MSGA_SIZE = 16*1024*1024
+# list responses carry messages this small (or smaller) themselves, for
+# clients that ask
+DEFAULT_INLINE_MSGC_SIZE = 1024
+# batch fetch/delete requests carry at most this many 32-byte tokens (of
+# each kind: a fetch can carry as many delete tokens again)
+MAX_BATCH_TOKENS = 1000
+# senders who hit a full transport are told to wait this long (in seconds)
+DEFAULT_QUOTA_RETRY_AFTER = 300
+# queued messages that nobody retrieves are deleted after this many seconds
+DEFAULT_MESSAGE_RETENTION = 30*24*60*60
+
+MSGA = metrics.counter("petmail_mailbox_msgA_total",
+                       "msgAs received, by what the sender was told",
+                       ["outcome"])
+MSGA_ACCEPTED = MSGA.labels("accepted")
+MSGA_REJECTED = MSGA.labels("rejected")
+MSGA_FULL = MSGA.labels("full")
+MSGA_SECONDS = metrics.histogram("petmail_mailbox_handle_msgA_seconds",
+                                 "time to accept or reject a msgA")
+STAGE_SECONDS = metrics.histogram("petmail_mailbox_handle_msgB_seconds",
+                                  "time spent in each stage of queueing a"
+                                  " message", ["stage"])
+STAGE_DECRYPT = STAGE_SECONDS.labels("decrypt") # msgA, in the executor
+STAGE_PARSE = STAGE_SECONDS.labels("parse") # msgB, including the TTID
+STAGE_LOOKUP = STAGE_SECONDS.labels("lookup")
+STAGE_INSERT = STAGE_SECONDS.labels("insert") # until committed
+RETRIEVALS = metrics.counter("petmail_mailbox_retrieval_requests_total",
+                             "retrieval requests, by resource",
+                             ["resource"])
+RETRIEVAL_SECONDS = metrics.histogram(
+    "petmail_mailbox_retrieval_seconds",
+    "time to answer retrieval requests, by resource (event-stream listings"
+    " stay open, and are only counted)", ["resource"])
 
 def parseMsgA(msgA):
-    key_and_boxed = remove_prefix(msgA, "a0:")
-    pubkey1_s, boxed = split_into(key_and_boxed, [32], True)
+    # msgA can be large, so slice the boxed part straight out of it rather
+    # than removing the prefix first
+    if not msgA.startswith("a0:"):
+        raise BadPrefixError("did not see expected 'a0:' prefix")
+    pubkey1_s, boxed = msgA[3:3+32], msgA[3+32:]
     return pubkey1_s, boxed
 
+def decryptMsgA(transport_privkey, msgA):
+    pubkey1_s, boxed = parseMsgA(msgA)
+    return Box(transport_privkey, PublicKey(pubkey1_s)).decrypt(boxed)
+
 def parseMsgB(msgB):
     (MSTT,),msgC = split_netstrings_and_trailer(msgB)
     return MSTT, msgC
@@ -42,14 +97,35 @@ class ServerResource(resource.Resource):
         self.message_handler = message_handler
 
     def render_POST(self, request):
-        msgA = request.content.read()
+        msgA = read_body(request)
         # the sender is allowed to observe the following failures:
         #  unrecognized version prefix ("a0:")
         #  message not boxed to our mailbox pubkey
-        # but no others. self.messageReceived() will raise any observable
-        # errors, and defer the rest of processing until later
-        self.message_handler(msgA)
-        return "ok"
+        #  recipient's transport is full (503, try again after Retry-After)
+        # but no others. self.message_handler() will fail its Deferred for
+        # any observable errors, and defer the rest of processing until later
+        d = defer.maybeDeferred(self.message_handler, msgA)
+        disconnected = []
+        request.notifyFinish().addErrback(disconnected.append)
+        def _done(_):
+            if not disconnected:
+                request.write("ok")
+                request.finish()
+        def _failed(f):
+            if disconnected:
+                return
+            if f.check(QuotaExceeded):
+                request.setResponseCode(http.SERVICE_UNAVAILABLE,
+                                        "mailbox full")
+                request.setHeader("Retry-After", "%d" % f.value.retry_after)
+                request.write("mailbox full")
+                request.finish()
+            else:
+                request.setResponseCode(http.BAD_REQUEST, "bad msgA")
+                request.write("bad msgA")
+                request.finish()
+        d.addCallbacks(_done, _failed)
+        return server.NOT_DONE_YET
 
 
 class BaseServer(service.MultiService):
@@ -75,31 +151,94 @@ class HTTPMailboxServer(BaseServer):
     by remote agents.
     """
 
-    def __init__(self, db, web, baseurl, desc):
+    def __init__(self, db, web, baseurl, desc, store=None, executor=None):
         BaseServer.__init__(self)
         self.db = db
+        self.executor = executor or CryptoExecutor()
+        # queued messages live in the MessageStore: by default that's a
+        # table in our main database
+        self.store = store or SQLiteMessageStore(db)
+        self.store.setServiceParent(self)
         assert baseurl.endswith("/")
         self.baseurl = baseurl
+        # nodes that run ingest workers on a separate port (usually behind
+        # a proxy) can tell senders to use that instead of our own port
+        self.ingest_url = desc.get("ingest_url")
         self.transport_privkey = PrivateKey(desc["transport_privkey"].decode("hex"))
         self.TT_privkey = desc["TT_private_key"].decode("hex")
         self.TT_pubkey = desc["TT_public_key"].decode("hex")
         self.retrieval_privkey = PrivateKey(desc["retrieval_privkey"].decode("hex"))
+        self.transports = TransportRegistry(
+            db, max_entries=desc.get("transport_cache_size", 10000))
+        # by default every queued message is committed by itself. Hosting
+        # nodes can trade a few milliseconds of latency (and the risk of
+        # losing that window on a crash) for much higher ingest throughput.
+        self.committer = GroupCommitter(
+            self.store,
+            max_messages=desc.get("group_commit_max_messages", 1),
+            max_delay_ms=desc.get("group_commit_max_delay_ms", 0))
+        # transports that are full make senders wait. The limits are off
+        # unless configured, and each transport can override them.
+        self.quota = QuotaTracker(
+            self.store, self.transports,
+            max_messages=desc.get("quota_max_messages"),
+            max_bytes=desc.get("quota_max_bytes"),
+            retry_after=desc.get("quota_retry_after",
+                                 DEFAULT_QUOTA_RETRY_AFTER))
+        # and messages that nobody comes for are eventually deleted. Each
+        # transport can override the retention period too.
+        self.sweeper = ExpirySweeper(
+            self.store, db, self.transports,
+            desc.get("message_retention", DEFAULT_MESSAGE_RETENTION),
+            interval=desc.get("expiry_sweep_interval", 3600))
+        self.sweeper.setServiceParent(self)
 
         # this is how we get messages from senders
         web.get_root().putChild("mailbox", ServerResource(self.handle_msgA))
+        # and this keeps oversized or mis-prefixed msgAs from being read
+        self.max_msgA_size = desc.get("max_msgA_size", DEFAULT_MAX_MSGA_SIZE)
+        web.limit_body("/mailbox", self.max_msgA_size, "a0:")
+
+        # list requests are remembered until they expire, optionally in the
+        # database too, so a restart doesn't let them be replayed
+        replay_cache = ReplayCache(
+            RetrievalListResource.CLOCK_WINDOW,
+            max_entries=desc.get("replay_cache_size", 100000),
+            db=db if desc.get("persist_replay_cache") else None)
+        # the fetch/delete tokens from each list request only live in memory
+        self.tokens = TokenTable(
+            lifetime=desc.get("retrieval_token_lifetime", 3600))
+        self.store.subscribe(self.tokens.message_changed)
 
         # add a second resource for agents to retrieve messages
         r = resource.Resource()
         # TODO: retrieval should use a different key than delivery
-        self.listres = RetrievalListResource(self.db, self.retrieval_privkey)
+        self.listres = RetrievalListResource(self.transports, self.store,
+                                            self.tokens,
+                                            self.retrieval_privkey,
+                                            replay_cache,
+                                            desc.get("inline_msgC_size",
+                                                     DEFAULT_INLINE_MSGC_SIZE))
         r.putChild("list", self.listres)
         ts = internet.TimerService(self.listres.CLOCK_WINDOW*3,
                                    self.prune_old_requests)
         ts.setServiceParent(self)
-        r.putChild("fetch", RetrievalFetchResource(self.db))
-        r.putChild("delete", RetrievalDeleteResource(self.db))
+        r.putChild("fetch", RetrievalFetchResource(self.transports,
+                                                self.store, self.tokens))
+        r.putChild("delete", RetrievalDeleteResource(self.store,
+                                                     self.tokens))
+        r.putChild("fetch-batch", RetrievalBatchFetchResource(
+            self.transports, self.store, self.tokens))
+        r.putChild("delete-batch", RetrievalBatchDeleteResource(self.store,
+                                                                self.tokens))
+        web.limit_body("/retrieval/fetch-batch", 2*32*MAX_BATCH_TOKENS)
+        web.limit_body("/retrieval/delete-batch", 32*MAX_BATCH_TOKENS)
         web.get_root().putChild("retrieval", r)
 
+    def stopService(self):
+        self.committer.flush()
+        return BaseServer.stopService(self)
+
     def allocate_transport(self, remote=True):
         # return a MailboxRecord, which includes retrieval information, and
         # data which can be turned into a TransportRecord for senders
@@ -117,6 +256,7 @@ class HTTPMailboxServer(BaseServer):
                               hex_or_none(RT), hex_or_none(symkey)),
                              "mailbox_server_transports")
         self.db.commit()
+        self.transports.add(tid, TTID, TT0, RT, symkey)
         return tid
 
     def get_local_transport(self):
@@ -126,12 +266,40 @@ class HTTPMailboxServer(BaseServer):
             return self.allocate_transport(False)
         return row["id"]
 
+    def set_transport_quota(self, tid, max_messages=None, max_bytes=None):
+        # None means the server-wide default
+        self.db.update("UPDATE mailbox_server_transports"
+                       " SET max_messages=?, max_bytes=? WHERE id=?",
+                       (max_messages, max_bytes, tid),
+                       "mailbox_server_transports", tid)
+        self.db.commit()
+        # the registry hears about the update eventually, but the new limits
+        # should apply right away
+        self.transports.remove(tid)
+        self.quota.update(tid)
+
+    def set_transport_retention(self, tid, retention=None):
+        # in seconds. None means the server-wide default.
+        self.db.update("UPDATE mailbox_server_transports"
+                       " SET retention=? WHERE id=?", (retention, tid),
+                       "mailbox_server_transports", tid)
+        self.db.commit()
+        self.transports.remove(tid)
+
+    def get_quota_usage(self):
+        # for operators: how much each remote transport has queued
+        c = self.db.execute("SELECT id FROM mailbox_server_transports"
+                            " WHERE symkey IS NOT NULL ORDER BY id")
+        usage = []
+        for row in c.fetchall():
+            u = self.quota.get_usage(row["id"])
+            u["tid"] = row["id"]
+            usage.append(u)
+        return usage
+
     def get_tid_data(self, tid):
-        c = self.db.execute("SELECT * FROM mailbox_server_transports"
-                             " WHERE id=?", (tid,))
-        row = c.fetchone()
-        return (row["TTID"].decode("hex"), row["TT0"].decode("hex"),
-                unhex_or_none(row["RT"]), unhex_or_none(row["symkey"]))
+        t = self.transports.get(tid)
+        return (t.TTID, t.TT0, t.RT, t.symkey)
 
     def get_mailbox_record(self, tid):
         # The mailbox record goes to the recipient who owns this transport.
@@ -152,7 +320,7 @@ class HTTPMailboxServer(BaseServer):
                          "RT": RT.encode("hex")}
         tpubkey = self.transport_privkey.public_key.encode()
         transport_generic = {"type": "http",
-                             "url": self.baseurl+"mailbox",
+                             "url": self.ingest_url or self.baseurl+"mailbox",
                              "transport_pubkey": tpubkey.encode("hex")
                              }
         transport_sender = {"TT0": TT0.encode("hex")}
@@ -163,37 +331,102 @@ class HTTPMailboxServer(BaseServer):
 
     def prune_old_requests(self):
         self.listres.prune_old_requests()
+        self.tokens.prune()
 
     def register_local_transport_handler(self, handler):
         self.local_transport_handler = handler
 
     def handle_msgA(self, msgA):
-        pubkey1_s, boxed = parseMsgA(msgA)
-        msgB = Box(self.transport_privkey, PublicKey(pubkey1_s)).decrypt(boxed)
+        # returns a Deferred that fails if the sender gets to hear about it
+        started = MSGA_SECONDS.start()
+        d = STAGE_DECRYPT.track(self.executor.run(decryptMsgA,
+                                                  self.transport_privkey,
+                                                  msgA))
+        d.addCallback(self.admit_msgB)
+        def _accepted(res):
+            MSGA_SECONDS.stop(started)
+            MSGA_ACCEPTED.inc()
+            return res
+        def _rejected(f):
+            MSGA_SECONDS.stop(started)
+            (MSGA_FULL if f.check(QuotaExceeded) else MSGA_REJECTED).inc()
+            return f
+        d.addCallbacks(_accepted, _rejected)
+        return d
+
+    def admit_msgB(self, msgB):
+        # after decryption, the only thing the sender gets to hear about is
+        # a full transport, so they can back off and try again later
+        try:
+            TTID, msgC = self.open_msgB(msgB)
+        except Exception:
+            # not the sender's problem: let handle_msgB() complain
+            eventually(self.handle_msgB, msgB)
+            return
+        t = self.lookup_TTID(TTID)
+        if t and t.symkey is not None:
+            self.quota.check(t.tid)
         # this ends the sender-observable errors
-        eventually(self.handle_msgB, msgB)
+        eventually(self.dispatch, TTID, t, msgC)
 
-    def handle_msgB(self, msgB):
+    def open_msgB(self, msgB):
+        started = STAGE_PARSE.start()
         MSTT, msgC = parseMsgB(msgB)
         TTID = rrid.decrypt(self.TT_privkey, MSTT)
-        # look up registered transports, queue message or deliver locally
-        c = self.db.execute("SELECT * FROM mailbox_server_transports"
-                            " WHERE TTID=?", (TTID.encode("hex"),))
-        row = c.fetchone()
-        if row:
-            if row["symkey"] is None:
-                return self.local_transport_handler(msgC)
-            else:
-                return self.queue_msgC(row["id"], msgC)
+        STAGE_PARSE.stop(started)
+        return TTID, msgC
+
+    def lookup_TTID(self, TTID):
+        started = STAGE_LOOKUP.start()
+        t = self.transports.lookup_TTID(TTID)
+        STAGE_LOOKUP.stop(started)
+        return t
+
+    def handle_msgB(self, msgB):
+        TTID, msgC = self.open_msgB(msgB)
+        return self.dispatch(TTID, self.lookup_TTID(TTID), msgC)
+
+    def dispatch(self, TTID, t, msgC):
+        # queue message or deliver locally
+        if t:
+            return self.deliver(t, msgC)
         # unknown
         self.signal_unrecognized_TTID(TTID)
 
+    def deliver(self, t, msgC):
+        if t.symkey is None:
+            return self.local_transport_handler(msgC)
+        else:
+            return self.queue_msgC(t.tid, msgC)
+
+    def deliver_from_worker(self, tid, msgC):
+        # an ingest worker has done handle_msgA() and the TTID lookup for
+        # us. Its cache might be stale, so check the tid again.
+        t = self.transports.get(tid)
+        if not t:
+            log.msg("ingest worker delivered to unknown tid %d" % tid)
+            return
+        return self.deliver(t, msgC)
+
+    def enable_ingest_workers(self, dbfile, listen, num_workers):
+        self.ingest_workers = IngestWorkerPool(dbfile, listen, num_workers,
+                                               self.deliver_from_worker,
+                                               self.signal_unrecognized_TTID,
+                                               self.quota.full)
+        self.ingest_workers.setServiceParent(self)
+        # workers turn away senders of full transports themselves
+        self.quota.subscribe(self.ingest_workers.set_full)
+
     def queue_msgC(self, tid, msgC):
-        self.db.insert("INSERT INTO mailbox_server_messages"
-                       " (tid, length, msgC) VALUES (?,?,?)",
-                       (tid, len(msgC), msgC.encode("hex")),
-                       "mailbox_server_messages")
-        self.db.commit()
+        # returns a Deferred that fires with the new message id once the
+        # message has been committed to disk
+        self.quota.charge(tid, len(msgC))
+        d = STAGE_INSERT.track(self.committer.add(tid, msgC))
+        def _failed(f):
+            self.quota.refund(tid, len(msgC))
+            return f
+        d.addErrback(_failed)
+        return d
 
     def signal_unrecognized_TTID(self, TTID):
         # this can be overridden by unit tests
@@ -206,40 +439,150 @@ def decrypt_list_request_1(req):
 def decrypt_list_request_2(tmppub, boxed0, retrieval_privkey):
     nonce = "\x00"*24
     m = Box(retrieval_privkey, PublicKey(tmppub)).decrypt(boxed0, nonce)
-    timestamp, RT = struct.unpack(">Q8s", m)
-    return timestamp, RT
+    timestamp, RT = struct.unpack(">Q8s", m[:16])
+    # newer clients follow that with a JSON dictionary of options
+    options = json.loads(m[16:]) if len(m) > 16 else {}
+    return timestamp, RT, options
 
 assert struct.calcsize(">Q") == 8
 
 def create_list_entry(symkey, tmppub, length,
-                      nonce=None, fetch_token=None, delete_token=None):
+                      nonce=None, fetch_token=None, delete_token=None,
+                      sbox=None):
+    # callers making many entries for the same symkey can pass in a
+    # SecretBox, instead of having us build one for each entry
     assert len(tmppub) == 32
     fetch_token = fetch_token or os.urandom(32)
     delete_token = delete_token or os.urandom(32)
     msg = "list:" + struct.pack(">32s32s32sQ",
                                 tmppub, fetch_token, delete_token, length)
     nonce = nonce or os.urandom(24)
-    sbox = SecretBox(symkey)
+    sbox = sbox or SecretBox(symkey)
     return sbox.encrypt(msg, nonce), fetch_token, delete_token
 
+def create_list_cursor(sbox, msgid, nonce=None):
+    # the cursor tells a client's next list request where this one left
+    # off. It is opaque to the client, and encrypted so that eavesdroppers
+    # can't use it to count messages.
+    nonce = nonce or os.urandom(24)
+    boxed = sbox.encrypt("cursor:" + struct.pack(">Q", msgid), nonce)
+    return base64.b64encode(boxed)
+
+def parse_list_cursor(sbox, cursor):
+    # returns the msgid, or 0 (meaning "list everything") if the cursor is
+    # missing or not one of ours
+    try:
+        m = sbox.decrypt(base64.b64decode(cursor))
+    except (CryptoError, TypeError):
+        return 0
+    if not m.startswith("cursor:") or len(m) != 7+8:
+        return 0
+    return struct.unpack(">Q", m[7:])[0]
+
 def encrypt_fetch_response(symkey, fetch_token, msgC, nonce=None):
     assert len(fetch_token) == 32
     msg = "fetch:" + fetch_token + msgC
     nonce = nonce or os.urandom(24)
     return SecretBox(symkey).encrypt(msg, nonce)
 
+def create_inline_entry(sbox, tmppub, msgC, nonce=None, delete_token=None):
+    # like a list entry and a fetch response in one: small messages are
+    # delivered in the list response itself, and only need to be deleted
+    assert len(tmppub) == 32
+    delete_token = delete_token or os.urandom(32)
+    msg = "inline:" + tmppub + delete_token + msgC
+    nonce = nonce or os.urandom(24)
+    return sbox.encrypt(msg, nonce), delete_token
+
+class MessageListing:
+    """I announce one tid's queued messages in response to one list request.
+
+    I am a pull producer for the request: the backlog is written a page at
+    a time, only as fast as the connection takes it, so a recipient with a
+    huge backlog costs neither a huge response buffer nor a long wait for
+    the first entry, and pages that nobody reads are never built. Once the
+    backlog is written, an EventSource listing stays open and announces new
+    messages as they arrive, while a polling one finishes.
+    """
+
+    def __init__(self, listres, request, tid, sbox, tmppub, after,
+                 page_size, send_cursor, subscribe, one_page=False,
+                 inline_size=0):
+        self.listres = listres
+        self.request = request
+        self.events = EventsProtocol(request)
+        self.tid = tid
+        self.sbox = sbox
+        self.tmppub = tmppub
+        self.after = after # the last msgid we've announced
+        self.page_size = page_size
+        self.send_cursor = send_cursor
+        self.subscribe = subscribe
+        self.one_page = one_page
+        self.inline_size = inline_size
+        self.producing = False
+
+    def start(self):
+        self.producing = True
+        self.request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if not self.producing:
+            return
+        messages = self.listres.store.list_messages(self.tid, self.after,
+                                                    self.page_size)
+        if messages:
+            self.announce(messages)
+        if len(messages) < self.page_size or self.one_page:
+            self.producing = False
+            self.request.unregisterProducer()
+            if not self.subscribe:
+                self.request.finish()
+
+    def stopProducing(self):
+        # the connection was lost
+        self.producing = False
+
+    def announce(self, messages):
+        entries = [(msgid, self.listres.prepare_entry(
+                    self.sbox, self.tmppub, self.tid, msgid, length,
+                    inline=0 < length <= self.inline_size))
+                   for (msgid, length) in messages]
+        self.after = messages[-1][0]
+        self.events.sendEvent(self.listres.format_event(self.sbox, entries,
+                                                        self.send_cursor))
+
+    def new_message(self, msgid, length):
+        # while the backlog is still being written, it will pick this up.
+        # Anything we've already announced (perhaps because the backlog got
+        # there before the notice did) is ignored.
+        if self.producing or msgid <= self.after:
+            return
+        self.announce([(msgid, length)])
+
+    def stop(self):
+        if self.producing:
+            self.producing = False
+            self.request.unregisterProducer()
+        self.events.stop()
+
 class RetrievalListResource(resource.Resource):
     CLOCK_WINDOW = 5*60 # the window is "now" plus/minus this value
-    MAX_MESSAGES_PER_ENTRY = 10
+    MAX_MESSAGES_PER_ENTRY = 10 # default page size
+    MAX_PAGE_SIZE = 1000
     ENABLE_EVENTSOURCE = True
 
-    def __init__(self, db, retrieval_privkey):
+    def __init__(self, transports, store, tokens, retrieval_privkey,
+                 replay_cache=None, inline_size=DEFAULT_INLINE_MSGC_SIZE):
         resource.Resource.__init__(self)
-        self.db = db
+        self.transports = transports
+        self.store = store
+        self.tokens = tokens
         self.retrieval_privkey = retrieval_privkey
-        self.old_requests = {} # maps tmppub to timestamp
-        self.db.subscribe("mailbox_server_messages", self.new_message)
-        # tid -> (EventsProtocol,symkey,tmppub) . only one per tid.
+        self.old_requests = replay_cache or ReplayCache(self.CLOCK_WINDOW)
+        self.inline_size = inline_size
+        self.store.subscribe(self.new_message)
+        # tid -> MessageListing, for EventSource requests. only one per tid.
         self.subscribers = {}
 
     def new_message(self, notice):
@@ -248,30 +591,35 @@ class RetrievalListResource(resource.Resource):
         v = notice.new_value
         if v["tid"] not in self.subscribers:
             return
-        (p, symkey, tmppub) = self.subscribers[v["tid"]]
-        entry = self.prepare_entry(symkey, tmppub, v)
-        p.sendEvent(base64.b64encode(entry))
+        self.subscribers[v["tid"]].new_message(v["id"], v["length"])
 
     def prune_old_requests(self, now=None):
-        old = (now or time.time()) - self.CLOCK_WINDOW
-        old_tmppubs = []
-        for tmppub, ts in self.old_requests.items():
-            if ts < old:
-                old_tmppubs.append(tmppub)
-        for tmppub in old_tmppubs:
-            del self.old_requests[tmppub]
+        self.old_requests.prune(now)
 
     def render_GET(self, request):
+        subscribe = ("text/event-stream" in (request.getHeader("accept") or "")
+                     and self.ENABLE_EVENTSOURCE)
+        track_retrieval(request, "events" if subscribe else "list",
+                        timed=not subscribe)
         msg = base64.urlsafe_b64decode(request.args["t"][0])
         tmppub, boxed0 = decrypt_list_request_1(msg)
         if tmppub in self.old_requests:
             request.setResponseCode(http.BAD_REQUEST, "Replay")
             return "Replay"
-        ts, RT = decrypt_list_request_2(tmppub, boxed0, self.retrieval_privkey)
+        ts, RT, options = decrypt_list_request_2(tmppub, boxed0,
+                                                 self.retrieval_privkey)
         now = time.time()
         if ts < now-self.CLOCK_WINDOW or ts > now+self.CLOCK_WINDOW:
             request.setResponseCode(http.BAD_REQUEST, "too much clock skew")
             return "Too much clock skew"
+        if not isinstance(options, dict):
+            request.setResponseCode(http.BAD_REQUEST, "bad options")
+            return "Bad options"
+        page_size = options.get("page_size", self.MAX_MESSAGES_PER_ENTRY)
+        if (not isinstance(page_size, (int, long))
+            or isinstance(page_size, bool) or page_size < 1):
+            request.setResponseCode(http.BAD_REQUEST, "bad page_size")
+            return "Bad page_size"
         try:
             tid, symkey = self.check_RT(RT)
         except KeyError:
@@ -279,103 +627,234 @@ class RetrievalListResource(resource.Resource):
             return "no such RT"
         # If check_RT() didn't throw KeyError, this is a new request, for a
         # known RT. It's worth preventing a replay.
-        self.old_requests[tmppub] = ts
-
-        all_messages = self.prepare_message_list(tid, symkey, tmppub)
-        groups = [all_messages[i:i+self.MAX_MESSAGES_PER_ENTRY]
-                  for i in range(0, len(all_messages),
-                                 self.MAX_MESSAGES_PER_ENTRY)]
-        entries = [" ".join([base64.b64encode(e) for e in group])
-                   for group in groups]
-        if ("text/event-stream" in (request.getHeader("accept") or "")
-            and self.ENABLE_EVENTSOURCE):
+        try:
+            self.old_requests.add(tmppub, ts, now)
+        except ReplayCacheFull:
+            request.setResponseCode(http.SERVICE_UNAVAILABLE,
+                                    "too many requests")
+            return "Too many requests, try again later"
+
+        sbox = SecretBox(symkey)
+        # clients that send a "cursor" option (even an empty one) get a new
+        # cursor with each event, and will only hear about messages after it
+        # next time
+        send_cursor = "cursor" in options
+        after = 0
+        if options.get("cursor"):
+            after = parse_list_cursor(sbox, str(options["cursor"]))
+        page_size = min(page_size, self.MAX_PAGE_SIZE)
+        if subscribe and tid in self.subscribers:
+            # close the old EventSource when a new GET occurs (since this
+            # one will reset the tokens anyways)
+            self.subscribers[tid].stop()
+        # this starts a new session, which revokes the tokens we handed out
+        # in any earlier list response
+        self.tokens.start_session(tid)
+        # clients that ask get small messages in the list response itself
+        inline_size = 0
+        if options.get("inline"):
+            inline_size = self.inline_size
+        # a polling client that asks for a page size gets one page, and can
+        # use its cursor to ask for the next
+        listing = MessageListing(self, request, tid, sbox, tmppub, after,
+                                 page_size, send_cursor, subscribe,
+                                 one_page=("page_size" in options
+                                           and not subscribe),
+                                 inline_size=inline_size)
+        if subscribe:
             # EventSource protocol
-            if tid in self.subscribers:
-                # close the EventsProtocol when a new GET occurs (since
-                # that will reset the tokens anyways)
-                self.subscribers[tid][0].stop()
             request.setHeader("content-type", "text/event-stream")
-            p = EventsProtocol(request)
-            p.sendComment("beginning Message List event stream")
-            for e in entries:
-                p.sendEvent(e)
-            self.subscribers[tid] = (p, symkey, tmppub)
+            listing.events.sendComment("beginning Message List event stream")
+            self.subscribers[tid] = listing
             # unsubscribe when the EventsProtocol is closed
             def _done(_):
-                if tid in self.subscribers and self.subscribers[tid][0] is p:
+                if self.subscribers.get(tid) is listing:
                     del self.subscribers[tid]
             request.notifyFinish().addErrback(_done)
-            return server.NOT_DONE_YET
-        for e in entries:
-            request.write("data: %s\n\n" % e)
-        return ""
+        listing.start()
+        return server.NOT_DONE_YET
 
     def check_RT(self, RT):
-        c = self.db.execute("SELECT * FROM mailbox_server_transports"
-                            " WHERE RT=?", (RT.encode("hex"),))
-        row = c.fetchone()
-        if row:
-            return (row["id"], row["symkey"].decode("hex"))
+        t = self.transports.lookup_RT(RT)
+        if t:
+            return (t.tid, t.symkey)
         raise KeyError("no such RT")
 
-    def prepare_message_list(self, tid, symkey, tmppub):
-        entries = []
-        c = self.db.execute("SELECT id,length FROM mailbox_server_messages"
-                            " WHERE tid=?", (tid,))
-        for row in c.fetchall():
-            entry = self.prepare_entry(symkey, tmppub, row)
-            entries.append(entry)
-        self.db.commit()
-        return entries
-
-    def prepare_entry(self, symkey, tmppub, c):
-        entry, fetch_token, delete_token = create_list_entry(symkey, tmppub,
-                                                             c["length"])
-        self.db.execute("UPDATE mailbox_server_messages"
-                        " SET fetch_token=?, delete_token=?"
-                        " WHERE id=?",
-                        (fetch_token.encode("hex"),
-                         delete_token.encode("hex"),
-                         c["id"]))
-        return entry
+    def format_event(self, sbox, entries, send_cursor):
+        # 'entries' is a list of (msgid, word)
+        words = [word for (msgid, word) in entries]
+        if send_cursor:
+            words.append("cursor:" + create_list_cursor(sbox, entries[-1][0]))
+        return " ".join(words)
+
+    def prepare_entry(self, sbox, tmppub, tid, msgid, length, inline=False):
+        # returns the word that announces this message in a list event
+        message = inline and self.store.get_message(msgid)
+        if message:
+            entry, delete_token = create_inline_entry(sbox, tmppub,
+                                                      message[1])
+            self.tokens.add(tid, msgid, None, delete_token)
+            return "msgC:" + base64.b64encode(entry)
+        entry, fetch_token, delete_token = create_list_entry(None, tmppub,
+                                                             length,
+                                                             sbox=sbox)
+        self.tokens.add(tid, msgid, fetch_token, delete_token)
+        return base64.b64encode(entry)
+
+def track_retrieval(request, name, timed=True):
+    # counts the request, and times it until the response is finished
+    if not metrics.registry.enabled:
+        return
+    RETRIEVALS.labels(name).inc()
+    if timed:
+        seconds = RETRIEVAL_SECONDS.labels(name)
+        started = seconds.start()
+        request.notifyFinish().addBoth(lambda _: seconds.stop(started))
+
+def delete_messages(store, tokens, msgids):
+    # all in one commit
+    for msgid in msgids:
+        tokens.forget_message(msgid)
+        store.delete_message(msgid)
+    if msgids:
+        store.commit()
+
+def find_delete_tokens(tokens, delete_tokens):
+    # unknown delete tokens are ignored
+    msgids = [tokens.find_delete_token(dt) for dt in delete_tokens]
+    return [msgid for msgid in msgids if msgid]
+
+def wants_autodelete(request):
+    return request.args.get("autodelete", ["0"])[0] == "1"
+
+def autodelete_when_finished(request, store, tokens, msgids):
+    # In fetch-and-acknowledge mode, messages are deleted once their response
+    # has been completely written. If the connection is lost first, they
+    # stay, and will be listed again. (So they might be delivered twice, if
+    # the response got through anyway: the client has asked for at-least-once)
+    def _finished(_):
+        delete_messages(store, tokens, msgids)
+    request.notifyFinish().addCallbacks(_finished, lambda f: None)
 
 class RetrievalFetchResource(resource.Resource):
-    def __init__(self, db):
+    def __init__(self, transports, store, tokens):
         resource.Resource.__init__(self)
-        self.db = db
+        self.transports = transports
+        self.store = store
+        self.tokens = tokens
+
+    def fetch(self, fetch_token):
+        # returns (msgid, encrypted response), or (None, None) if the token
+        # is unknown
+        msgid = self.tokens.find_fetch_token(fetch_token)
+        message = msgid and self.store.get_message(msgid)
+        if not message:
+            return None, None
+        tid, msgC = message
+        symkey = self.transports.get(tid).symkey
+        self.tokens.clear_fetch_token(msgid)
+        return msgid, encrypt_fetch_response(symkey, fetch_token, msgC)
 
     def render_GET(self, request):
+        track_retrieval(request, "fetch")
         fetch_token = base64.urlsafe_b64decode(request.args["t"][0])
-        c = self.db.execute("SELECT * FROM mailbox_server_messages"
-                            " WHERE fetch_token=?",
-                            (fetch_token.encode("hex"),))
-        row = c.fetchone()
-        if row:
-            c2 = self.db.execute("SELECT symkey"
-                                 " FROM mailbox_server_transports"
-                                 " WHERE id=?", (row["tid"],))
-            symkey = c2.fetchone()["symkey"].decode("hex")
-            self.db.execute("UPDATE mailbox_server_messages"
-                            " SET fetch_token=NULL"
-                            " WHERE id=?",
-                            (row["id"],))
-            self.db.commit()
-            resp = encrypt_fetch_response(symkey, fetch_token,
-                                          row["msgC"].decode("hex"))
+        msgid, resp = self.fetch(fetch_token)
+        if resp:
+            if wants_autodelete(request):
+                autodelete_when_finished(request, self.store, self.tokens,
+                                         [msgid])
             return resp
         request.setResponseCode(http.NOT_FOUND, "unknown fetch_token")
         return ""
 
+def split_tokens(body):
+    # batch requests are a concatenation of 32-byte tokens
+    if len(body) % 32:
+        raise ValueError("body is not a whole number of tokens")
+    return [body[i:i+32] for i in range(0, len(body), 32)]
+
+class BatchFetch:
+    """I write the responses to one batch fetch request, as a netstring for
+    each fetch token, in the order they were given. Known tokens get the same
+    encrypted response that the single-message 'fetch' would return, unknown
+    ones get an empty netstring. I am a pull producer, so only one message is
+    read from the store (and held in memory) at a time.
+    """
+
+    def __init__(self, fetchres, request, fetch_tokens):
+        self.fetchres = fetchres
+        self.request = request
+        self.fetch_tokens = deque(fetch_tokens)
+        self.fetched = [] # msgids
+        self.producing = False
+
+    def start(self):
+        self.producing = True
+        self.request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if not self.producing:
+            return
+        if not self.fetch_tokens:
+            self.producing = False
+            self.request.unregisterProducer()
+            self.request.finish()
+            return
+        msgid, resp = self.fetchres.fetch(self.fetch_tokens.popleft())
+        if msgid:
+            self.fetched.append(msgid)
+        self.request.write(netstring(resp or ""))
+
+    def stopProducing(self):
+        self.producing = False
+
+class RetrievalBatchFetchResource(RetrievalFetchResource):
+    def render_POST(self, request):
+        # the body can start with the delete tokens of messages from earlier
+        # fetches (as many as the "acks=" argument says), which are deleted
+        # before anything is fetched
+        track_retrieval(request, "fetch-batch")
+        try:
+            tokens = split_tokens(read_body(request))
+            acks = int(request.args.get("acks", ["0"])[0])
+            if not 0 <= acks <= len(tokens):
+                raise ValueError("bad acks= count")
+        except ValueError:
+            request.setResponseCode(http.BAD_REQUEST, "bad fetch tokens")
+            return "bad fetch tokens"
+        delete_messages(self.store, self.tokens,
+                        find_delete_tokens(self.tokens, tokens[:acks]))
+        request.setHeader("content-type", "application/octet-stream")
+        bf = BatchFetch(self, request, tokens[acks:])
+        if wants_autodelete(request):
+            autodelete_when_finished(request, self.store, self.tokens,
+                                     bf.fetched)
+        bf.start()
+        return server.NOT_DONE_YET
+
 class RetrievalDeleteResource(resource.Resource):
-    def __init__(self, db):
+    def __init__(self, store, tokens):
         resource.Resource.__init__(self)
-        self.db = db
+        self.store = store
+        self.tokens = tokens
 
     def render_POST(self, request):
+        track_retrieval(request, "delete")
         delete_token = base64.urlsafe_b64decode(request.args["t"][0])
-        self.db.execute("DELETE FROM mailbox_server_messages"
-                        " WHERE delete_token=?",
-                        (delete_token.encode("hex"),))
-        self.db.commit()
+        delete_messages(self.store, self.tokens,
+                        find_delete_tokens(self.tokens, [delete_token]))
+        request.setResponseCode(http.OK, "deleted")
+        return ""
+
+class RetrievalBatchDeleteResource(RetrievalDeleteResource):
+    def render_POST(self, request):
+        track_retrieval(request, "delete-batch")
+        try:
+            delete_tokens = split_tokens(read_body(request))
+        except ValueError:
+            request.setResponseCode(http.BAD_REQUEST, "bad delete tokens")
+            return "bad delete tokens"
+        delete_messages(self.store, self.tokens,
+                        find_delete_tokens(self.tokens, delete_tokens))
         request.setResponseCode(http.OK, "deleted")
         return ""
@@ -0,0 +1,619 @@
+# I define where the mailbox server keeps queued messages (the msgC bodies
+# waiting for their recipient to retrieve them).
+
+import os, time, struct, zlib, mmap, bisect, sqlite3
+from collections import defaultdict
+from twisted.application import service, internet
+from twisted.internet import defer
+from twisted.python import log, failure
+from ..database import Notice
+from ..eventual import eventually
+
+class MessageStore(service.MultiService):
+    """I am the interface that HTTPMailboxServer uses to queue messages.
+
+    Mutating methods (add_message, delete_message) are not durable until
+    commit() is called. After a commit, subscribers receive a Notice for
+    the 'mailbox_server_messages' table. Inserts have new_value holding (at
+    least) 'id', 'tid', and 'length'. Deletes of a message that existed
+    carry its 'tid' and 'length' in their tags.
+
+    Message ids are assigned in increasing order, and list_messages()
+    returns them in that order. Each message remembers when it arrived (when
+    add_message() was called, in whole seconds), so old ones can be expired.
+    """
+
+    def subscribe(self, observer):
+        raise NotImplementedError
+    def add_message(self, tid, msgC):
+        # returns the new message id
+        raise NotImplementedError
+    def commit(self):
+        raise NotImplementedError
+    def rollback(self):
+        raise NotImplementedError
+    def list_messages(self, tid, after=0, limit=None):
+        # returns a list of (msgid, length), for msgids greater than 'after',
+        # at most 'limit' of them
+        raise NotImplementedError
+    def get_message(self, msgid):
+        # returns (tid, msgC), or None
+        raise NotImplementedError
+    def delete_message(self, msgid):
+        raise NotImplementedError
+    def usage(self):
+        # returns a dict mapping tid to (number of messages, total length),
+        # for every tid with committed messages
+        raise NotImplementedError
+    def list_old_messages(self, before, after=None, limit=None):
+        # returns a list of (arrived, msgid, tid, length), oldest first, for
+        # messages that arrived before 'before'. 'after' is an (arrived,
+        # msgid) pair from a previous call, to resume where it left off.
+        raise NotImplementedError
+
+class SQLiteMessageStore(MessageStore):
+    """I keep queued messages in the node's main database, in the
+    mailbox_server_messages table. This is fine for a node that only serves
+    its own agent."""
+
+    def __init__(self, db, clock=time.time):
+        MessageStore.__init__(self)
+        self.db = db
+        self.clock = clock
+
+    def subscribe(self, observer):
+        self.db.subscribe("mailbox_server_messages", observer)
+
+    def add_message(self, tid, msgC):
+        body = sqlite3.Binary(msgC)
+        arrived = int(self.clock())
+        new_value = {"tid": tid, "fetch_token": None, "delete_token": None,
+                     "length": len(msgC), "arrived": arrived, "msgC": body}
+        return self.db.insert("INSERT INTO mailbox_server_messages"
+                              " (tid, length, arrived, msgC)"
+                              " VALUES (?,?,?,?)",
+                              (tid, len(msgC), arrived, body),
+                              "mailbox_server_messages",
+                              new_value=new_value)
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def list_messages(self, tid, after=0, limit=None):
+        c = self.db.execute("SELECT id,length FROM mailbox_server_messages"
+                            " WHERE tid=? AND id>? ORDER BY id LIMIT ?",
+                            (tid, after, -1 if limit is None else limit))
+        return [(row["id"], row["length"]) for row in c.fetchall()]
+
+    def get_message(self, msgid):
+        c = self.db.execute("SELECT tid,msgC FROM mailbox_server_messages"
+                            " WHERE id=?", (msgid,))
+        row = c.fetchone()
+        if not row:
+            return None
+        return row["tid"], str(row["msgC"])
+
+    def delete_message(self, msgid):
+        row = self.db.execute("SELECT tid,length FROM mailbox_server_messages"
+                              " WHERE id=?", (msgid,)).fetchone()
+        tags = {"tid": row["tid"], "length": row["length"]} if row else {}
+        self.db.delete("DELETE FROM mailbox_server_messages WHERE id=?",
+                       (msgid,), "mailbox_server_messages", msgid, tags)
+
+    def usage(self):
+        c = self.db.execute("SELECT tid,COUNT(*),SUM(length)"
+                            " FROM mailbox_server_messages GROUP BY tid")
+        return dict([(row[0], (row[1], row[2])) for row in c.fetchall()])
+
+    def list_old_messages(self, before, after=None, limit=None):
+        after_arrived, after_msgid = after or (-1, 0)
+        c = self.db.execute("SELECT arrived,id,tid,length"
+                            " FROM mailbox_server_messages"
+                            " WHERE arrived<? AND (arrived>? OR"
+                            "  (arrived=? AND id>?))"
+                            " ORDER BY arrived,id LIMIT ?",
+                            (before, after_arrived, after_arrived,
+                             after_msgid, -1 if limit is None else limit))
+        return [(row["arrived"], row["id"], row["tid"], row["length"])
+                for row in c.fetchall()]
+
+
+# The segment log is a directory of numbered segment files. Each file is a
+# sequence of records, each a fixed-size header followed by a body:
+#
+#  type (1 byte), msgid (8), tid (8), body length (4), crc32(body) (4)
+#
+# "S" starts every segment, and records the next msgid to be allocated (so
+# ids are never reused, even after every record that mentioned them has been
+# compacted away). "A" adds a message. "D" deletes one. "T" (whose body is
+# an 8-byte timestamp) says when the "A" records after it (up to the next
+# "T", in the same segment) arrived: we write one before the first message
+# of each second, rather than a timestamp in every record. "A" records with
+# no "T" before them (written before "T" existed) are treated as arriving
+# when the store was opened. Compaction copies the live "A" records of a
+# mostly-dead segment to the end of the log (with their "T"s), then removes
+# the old file, so both appends and compaction are sequential writes. It
+# goes a chunk at a time, and a crash part-way through is harmless: the
+# copies written so far replace the originals when the log is replayed.
+
+HEADER = struct.Struct(">cQQII")
+ARRIVAL = struct.Struct(">Q")
+START, ADD, DELETE, TIMESTAMP = "S", "A", "D", "T"
+RECORD_TYPES = (START, ADD, DELETE, TIMESTAMP)
+
+class Segment:
+    def __init__(self, segnum, path):
+        self.segnum = segnum
+        self.path = path
+        self.size = 0
+        self.live_bytes = 0 # header+body of the "A" records still indexed
+        self.tombstone_bytes = 0 # of the "D" records
+        self.map = None
+
+    def read(self, offset, length):
+        return self.mapped(offset+length)[offset:offset+length]
+
+    def mapped(self, size):
+        # returns a map of (at least) the first 'size' bytes of the file
+        if self.map is None or size > len(self.map):
+            self.close()
+            f = open(self.path, "rb")
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+        return self.map
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+def scan_segment(path):
+    """Return a list of (type, msgid, tid, body_offset, length) for every
+    intact record in the file, and the offset just past the last one. A torn
+    or corrupt record ends the scan."""
+    size = os.path.getsize(path)
+    if not size:
+        return [], 0
+    f = open(path, "rb")
+    try:
+        m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    try:
+        return read_records(m, 0, size)
+    finally:
+        m.close()
+
+def read_records(m, offset, size, limit=None):
+    """Like scan_segment, but for the records of the mapped file 'm' that
+    start at or after 'offset' (and end before 'size'). With 'limit', stop
+    once we're that many bytes past 'offset'."""
+    records = []
+    stop = size if limit is None else offset + limit
+    while offset + HEADER.size <= size and offset < stop:
+        rtype, msgid, tid, length, crc = HEADER.unpack_from(m, offset)
+        start = offset + HEADER.size
+        if rtype not in RECORD_TYPES or start + length > size:
+            break
+        if zlib.crc32(m[start:start+length]) & 0xffffffff != crc:
+            break
+        records.append((rtype, msgid, tid, start, length))
+        offset = start + length
+    return records, offset
+
+def insort_new(items, item):
+    # add item to the sorted list, unless it is already there. Appending is
+    # the common case, since ids and arrival times only go up, but
+    # compaction can leave a message's only copy after newer ones.
+    if not items or item > items[-1]:
+        items.append(item)
+        return
+    i = bisect.bisect_left(items, item)
+    if i == len(items) or items[i] != item:
+        items.insert(i, item)
+
+def remove_sorted(items, item):
+    i = bisect.bisect_left(items, item)
+    if i < len(items) and items[i] == item:
+        del items[i]
+
+class SegmentLogMessageStore(MessageStore):
+    """I keep queued messages in an append-only log of segment files, with
+    an in-memory index (rebuilt at startup) from msgid to file location, a
+    per-tid list of msgids, and a list of msgids in order of arrival.
+    Deletes append a small tombstone rather than rewriting anything, and a
+    background pass rewrites segments that are mostly dead. This suits
+    hosting nodes with many transports and lots of churn, where DELETEs
+    would otherwise fragment the database file.
+    """
+    SEGMENT_SIZE = 16*1000*1000
+    COMPACT_INTERVAL = 60 # seconds
+    COMPACT_THRESHOLD = 0.5 # rewrite sealed segments less than half live
+    # a quiet server can take a long time to fill its active segment, so we
+    # seal it early once it is this big and mostly dead
+    COMPACT_ACTIVE_SIZE = 1000*1000
+    COMPACT_CHUNK = 1000*1000 # bytes of old segment per reactor turn
+    COMPACT_RETRY = 0.01 # seconds, while a transaction is open
+
+    def __init__(self, logdir, fsync=True, clock=time.time, reactor=None):
+        MessageStore.__init__(self)
+        self.logdir = logdir
+        self.fsync = fsync
+        self.clock = clock
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        if not os.path.isdir(logdir):
+            os.makedirs(logdir)
+        self.observers = []
+        self.segments = {} # segnum -> Segment
+        self.index = {} # msgid -> (segnum, offset, length, tid, arrived)
+        self.by_tid = defaultdict(list) # tid -> sorted list of msgids
+        self.arrivals = [] # sorted list of (arrived, msgid)
+        self.next_msgid = 1
+        # the last "T" written to the active segment, and the last one that
+        # was committed
+        self.stamp = self.committed_stamp = None
+        # changes since the last commit: (ADD, msgid, tid, segment, offset,
+        # length, arrived) or (DELETE, msgid)
+        self.pending = []
+        # while a compaction runs: [segment, oldest, offset, Deferred]
+        self.compaction = None
+        self.next_chunk = None
+        self.replay()
+        self.open_active()
+        ts = internet.TimerService(self.COMPACT_INTERVAL,
+                                   self.periodic_compact)
+        ts.setServiceParent(self)
+
+    def segment_path(self, segnum):
+        return os.path.join(self.logdir, "%08d.seg" % segnum)
+
+    def replay(self):
+        opened = int(self.clock())
+        segnums = sorted([int(fn[:-len(".seg")])
+                          for fn in os.listdir(self.logdir)
+                          if fn.endswith(".seg")])
+        for segnum in segnums:
+            seg = Segment(segnum, self.segment_path(segnum))
+            self.segments[segnum] = seg
+            records, end = scan_segment(seg.path)
+            if end != os.path.getsize(seg.path):
+                # probably a write that was interrupted by a crash: it was
+                # never committed, so it is safe to discard
+                log.msg("truncating %s from %d to %d bytes"
+                        % (seg.path, os.path.getsize(seg.path), end))
+                f = open(seg.path, "r+b")
+                f.truncate(end)
+                f.close()
+            seg.size = end
+            self.stamp = None
+            for (rtype, msgid, tid, offset, length) in records:
+                if rtype == START:
+                    self.next_msgid = max(self.next_msgid, msgid)
+                    continue
+                if rtype == TIMESTAMP:
+                    (self.stamp,) = ARRIVAL.unpack(seg.read(offset, length))
+                    continue
+                self.next_msgid = max(self.next_msgid, msgid+1)
+                if rtype == ADD:
+                    # a later copy (written by compaction) replaces an
+                    # earlier one
+                    self.unindex(msgid)
+                    arrived = opened if self.stamp is None else self.stamp
+                    self.index_message(msgid, tid, seg, offset, length,
+                                       arrived)
+                elif rtype == DELETE:
+                    seg.tombstone_bytes += HEADER.size
+                    self.forget(msgid)
+            # reading the "T"s mapped the file, which can wait until somebody
+            # wants a message from it
+            seg.close()
+        self.committed_stamp = self.stamp
+
+    def index_message(self, msgid, tid, seg, offset, length, arrived):
+        self.index[msgid] = (seg.segnum, offset, length, tid, arrived)
+        seg.live_bytes += HEADER.size + length
+        insort_new(self.arrivals, (arrived, msgid))
+        insort_new(self.by_tid[tid], msgid)
+
+    def unindex(self, msgid):
+        loc = self.index.pop(msgid, None)
+        if not loc:
+            return None
+        segnum, offset, length, tid, arrived = loc
+        self.segments[segnum].live_bytes -= HEADER.size + length
+        remove_sorted(self.arrivals, (arrived, msgid))
+        # the per-tid entry is left alone: index_message() won't add a
+        # replayed copy twice, and forget() removes it for real
+        return tid
+
+    def open_active(self):
+        if self.segments:
+            last = self.segments[max(self.segments)]
+            if last.size < self.SEGMENT_SIZE:
+                self.active = last
+                self.active_file = open(last.path, "ab")
+                self.committed_size = last.size
+                return
+        self.start_segment()
+
+    def start_segment(self):
+        segnum = max(self.segments or [0]) + 1
+        self.active = seg = Segment(segnum, self.segment_path(segnum))
+        self.segments[segnum] = seg
+        self.active_file = open(seg.path, "ab")
+        # timestamps don't carry over from one segment to the next
+        self.stamp = None
+        self.append(START, self.next_msgid, 0, "")
+        self.sync()
+
+    def append(self, rtype, msgid, tid, body):
+        crc = zlib.crc32(body) & 0xffffffff
+        self.active_file.write(HEADER.pack(rtype, msgid, tid, len(body), crc))
+        self.active_file.write(body)
+        offset = self.active.size + HEADER.size
+        self.active.size = offset + len(body)
+        return offset
+
+    def sync(self):
+        self.active_file.flush()
+        if self.fsync:
+            os.fsync(self.active_file.fileno())
+        self.committed_size = self.active.size
+        self.committed_stamp = self.stamp
+
+    def append_stamp(self, arrived):
+        if arrived != self.stamp:
+            self.append(TIMESTAMP, 0, 0, ARRIVAL.pack(arrived))
+            self.stamp = arrived
+
+    def roll_over(self):
+        self.active_file.close()
+        self.start_segment()
+
+    def stopService(self):
+        if self.next_chunk and self.next_chunk.active():
+            # the rest will have to wait until we start again
+            self.next_chunk.cancel()
+            self.finish_compaction(None)
+        self.active_file.close()
+        for seg in self.segments.values():
+            seg.close()
+        return MessageStore.stopService(self)
+
+    # MessageStore interface
+
+    def subscribe(self, observer):
+        self.observers.append(observer)
+
+    def add_message(self, tid, msgC):
+        msgid = self.next_msgid
+        self.next_msgid += 1
+        arrived = int(self.clock())
+        self.append_stamp(arrived)
+        offset = self.append(ADD, msgid, tid, msgC)
+        self.pending.append((ADD, msgid, tid, self.active, offset,
+                             len(msgC), arrived))
+        return msgid
+
+    def delete_message(self, msgid):
+        if msgid not in self.index:
+            return
+        self.append(DELETE, msgid, self.index[msgid][3], "")
+        self.pending.append((DELETE, msgid))
+
+    def commit(self):
+        self.sync()
+        pending, self.pending = self.pending, []
+        notices = []
+        for p in pending:
+            if p[0] == ADD:
+                (_, msgid, tid, seg, offset, length, arrived) = p
+                self.index_message(msgid, tid, seg, offset, length, arrived)
+                notices.append(Notice("mailbox_server_messages", "insert",
+                                      msgid, {"id": msgid, "tid": tid,
+                                              "length": length,
+                                              "arrived": arrived}, {}))
+            else:
+                msgid = p[1]
+                self.active.tombstone_bytes += HEADER.size
+                loc = self.index.get(msgid)
+                tags = {"tid": loc[3], "length": loc[2]} if loc else {}
+                self.forget(msgid)
+                notices.append(Notice("mailbox_server_messages", "delete",
+                                      msgid, None, tags))
+        for n in notices:
+            for o in self.observers:
+                eventually(o, n)
+        if self.active.size >= self.SEGMENT_SIZE:
+            self.roll_over()
+
+    def rollback(self):
+        # discard everything appended since the last commit
+        self.pending = []
+        self.active_file.close()
+        self.active.close()
+        f = open(self.active.path, "r+b")
+        f.truncate(self.committed_size)
+        f.close()
+        self.active.size = self.committed_size
+        self.stamp = self.committed_stamp
+        self.active_file = open(self.active.path, "ab")
+
+    def forget(self, msgid):
+        tid = self.unindex(msgid)
+        if tid is None:
+            return
+        msgids = self.by_tid[tid]
+        remove_sorted(msgids, msgid)
+        if not msgids:
+            del self.by_tid[tid]
+
+    def list_messages(self, tid, after=0, limit=None):
+        msgids = self.by_tid.get(tid)
+        if not msgids:
+            return []
+        start = bisect.bisect_right(msgids, after)
+        end = len(msgids) if limit is None else start+limit
+        return [(msgid, self.index[msgid][2]) for msgid in msgids[start:end]]
+
+    def get_message(self, msgid):
+        loc = self.index.get(msgid)
+        if not loc:
+            return None
+        segnum, offset, length, tid, arrived = loc
+        seg = self.segments[segnum]
+        if seg is self.active:
+            self.active_file.flush()
+        return tid, seg.read(offset, length)
+
+    def usage(self):
+        usage = {}
+        for tid, msgids in self.by_tid.items():
+            usage[tid] = (len(msgids),
+                          sum([self.index[msgid][2] for msgid in msgids]))
+        return usage
+
+    def list_old_messages(self, before, after=None, limit=None):
+        start = bisect.bisect_right(self.arrivals, after) if after else 0
+        end = bisect.bisect_left(self.arrivals, (before, 0))
+        if limit is not None:
+            end = min(end, start+limit)
+        old = []
+        for (arrived, msgid) in self.arrivals[start:end]:
+            segnum, offset, length, tid, arrived = self.index[msgid]
+            old.append((arrived, msgid, tid, length))
+        return old
+
+    # compaction
+
+    def periodic_compact(self):
+        d = self.compact()
+        # failures were logged already, and shouldn't stop the timer
+        d.addErrback(lambda f: None)
+        return d
+
+    def compact(self):
+        """Rewrite the oldest sealed segment that is mostly dead, if any
+        (sealing the active segment first, if that one is). Returns a
+        Deferred that fires with the segment number that was removed, or
+        None. The rewrite goes COMPACT_CHUNK bytes at a time, with a trip
+        through the reactor in between, so deliveries and retrievals can
+        get in."""
+        if self.compaction or self.pending:
+            return defer.succeed(None) # try again next time
+        seg = self.find_compactable()
+        if seg is None:
+            return defer.succeed(None)
+        # A tombstone must outlive every copy of the record it deletes. All
+        # of those copies were written before the tombstone, so if this is
+        # the oldest segment, they are all in here with it, and can go away
+        # together. Otherwise we carry the tombstones forward.
+        oldest = (seg.segnum == min(self.segments))
+        d = defer.Deferred()
+        self.compaction = [seg, oldest, 0, d]
+        self.compact_chunk()
+        return d
+
+    def mostly_dead(self, seg):
+        # tombstones are only dead in the oldest segment (see compact), and
+        # elsewhere would just be copied forward again
+        kept = seg.live_bytes
+        if seg.segnum != min(self.segments):
+            kept += seg.tombstone_bytes
+        return kept <= seg.size * self.COMPACT_THRESHOLD
+
+    def find_compactable(self):
+        for segnum in sorted(self.segments):
+            seg = self.segments[segnum]
+            if seg is not self.active and self.mostly_dead(seg):
+                return seg
+        seg = self.active
+        if seg.size >= self.COMPACT_ACTIVE_SIZE and self.mostly_dead(seg):
+            self.roll_over()
+            return seg
+        return None
+
+    def compact_chunk(self):
+        self.next_chunk = None
+        seg, oldest, offset, d = self.compaction
+        if self.pending:
+            # our sync() would commit somebody else's transaction
+            self.next_chunk = self.reactor.callLater(self.COMPACT_RETRY,
+                                                     self.compact_chunk)
+            return
+        try:
+            records, end = read_records(seg.mapped(seg.size), offset,
+                                        seg.size, self.COMPACT_CHUNK)
+            if not records and end < seg.size:
+                raise ValueError("corrupt record in %s at %d"
+                                 % (seg.path, end))
+            self.copy_records(seg, oldest, records)
+        except:
+            f = failure.Failure()
+            log.err(f, "segment compaction failed")
+            self.rollback() # any copies we didn't get to sync
+            self.finish_compaction(f)
+            return
+        if end < seg.size:
+            self.compaction[2] = end
+            self.next_chunk = self.reactor.callLater(0, self.compact_chunk)
+            return
+        seg.close()
+        os.unlink(seg.path)
+        del self.segments[seg.segnum]
+        self.finish_compaction(seg.segnum)
+
+    def copy_records(self, seg, oldest, records):
+        # the copies can take the active segment past SEGMENT_SIZE (by at
+        # most half a segment), until the next commit() starts a new one
+        target = self.active
+        moves = []
+        for (rtype, msgid, tid, offset, length) in records:
+            if rtype == ADD:
+                loc = self.index.get(msgid)
+                if loc and loc[0] == seg.segnum and loc[1] == offset:
+                    body = seg.read(offset, length)
+                    arrived = loc[4]
+                    self.append_stamp(arrived)
+                    newoffset = self.append(ADD, msgid, tid, body)
+                    moves.append((msgid, tid, newoffset, length, arrived))
+            elif rtype == DELETE and not oldest:
+                self.append(DELETE, msgid, tid, "")
+                target.tombstone_bytes += HEADER.size
+        self.sync()
+        for (msgid, tid, newoffset, length, arrived) in moves:
+            self.unindex(msgid)
+            self.index_message(msgid, tid, target, newoffset, length,
+                               arrived)
+
+    def finish_compaction(self, result):
+        d = self.compaction[3]
+        self.compaction = self.next_chunk = None
+        if isinstance(result, failure.Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def get_stats(self):
+        return {"segments": len(self.segments),
+                "messages": len(self.index),
+                "live_bytes": sum([s.live_bytes
+                                   for s in self.segments.values()]),
+                "total_bytes": sum([s.size for s in self.segments.values()]),
+                "compacting": self.compaction is not None,
+                }
+
+def create_message_store(db, basedir, desc):
+    store_type = desc.get("message_store", "sqlite")
+    if store_type == "sqlite":
+        return SQLiteMessageStore(db)
+    if store_type == "log":
+        return SegmentLogMessageStore(os.path.join(basedir, "mailbox-spool"))
+    raise ValueError("unknown message_store type '%s'" % store_type)
@@ -0,0 +1,99 @@
+# I hold the fetch/delete tokens that the mailbox server hands out in
+# retrieval "list" responses. They are only good for one retrieval session,
+# so they live in memory, not in the message store.
+
+import time
+
+class TokenTable:
+    """I map fetch and delete tokens to message ids, grouped into one
+    session per transport (tid).
+
+    Each 'list' request starts a new session for its tid, which revokes
+    every token from that tid's previous session. A session that hasn't
+    issued or resolved a token for 'lifetime' seconds is revoked too, when
+    it is next used or by prune(). Fetch tokens are single-use. Nothing here
+    touches the database, so listing a large backlog is free apart from the
+    crypto.
+    """
+
+    def __init__(self, lifetime=3600, clock=time.time):
+        self.lifetime = lifetime
+        self.clock = clock
+        self.fetch_tokens = {} # fetch_token -> msgid
+        self.delete_tokens = {} # delete_token -> msgid
+        self.messages = {} # msgid -> (tid, fetch_token, delete_token)
+        self.sessions = {} # tid -> [last_used, set of msgids]
+
+    def __len__(self):
+        return len(self.messages)
+
+    def start_session(self, tid):
+        self.revoke(tid)
+        self.sessions[tid] = [self.clock(), set()]
+
+    def revoke(self, tid):
+        last_used, msgids = self.sessions.pop(tid, (None, ()))
+        for msgid in msgids:
+            fetch_token, delete_token = self.messages.pop(msgid)[1:]
+            self.fetch_tokens.pop(fetch_token, None)
+            self.delete_tokens.pop(delete_token, None)
+
+    def add(self, tid, msgid, fetch_token, delete_token):
+        if tid not in self.sessions:
+            self.start_session(tid)
+        self.forget_message(msgid)
+        self.messages[msgid] = (tid, fetch_token, delete_token)
+        if fetch_token:
+            # messages delivered inline with the list don't need one
+            self.fetch_tokens[fetch_token] = msgid
+        self.delete_tokens[delete_token] = msgid
+        session = self.sessions[tid]
+        session[0] = self.clock()
+        session[1].add(msgid)
+
+    def forget_message(self, msgid):
+        if msgid not in self.messages:
+            return
+        tid, fetch_token, delete_token = self.messages.pop(msgid)
+        self.fetch_tokens.pop(fetch_token, None)
+        self.delete_tokens.pop(delete_token, None)
+        self.sessions[tid][1].discard(msgid)
+
+    def message_changed(self, notice):
+        # subscribed to the message store, so deleted messages (however
+        # they were deleted) don't leave tokens behind
+        if notice.action == "delete":
+            self.forget_message(notice.id)
+
+    def lookup(self, table, token):
+        msgid = table.get(token)
+        if msgid is None:
+            return None
+        tid = self.messages[msgid][0]
+        now = self.clock()
+        session = self.sessions[tid]
+        if now > session[0] + self.lifetime:
+            self.revoke(tid)
+            return None
+        session[0] = now
+        return msgid
+
+    def find_fetch_token(self, fetch_token):
+        # returns msgid, or None
+        return self.lookup(self.fetch_tokens, fetch_token)
+
+    def clear_fetch_token(self, msgid):
+        tid, fetch_token, delete_token = self.messages[msgid]
+        self.fetch_tokens.pop(fetch_token, None)
+        self.messages[msgid] = (tid, None, delete_token)
+
+    def find_delete_token(self, delete_token):
+        # returns msgid, or None
+        return self.lookup(self.delete_tokens, delete_token)
+
+    def prune(self, now=None):
+        oldest = (now or self.clock()) - self.lifetime
+        for tid in [tid for (tid, (last_used, msgids))
+                    in self.sessions.items()
+                    if last_used < oldest]:
+            self.revoke(tid)
@@ -0,0 +1,91 @@
+# I hold the mailbox server's view of its transports (one per recipient it
+# serves), so the delivery and retrieval paths don't need to ask the
+# database about them for every message.
+
+from collections import namedtuple, OrderedDict
+from ..util import unhex_or_none
+
+Transport = namedtuple("Transport", ["tid", "TTID", "TT0", "RT", "symkey",
+                                     "max_messages", "max_bytes",
+                                     "retention"])
+
+class TransportRegistry:
+    """I am an LRU cache of mailbox_server_transports rows, indexed by tid,
+    TTID, and RT, with all the binary fields already decoded. A miss falls
+    through to the database. At most max_entries transports are held in
+    memory, so a hosting node with millions of recipients only pays for the
+    ones that are active.
+
+    The server tells me about new transports with add(), and any row that
+    is updated or deleted in the database is dropped from the cache when
+    the change is committed. Unknown TTIDs and RTs are not remembered (an
+    attacker could use them to flush the cache), so they cost a query
+    each.
+    """
+
+    def __init__(self, db, max_entries=10000):
+        assert max_entries >= 1
+        self.db = db
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # tid -> Transport, oldest first
+        self.by_TTID = {}
+        self.by_RT = {}
+        self.db.subscribe("mailbox_server_transports", self.db_changed)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, tid, TTID, TT0, RT, symkey, max_messages=None,
+            max_bytes=None, retention=None):
+        self.remove(tid)
+        t = Transport(tid, TTID, TT0, RT, symkey, max_messages, max_bytes,
+                      retention)
+        self.entries[tid] = t
+        self.by_TTID[TTID] = tid
+        if RT is not None:
+            self.by_RT[RT] = tid
+        while len(self.entries) > self.max_entries:
+            self.remove(next(iter(self.entries)))
+        return t
+
+    def remove(self, tid):
+        t = self.entries.pop(tid, None)
+        if t:
+            del self.by_TTID[t.TTID]
+            self.by_RT.pop(t.RT, None)
+
+    def db_changed(self, notice):
+        if notice.action in ("update", "delete"):
+            self.remove(notice.id)
+
+    def touch(self, tid):
+        # move to the most-recently-used end
+        t = self.entries.pop(tid)
+        self.entries[tid] = t
+        return t
+
+    def load(self, column, value):
+        c = self.db.execute("SELECT * FROM mailbox_server_transports"
+                            " WHERE %s=?" % column, (value,))
+        row = c.fetchone()
+        if not row:
+            return None
+        return self.add(row["id"], row["TTID"].decode("hex"),
+                        row["TT0"].decode("hex"), unhex_or_none(row["RT"]),
+                        unhex_or_none(row["symkey"]), row["max_messages"],
+                        row["max_bytes"], row["retention"])
+
+    def get(self, tid):
+        if tid in self.entries:
+            return self.touch(tid)
+        return self.load("id", tid)
+
+    def lookup_TTID(self, TTID):
+        if TTID in self.by_TTID:
+            return self.touch(self.by_TTID[TTID])
+        return self.load("TTID", TTID.encode("hex"))
+
+    def lookup_RT(self, RT):
+        if RT in self.by_RT:
+            return self.touch(self.by_RT[RT])
+        return self.load("RT", RT.encode("hex"))
@@ -0,0 +1,198 @@
+# I hold the node's counters, gauges, and latency histograms, and render
+# them in the Prometheus text format for the /metrics page.
+
+import time, bisect
+
+# in seconds: from a fraction of a millisecond (a cached database read) up
+# to ten seconds (a slow delivery)
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0,
+                   5.0, 10.0)
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    def escape(v):
+        return (str(v).replace("\\", "\\\\").replace("\"", "\\\"")
+                .replace("\n", "\\n"))
+    return "{%s}" % ",".join(['%s="%s"' % (k, escape(v))
+                              for (k, v) in labels])
+
+class _Metric(object):
+    def __init__(self, registry, name, help, labelnames=(), **kwargs):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.kwargs = kwargs
+        self.children = {} # tuple of label values -> metric
+
+    def labels(self, *values):
+        # returns the metric for these label values, which callers on hot
+        # paths should hang on to rather than looking up every time
+        assert len(values) == len(self.labelnames), values
+        child = self.children.get(values)
+        if child is None:
+            child = self.__class__(self.registry, self.name, self.help,
+                                   **self.kwargs)
+            self.children[values] = child
+        return child
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help.replace("\n", " ")),
+                 "# TYPE %s %s" % (self.name, self.TYPE)]
+        if self.labelnames:
+            children = [(zip(self.labelnames, values), child)
+                        for (values, child) in sorted(self.children.items())]
+        else:
+            children = [([], self)]
+        for (labels, child) in children:
+            for (suffix, extra, value) in child.samples():
+                lines.append("%s%s%s %s" % (self.name, suffix,
+                                            format_labels(labels + extra),
+                                            format_value(value)))
+        return lines
+
+class Counter(_Metric):
+    TYPE = "counter"
+    value = 0
+
+    def inc(self, amount=1):
+        if self.registry.enabled:
+            self.value += amount
+
+    def samples(self):
+        return [("_total" if not self.name.endswith("_total") else "", [],
+                 self.value)]
+
+class Gauge(_Metric):
+    """A value that goes up and down. Gauges built with fn= call it when
+    they are rendered, which costs nothing until somebody asks."""
+    TYPE = "gauge"
+    value = 0
+
+    def set(self, value):
+        if self.registry.enabled:
+            self.value = value
+
+    def inc(self, amount=1):
+        if self.registry.enabled:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, fn):
+        # for gauges that read an object which is only built later (like
+        # the node's executor), and which a new node replaces
+        self.kwargs["fn"] = fn
+
+    def samples(self):
+        fn = self.kwargs.get("fn")
+        return [("", [], fn() if fn else self.value)]
+
+class Histogram(_Metric):
+    """Counts observations (usually latencies, in seconds) into buckets.
+    For timing, start() returns a token (None while metrics are disabled)
+    to hand to stop(), so a disabled histogram doesn't even read the
+    clock."""
+    TYPE = "histogram"
+
+    def __init__(self, registry, name, help, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, registry, name, help, labelnames,
+                         buckets=buckets)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets)+1) # the last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        if not self.registry.enabled:
+            return
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def start(self):
+        if self.registry.enabled:
+            return self.registry.clock()
+        return None
+
+    def stop(self, started):
+        if started is not None:
+            self.observe(self.registry.clock() - started)
+
+    def track(self, d):
+        # time a Deferred, from now until it fires (either way)
+        started = self.start()
+        if started is not None:
+            def _done(res):
+                self.stop(started)
+                return res
+            d.addBoth(_done)
+        return d
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for (le, count) in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            samples.append(("_bucket", [("le", format_value(le))],
+                            cumulative))
+        samples.append(("_sum", [], self.sum))
+        samples.append(("_count", [], self.count))
+        return samples
+
+class Registry:
+    """I hold every metric in the node. Modules create theirs when they are
+    imported (with counter(), gauge(), and histogram() below), and keep them
+    in module-level names, so instrumenting a hot path costs one method
+    call. Until enable() is called, those calls return without recording
+    anything."""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.enabled = False
+        self.metrics = {} # name -> metric
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def add(self, cls, name, help, labelnames=(), **kwargs):
+        # modules that get imported twice (e.g. by tests) share the metric
+        m = self.metrics.get(name)
+        if m is None:
+            m = self.metrics[name] = cls(self, name, help, labelnames,
+                                         **kwargs)
+        assert isinstance(m, cls), (name, m)
+        return m
+
+    def counter(self, name, help, labelnames=()):
+        return self.add(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=(), fn=None):
+        return self.add(Gauge, name, help, labelnames, fn=fn)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram, name, help, labelnames, buckets=buckets)
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
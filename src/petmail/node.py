@@ -1,14 +1,32 @@
 import json
 from twisted.application import service
-from . import database, web, util
+from . import database, web, util, metrics
+from .executor import CryptoExecutor
+from .httpclient import HTTPClient
 
 class Node(service.MultiService):
-    def __init__(self, basedir, dbfile):
+    def __init__(self, basedir, dbfile, crypto_threads=0, ingest_workers=0,
+                 ingest_listen=None, ingest_url=None, enable_metrics=False,
+                 cidtoken_window=None):
         service.MultiService.__init__(self)
+        # metrics cost (almost) nothing until they are turned on
+        if enable_metrics:
+            metrics.registry.enable()
         self.basedir = basedir
         self.dbfile = dbfile
 
         self.db = database.make_observable_db(dbfile)
+        # with crypto_threads=0, all crypto runs inline on the reactor thread
+        self.executor = CryptoExecutor(crypto_threads)
+        self.executor.setServiceParent(self)
+        # all outbound HTTP shares one pool of persistent connections
+        self.http = HTTPClient()
+        self.http.setServiceParent(self)
+        self.init_metrics()
+        self.ingest_workers = ingest_workers
+        self.ingest_listen = ingest_listen
+        self.ingest_url = ingest_url
+        self.cidtoken_window = cidtoken_window
         self.init_webport()
         self.agent = None
         c = self.db.execute("SELECT name FROM services")
@@ -34,6 +52,27 @@ class Node(service.MultiService):
         self.db.execute("UPDATE node SET %s=?" % name, (value,))
         self.db.commit()
 
+    def init_metrics(self):
+        # the crypto queue and the connection pool keep their own counts,
+        # which these gauges read whenever /metrics is rendered
+        def stat(obj, name):
+            return lambda: obj.get_stats()[name]
+        g = metrics.gauge("petmail_executor_tasks",
+                          "crypto tasks waiting for, or running on, a worker",
+                          ["state"])
+        for name in ["queued", "active"]:
+            g.labels(name).set_function(stat(self.executor, name))
+        g = metrics.gauge("petmail_executor_threads", "crypto worker threads")
+        g.set_function(stat(self.executor, "threads"))
+        g = metrics.gauge("petmail_http_requests",
+                          "outbound HTTP requests in progress, or waiting for"
+                          " a connection", ["state"])
+        for name in ["active", "queued"]:
+            g.labels(name).set_function(stat(self.http, name))
+        g = metrics.gauge("petmail_http_idle_connections",
+                          "persistent HTTP connections awaiting a request")
+        g.set_function(stat(self.http, "idle_connections"))
+
     def init_webport(self):
         # Access tokens last as long as the node is running: they are cleared
         # at each startup.
@@ -46,6 +85,8 @@ class Node(service.MultiService):
         c = self.db.execute("SELECT * FROM node").fetchone()
         self.web = web.WebPort(str(c["listenport"]), access_token)
         self.web.setServiceParent(self)
+        if metrics.registry.enabled:
+            self.web.enable_metrics(metrics.registry)
         self.baseurl = str(c["baseurl"])
         assert self.baseurl.endswith("/")
 
@@ -61,15 +102,27 @@ class Node(service.MultiService):
 
     def init_mailbox_server(self, baseurl):
         from .mailbox.server import HTTPMailboxServer
+        from .mailbox.store import create_message_store
         # TODO: learn/be-told our IP addr/hostname
         c = self.db.execute("SELECT * FROM mailbox_server_config")
         row = c.fetchone()
-        s = HTTPMailboxServer(self.db, self.web, baseurl,
-                              json.loads(row["mailbox_config_json"]))
+        desc = json.loads(row["mailbox_config_json"])
+        if self.ingest_url:
+            desc["ingest_url"] = self.ingest_url
+        store = create_message_store(self.db, self.basedir, desc)
+        s = HTTPMailboxServer(self.db, self.web, baseurl, desc, store,
+                              self.executor)
+        if self.ingest_workers:
+            s.enable_ingest_workers(self.dbfile, self.ingest_listen,
+                                    self.ingest_workers)
         s.setServiceParent(self)
         self.mailbox_server = s
 
     def init_agent(self):
         from . import agent
-        self.agent = agent.Agent(self.db, self.basedir, self.mailbox_server)
+        options = {}
+        if self.cidtoken_window:
+            options["cidtoken_window"] = self.cidtoken_window
+        self.agent = agent.Agent(self.db, self.basedir, self.mailbox_server,
+                                 self.executor, self.http, **options)
         self.agent.setServiceParent(self)
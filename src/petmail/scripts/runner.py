@@ -62,15 +62,51 @@ class CreateNodeOptions(BasedirParameterMixin, BasedirArgument, usage.Options):
 class PrintBaseURLOptions(BasedirParameterMixin, BasedirArgument, usage.Options):
     pass
 
-class StartNodeOptions(BasedirParameterMixin, StartArguments, usage.Options):
+class NodeTuningOptions:
+    optParameters = [
+        ("crypto-threads", None, 4,
+         "number of threads for public-key crypto", int),
+        ("ingest-workers", None, 0,
+         "number of processes to accept inbound mailbox messages", int),
+        ("ingest-listen", None, None,
+         "where ingest workers listen, like tcp:PORT:interface=ADDR"),
+        ("ingest-url", None, None,
+         "mailbox URL to give new senders (e.g. a proxy for --ingest-listen)"),
+        ("cidtoken-window", None, 8,
+         "how many future messages per contact can be recognized quickly,"
+         " if earlier ones go missing", int),
+        ]
+    optFlags = [
+        ("inline-crypto", None,
+         "do all crypto on the main thread, instead of --crypto-threads"),
+        ("metrics", None,
+         "record counters and latencies, and serve them from /metrics"),
+        ]
+
+    def check_tuning_options(self):
+        if self["ingest-workers"] and not self["ingest-listen"]:
+            raise usage.UsageError("--ingest-workers requires --ingest-listen")
+        if (self["ingest-listen"]
+            and not self["ingest-listen"].startswith("tcp:")):
+            raise usage.UsageError("--ingest-listen must start with tcp:")
+        if self["cidtoken-window"] < 1:
+            raise usage.UsageError("--cidtoken-window must be at least 1")
+
+class StartNodeOptions(BasedirParameterMixin, NodeTuningOptions,
+                       StartArguments, usage.Options):
     optFlags = [
         ("no-open", "n", "Do not automatically open the control panel"),
         ]
+    def postOptions(self):
+        BasedirParameterMixin.postOptions(self)
+        self.check_tuning_options()
 class StopNodeOptions(BasedirParameterMixin, BasedirArgument, usage.Options):
     pass
-class RestartNodeOptions(BasedirParameterMixin, StartArguments, usage.Options):
+class RestartNodeOptions(BasedirParameterMixin, NodeTuningOptions,
+                         StartArguments, usage.Options):
     def postOptions(self):
         BasedirParameterMixin.postOptions(self)
+        self.check_tuning_options()
         self["no-open"] = False
 class OpenOptions(BasedirParameterMixin, BasedirArgument, usage.Options):
     optFlags = [
@@ -136,6 +172,7 @@ class Options(usage.Options):
                    ("send-basic", None, SendBasicOptions, "Send a basic message"),
                    ("fetch-messages", None, NoOptions, "Fetch all stored messages"),
                    ("follow-messages", None, NoOptions, "Fetch messages"),
+                   ("mailbox-usage", None, NoOptions, "Show how much each mailbox transport has queued"),
                    ]
 
     def opt_version(self):
@@ -226,6 +263,17 @@ def render_messages(result):
         lines.append(str(entry["payload"]))
     return "\n".join(lines)+"\n"
 
+def render_mailbox_usage(result):
+    lines = []
+    def limit(value):
+        return "-" if value is None else str(value)
+    for entry in result["transports"]:
+        lines.append("tid %d: %d messages (max %s), %d bytes (max %s)%s" % (
+            entry["tid"], entry["messages"], limit(entry["max_messages"]),
+            entry["bytes"], limit(entry["max_bytes"]),
+            " FULL" if entry["full"] else ""))
+    return "\n".join(lines)+"\n"
+
 def WebCommand(name, argnames, render=render_text, extra_args={}):
     # Build a dispatch function for simple commands that deliver some string
     # arguments to a web API, then display a result.
@@ -265,6 +313,8 @@ DISPATCH = {"create-node": create_node,
             "fetch-messages": WebCommand("fetch-messages", [],
                                          render=render_messages),
             "follow-messages": follow_messages,
+            "mailbox-usage": WebCommand("mailbox-usage", [],
+                                        render=render_mailbox_usage),
             "accept": accept,
             }
 
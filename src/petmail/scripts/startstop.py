@@ -10,14 +10,15 @@ class MyTwistdConfig(twistd.ServerOptions):
 
 class MyPlugin:
     tapname = "xyznode"
-    def __init__(self, basedir, dbfile):
+    def __init__(self, basedir, dbfile, node_options={}):
         self.basedir = basedir
         self.dbfile = dbfile
+        self.node_options = node_options
     def makeService(self, so):
         # delay this import as late as possible, to allow twistd's code to
         # accept --reactor= selection
         from .. import node
-        return node.Node(self.basedir, self.dbfile)
+        return node.Node(self.basedir, self.dbfile, **self.node_options)
 
 def start(so, out, err):
     basedir = os.path.abspath(so["basedir"])
@@ -35,7 +36,16 @@ def start(so, out, err):
         print >>err, twistd_config
         print >>err, "petmail %s: %s" % (so.subCommand, ue)
         return 1
-    twistd_config.loadedPlugins = {"XYZ": MyPlugin(basedir, dbfile)}
+    node_options = {
+        "crypto_threads": 0 if so["inline-crypto"] else so["crypto-threads"],
+        "ingest_workers": so["ingest-workers"],
+        "ingest_listen": so["ingest-listen"],
+        "ingest_url": so["ingest-url"],
+        "enable_metrics": so["metrics"],
+        "cidtoken_window": so["cidtoken-window"],
+        }
+    twistd_config.loadedPlugins = {"XYZ": MyPlugin(basedir, dbfile,
+                                                   node_options)}
     # this spawns off a child process, and the parent calls os._exit(0), so
     # there's no way for us to get control afterwards, even with 'except
     # SystemExit'. So if we want to do anything with the running child, we
@@ -284,10 +284,11 @@ class TwoNodeMixin(BasedirMixin, NodeRunnerMixin, PollMixin):
             0, a_signkey.verify_key.encode().encode("hex"),
             )
 
-        nA.db.execute(q, vA)
-        nA.db.commit()
-        nB.db.execute(q, vB)
+        # the agents' channel indexes hear about these through notices
+        nA.db.insert(q, vA, "addressbook")
         nA.db.commit()
+        nB.db.insert(q, vB, "addressbook")
+        nB.db.commit()
 
         entA = nA.db.execute("SELECT * FROM addressbook").fetchone()
         entB = nB.db.execute("SELECT * FROM addressbook").fetchone()
@@ -22,6 +22,9 @@ class PollMixin:
             cutoff = time.time() + timeout
         lc = task.LoopingCall(self._poll, check_f, cutoff)
         d = lc.start(pollinterval)
+        # don't leave the loop in the reactor if the test ends some other
+        # way (like a trial timeout)
+        self.addCleanup(lambda: lc.running and lc.stop())
         def _convert_done(f):
             f.trap(PollComplete)
             return None
@@ -1,10 +1,14 @@
 import json
 from twisted.trial import unittest
+from twisted.internet import defer
 from hashlib import sha256
 from nacl.public import PrivateKey, PublicKey, Box
 from .common import TwoNodeMixin
 from ..mailbox import channel
 from ..mailbox.server import parseMsgA, parseMsgB
+from ..executor import CryptoExecutor
+from ..eventual import flushEventualQueue
+from ..errors import ReplayError
 
 class msgC(TwoNodeMixin, unittest.TestCase):
     def test_create_and_parse(self):
@@ -59,7 +63,11 @@ class msgC(TwoNodeMixin, unittest.TestCase):
 
         CIDToken, CIDBox, msgD = channel.parse_msgC(msgC)
 
-        # TODO: test CIDToken
+        # test CIDToken
+        cidindex = channel.CIDTokenIndex(nB.db)
+        self.failUnlessEqual(cidindex.lookup(CIDToken), (entB2["id"], 1))
+        self.failUnlessEqual(channel.CIDTokenIndex(nA.db).lookup(CIDToken),
+                             (None, None))
 
         # test CIDBox
         cid,which_key = channel.find_channel_from_CIDBox(nB.db, CIDBox)
@@ -83,14 +91,227 @@ class msgC(TwoNodeMixin, unittest.TestCase):
 
         # this exercises the full processing path, which will increment both
         # outbound and inbound seqnums
-        cid2, seqnum, payload2_s = channel.process_msgC(nB.db, msgC)
+        d = channel.process_msgC(nB.db, msgC)
+        def _processed((cid2, seqnum, payload2_s)):
+            self.failUnlessEqual(cid2, entB2["id"])
+            self.failUnlessEqual(seqnum, 1)
+            self.failUnlessEqual(json.loads(payload2_s), payload)
 
-        self.failUnlessEqual(cid2, entB2["id"])
-        self.failUnlessEqual(seqnum, 1)
-        self.failUnlessEqual(json.loads(payload2_s), payload)
+            self.failUnlessEqual(self.get_outbound_seqnum(nA.db,
+                                                          entA2["id"]), 2)
+            self.failUnlessEqual(self.get_inbound_seqnum(nB.db,
+                                                         entB2["id"]), 1)
+        d.addCallback(_processed)
+        return d
 
-        self.failUnlessEqual(self.get_outbound_seqnum(nA.db, entA2["id"]), 2)
-        self.failUnlessEqual(self.get_inbound_seqnum(nB.db, entB2["id"]), 1)
+    def test_cidtoken_index(self):
+        nA, nB, entA, entB = self.make_connected_nodes()
+        entA2, entB2 = self.add_new_channel(nA, nB)
+        cidindex = channel.CIDTokenIndex(nB.db)
+        chan = channel.OutboundChannel(nA.db, entA2["id"])
+        msgCs = [chan.createMsgC({"n": n}) for n in range(2)]
+        # with the index, nobody needs to scan the addressbook
+        def _no_scan(db, CIDBox, keyring=None):
+            raise AssertionError("CIDBox scan")
+        self.patch(channel, "find_channel_from_CIDBox", _no_scan)
+        d = channel.process_msgC(nB.db, msgCs[0], cidindex=cidindex)
+        def _processed((cid, seqnum, payload_s)):
+            self.failUnlessEqual((cid, seqnum), (entB2["id"], 1))
+            CIDKey = entB2["my_CID_key"].decode("hex")
+            next_CIDToken = channel.build_CIDToken(CIDKey, 2)
+            self.failUnlessEqual(cidindex.lookup(next_CIDToken),
+                                 (entB2["id"], 2))
+            row = nB.db.execute("SELECT next_CID_token FROM addressbook"
+                                " WHERE id=?", (entB2["id"],)).fetchone()
+            self.failUnlessEqual(row[0], next_CIDToken.encode("hex"))
+            # a new index picks up where this one left off
+            self.failUnlessEqual(
+                channel.CIDTokenIndex(nB.db).lookup(next_CIDToken),
+                (entB2["id"], 2))
+            return channel.process_msgC(nB.db, msgCs[1], cidindex=cidindex)
+        d.addCallback(_processed)
+        d.addCallback(lambda (cid, seqnum, payload_s):
+                      self.failUnlessEqual((cid, seqnum), (entB2["id"], 2)))
+        return d
+
+    def test_cidtoken_window(self):
+        nA, nB, entA, entB = self.make_connected_nodes()
+        cidindex = channel.CIDTokenIndex(nB.db, window=3)
+        CIDKey = entB["my_CID_key"].decode("hex")
+        token = lambda seqnum: channel.build_CIDToken(CIDKey, seqnum)
+        # only the next token is derived up front
+        self.failUnlessEqual(cidindex.get_stats()["tokens"], 1)
+        self.failUnlessEqual(cidindex.lookup(token(1)), (entB["id"], 1))
+        # the first miss fills the window, which covers a lost message
+        self.failUnlessEqual(cidindex.lookup(token(3)), (entB["id"], 3))
+        self.failUnlessEqual(cidindex.lookup(token(4)), (None, None))
+        self.failUnlessEqual(cidindex.get_stats()["tokens"], 3)
+        chan = channel.OutboundChannel(nA.db, entA["id"])
+        msgCs = [chan.createMsgC({"n": n}) for n in range(5)]
+        def _no_scan(db, CIDBox, keyring=None):
+            raise AssertionError("CIDBox scan")
+        self.patch(channel, "find_channel_from_CIDBox", _no_scan)
+        # messages 1 and 2 were lost, and so was 4
+        d = channel.process_msgC(nB.db, msgCs[2], cidindex=cidindex)
+        def _processed(res, expected_seqnum):
+            self.failUnlessEqual(res[:2], (entB["id"], expected_seqnum))
+        d.addCallback(_processed, 3)
+        d.addCallback(lambda _: channel.process_msgC(nB.db, msgCs[4],
+                                                     cidindex=cidindex))
+        d.addCallback(_processed, 5)
+        def _check(_):
+            # the window has slid, and old tokens are gone
+            self.failUnlessEqual(cidindex.lookup(token(3)), (None, None))
+            self.failUnlessEqual(cidindex.lookup(token(8)), (entB["id"], 8))
+            stats = cidindex.get_stats()
+            self.failUnlessEqual((stats["tokens"], stats["needs_refill"]),
+                                 (3, 0))
+        d.addCallback(_check)
+        return d
+
+    def test_cidbox_keyring(self):
+        nA, nB, entA, entB = self.make_connected_nodes()
+        entA2, entB2 = self.add_new_channel(nA, nB)
+        keyring = channel.CIDKeyring(nB.db)
+        msgC = channel.OutboundChannel(nA.db, entA2["id"]).createMsgC({})
+        CIDToken, CIDBox, msgD = channel.parse_msgC(msgC)
+        expected = channel.find_channel_from_CIDBox(nB.db, CIDBox)
+        self.failUnlessEqual(expected[0], entB2["id"])
+        def _no_sql(*args):
+            raise AssertionError("SQL during the scan")
+        no_sql = self.patch(nB.db, "execute", _no_sql)
+        self.failUnlessEqual(keyring.find(CIDBox), expected)
+        self.failUnlessEqual(channel.CIDKeyring(nA.db).find(CIDBox),
+                             (None, None))
+        self.failUnlessEqual(keyring.find("short"), (None, None))
+        keylist = keyring.get_keylist(entB2["id"])
+        self.failUnlessEqual([keyid[:2] for (privkey, keyid) in keylist],
+                             [(entB2["id"], "old"), (entB2["id"], "new")])
+        self.failUnlessEqual(keylist[1][0].encode().encode("hex"),
+                             entB2["my_new_channel_privkey"])
+        # the PrivateKeys are built once, and then kept
+        self.failUnlessIn(id(keylist[1][0]),
+                          [id(privkey)
+                           for (privkey, keyid) in keyring.get_keylist()])
+        self.failUnlessEqual(keyring.get_keylist(12345), None)
+        no_sql.restore()
+        d = channel.process_msgC(nB.db, msgC, keyring=keyring)
+        def _processed(_):
+            # the keyring has moved on, and sees the copy as a replay
+            self.failUnlessRaises(ReplayError, keyring.find, CIDBox)
+            # deleted contacts are dropped when the notice arrives
+            nB.db.delete("DELETE FROM addressbook WHERE id=?",
+                         (entB2["id"],), "addressbook", entB2["id"])
+            nB.db.commit()
+            return flushEventualQueue()
+        d.addCallback(_processed)
+        d.addCallback(lambda _: self.failUnlessEqual(keyring.find(CIDBox),
+                                                     (None, None)))
+        return d
+
+    def make_trial_msgD(self, pubkey):
+        privkey2 = PrivateKey.generate()
+        nonce = "\x00"*Box.NONCE_SIZE
+        msgD = (privkey2.public_key.encode()
+                + Box(privkey2, pubkey).encrypt("msgE", nonce))
+        return privkey2.public_key.encode(), msgD
+
+    def test_trial_decrypt(self):
+        keys = [PrivateKey.generate() for i in range(200)]
+        keylist = [(privkey, i) for (i, privkey) in enumerate(keys)]
+        pubkey2_s, msgD = self.make_trial_msgD(keys[10].public_key)
+        tried = []
+        class CountingBox(Box):
+            def __init__(self, *args):
+                tried.append(1)
+                Box.__init__(self, *args)
+        self.patch(channel, "Box", CountingBox)
+        # inline, the chunks run one after another, and once the first
+        # finds the key, the rest stop before trying any
+        e = CryptoExecutor()
+        results = []
+        channel.trial_decrypt_msgD(e, msgD, keylist).addCallback(
+            results.append)
+        self.failUnlessEqual(results, [(10, pubkey2_s, "msgE")])
+        self.failUnlessEqual(len(tried), 11)
+        self.failUnlessEqual(e.get_stats()["inline"], 4)
+
+        e = CryptoExecutor(2)
+        e.setServiceParent(self.sparent)
+        pubkey2_s, msgD = self.make_trial_msgD(keys[150].public_key)
+        d = channel.trial_decrypt_msgD(e, msgD, keylist)
+        d.addCallback(self.failUnlessEqual, (150, pubkey2_s, "msgE"))
+        unknown = PrivateKey.generate().public_key
+        d.addCallback(lambda _: channel.trial_decrypt_msgD(
+            e, self.make_trial_msgD(unknown)[1], keylist))
+        d.addCallback(self.failUnlessEqual, (None, None, None))
+        return d
+
+    def test_batch(self):
+        nA, nB, entA, entB = self.make_connected_nodes()
+        chan = channel.OutboundChannel(nA.db, entA["id"])
+        m = [chan.createMsgC({"n": n}) for n in range(1, 5)]
+        cidindex = channel.CIDTokenIndex(nB.db)
+        keyring = channel.CIDKeyring(nB.db)
+        commits = []
+        real_commit = nB.db.commit
+        def _commit():
+            commits.append(1)
+            real_commit()
+        self.patch(nB.db, "commit", _commit)
+        stored = []
+        def _before_commit(accepted):
+            self.failUnlessEqual(commits, [])
+            stored.extend(accepted)
+        # 3 overtakes 2, so 2 is too late, just as it would be on its own
+        batch = [m[0], m[2], "c0:garbage", m[1], m[3], m[3]]
+        d = channel.process_msgCs(nB.db, batch, cidindex=cidindex,
+                                  keyring=keyring,
+                                  before_commit=_before_commit)
+        def _processed(results):
+            self.failUnlessEqual(len(commits), 1)
+            self.failUnlessEqual(stored,
+                                 [r for r in results if isinstance(r, tuple)])
+            cid = entB["id"]
+            self.failUnlessEqual([r[:2] for r in stored],
+                                 [(cid, 1), (cid, 3), (cid, 4)])
+            self.failUnlessEqual(json.loads(stored[1][2]), {"n": 3})
+            self.failUnless(results[2].check(ValueError))
+            self.failUnless(results[3].check(ReplayError))
+            self.failUnless(results[5].check(ReplayError))
+            self.failUnlessEqual(self.get_inbound_seqnum(nB.db, cid), 4)
+            CIDKey = entB["my_CID_key"].decode("hex")
+            self.failUnlessEqual(cidindex.lookup(channel.build_CIDToken(
+                CIDKey, 5)), (cid, 5))
+            self.failUnlessRaises(ReplayError, keyring.find,
+                                  channel.parse_msgC(m[3])[1])
+        d.addCallback(_processed)
+        return d
+
+    def test_threaded_replay(self):
+        nA, nB, entA, entB = self.make_connected_nodes()
+        e = CryptoExecutor(2)
+        e.setServiceParent(self.sparent)
+        msgC = channel.OutboundChannel(nA.db, entA["id"]).createMsgC({"a":1})
+        # both copies are handed to the executor before either is recorded,
+        # so only the final seqnum check can catch the second one
+        d1 = channel.process_msgC(nB.db, msgC, e)
+        d2 = channel.process_msgC(nB.db, msgC, e)
+        results = []
+        d1.addBoth(results.append)
+        d2.addBoth(results.append)
+        d = defer.DeferredList([d1, d2])
+        def _then(_):
+            self.failUnlessEqual(len(results), 2)
+            successes = [r for r in results if isinstance(r, tuple)]
+            self.failUnlessEqual(len(successes), 1)
+            self.failUnlessEqual(successes[0][1], 1)
+            failures = [r for r in results if not isinstance(r, tuple)]
+            self.failUnless(failures[0].check(ReplayError))
+            self.failUnlessEqual(self.get_inbound_seqnum(nB.db, entB["id"]),
+                                 1)
+        d.addCallback(_then)
+        return d
 
 class Send(TwoNodeMixin, unittest.TestCase):
     def test_send(self):
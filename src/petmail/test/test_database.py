@@ -1,8 +1,9 @@
-import os.path
+import os.path, time, sqlite3
 from twisted.trial import unittest
 from common import BasedirMixin
 from ..eventual import flushEventualQueue
-from ..database import get_db, make_observable_db, DBError
+from ..database import (get_db, make_observable_db, get_schema, DBError,
+                        TARGET_VERSION)
 
 class Database(BasedirMixin, unittest.TestCase):
     def test_create(self):
@@ -11,7 +12,7 @@ class Database(BasedirMixin, unittest.TestCase):
         db = get_db(dbfile)
 
         row = db.execute("SELECT * FROM version").fetchone()
-        self.failUnlessEqual(row["version"], 1)
+        self.failUnlessEqual(row["version"], TARGET_VERSION)
 
     def test_create_failure(self):
         bad_dbfile = "missing/directory/test.db"
@@ -24,10 +25,11 @@ class Database(BasedirMixin, unittest.TestCase):
         dbfile = os.path.join(basedir, "test.db")
         db = get_db(dbfile)
 
-        db.execute("UPDATE version SET version=2")
+        future = TARGET_VERSION+1
+        db.execute("UPDATE version SET version=?", (future,))
         db.commit()
         err = self.failUnlessRaises(DBError, get_db, dbfile)
-        self.failUnlessEqual("Unable to handle db version 2",
+        self.failUnlessEqual("Unable to handle db version %d" % future,
                              str(err))
 
         db.execute("DROP TABLE version")
@@ -36,6 +38,91 @@ class Database(BasedirMixin, unittest.TestCase):
         self.failUnlessEqual("db file is unusable: no such table: version",
                              str(err))
 
+    def make_v1_db(self, dbfile):
+        db = sqlite3.connect(dbfile)
+        db.executescript(get_schema(1))
+        db.execute("INSERT INTO version (version) VALUES (?)", (1,))
+        return db
+
+    def test_upgrade_v1(self):
+        basedir = self.make_basedir()
+        dbfile = os.path.join(basedir, "test.db")
+        db = self.make_v1_db(dbfile)
+        msgC = "c0:" + "".join([chr(i) for i in range(256)])
+        db.execute("INSERT INTO mailbox_server_messages"
+                   " (tid, fetch_token, length, msgC) VALUES (?,?,?,?)",
+                   (3, "ab"*32, len(msgC), msgC.encode("hex")))
+        db.execute("INSERT INTO mailbox_server_transports (TTID) VALUES (?)",
+                   ("cd"*32,))
+        db.commit()
+        db.close()
+
+        db = get_db(dbfile)
+        row = db.execute("SELECT * FROM version").fetchone()
+        self.failUnlessEqual(row["version"], TARGET_VERSION)
+        rows = db.execute("SELECT * FROM mailbox_server_messages").fetchall()
+        self.failUnlessEqual(len(rows), 1)
+        self.failUnlessEqual(rows[0]["id"], 1)
+        self.failUnlessEqual(rows[0]["tid"], 3)
+        self.failUnlessEqual(rows[0]["fetch_token"], "ab"*32)
+        self.failUnlessEqual(rows[0]["length"], len(msgC))
+        self.failUnlessEqual(str(rows[0]["msgC"]), msgC)
+        # the indexes were rebuilt too
+        self.failUnlessRaises(sqlite3.IntegrityError, db.execute,
+                              "INSERT INTO mailbox_server_messages"
+                              " (fetch_token) VALUES (?)", ("ab"*32,))
+        # and ids keep counting up from where they were
+        db.execute("INSERT INTO mailbox_server_messages (tid) VALUES (4)")
+        rows = db.execute("SELECT id FROM mailbox_server_messages"
+                          " WHERE tid=4").fetchall()
+        self.failUnlessEqual(rows[0]["id"], 2)
+        # transports use the server's default quotas and retention
+        row = db.execute("SELECT * FROM mailbox_server_transports").fetchone()
+        self.failUnlessEqual((row["max_messages"], row["max_bytes"],
+                              row["retention"]), (None, None, None))
+        # and old messages start their retention period now
+        row = db.execute("SELECT arrived FROM mailbox_server_messages"
+                         " WHERE id=1").fetchone()
+        self.failUnless(abs(row["arrived"] - time.time()) < 60, row[0])
+
+    def test_upgrade_v1_deleted_ids(self):
+        # the newest message was deleted before the upgrade, and its id must
+        # not be handed out again afterwards
+        basedir = self.make_basedir()
+        dbfile = os.path.join(basedir, "test.db")
+        db = self.make_v1_db(dbfile)
+        for i in range(3):
+            db.execute("INSERT INTO mailbox_server_messages"
+                       " (tid, fetch_token, length, msgC) VALUES (?,?,?,?)",
+                       (3, "%064d" % i, 1, "00"))
+        db.execute("DELETE FROM mailbox_server_messages WHERE id=3")
+        db.commit()
+        db.close()
+
+        db = get_db(dbfile)
+        ids = [row["id"] for row in
+               db.execute("SELECT id FROM mailbox_server_messages")]
+        self.failUnlessEqual(sorted(ids), [1, 2])
+        c = db.execute("INSERT INTO mailbox_server_messages (tid)"
+                       " VALUES (4)")
+        self.failUnlessEqual(c.lastrowid, 4)
+
+    def test_upgrade_v1_empty(self):
+        # every message was deleted: there's nothing to copy, but the counter
+        # still carries over
+        basedir = self.make_basedir()
+        dbfile = os.path.join(basedir, "test.db")
+        db = self.make_v1_db(dbfile)
+        db.execute("INSERT INTO mailbox_server_messages (tid) VALUES (3)")
+        db.execute("DELETE FROM mailbox_server_messages")
+        db.commit()
+        db.close()
+
+        db = get_db(dbfile)
+        c = db.execute("INSERT INTO mailbox_server_messages (tid)"
+                       " VALUES (4)")
+        self.failUnlessEqual(c.lastrowid, 2)
+
     def test_coercion(self):
         # if sqlite doesn't recognize a column type in the schema, it
         # defaults to some curious value which attempts to automatically
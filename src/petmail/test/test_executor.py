@@ -0,0 +1,63 @@
+import threading
+from twisted.trial import unittest
+from twisted.application import service
+from nacl.public import PrivateKey, Box
+from ..executor import CryptoExecutor
+
+def which_thread():
+    return threading.current_thread()
+
+def fail():
+    raise ValueError("oops")
+
+class Executor(unittest.TestCase):
+    def setUp(self):
+        self.sparent = service.MultiService()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def test_inline(self):
+        e = CryptoExecutor()
+        e.setServiceParent(self.sparent)
+        results = []
+        e.run(which_thread).addCallback(results.append)
+        self.failUnlessEqual(results, [threading.current_thread()])
+        d = e.run(fail)
+        self.failUnlessFailure(d, ValueError)
+        d.addCallback(lambda _: self.failUnlessEqual(e.get_stats()["inline"],
+                                                     2))
+        return d
+
+    def test_threads(self):
+        e = CryptoExecutor(2)
+        e.setServiceParent(self.sparent)
+        d = e.run(which_thread)
+        def _ran(t):
+            self.failIfEqual(t, threading.current_thread())
+            return self.failUnlessFailure(e.run(fail), ValueError)
+        d.addCallback(_ran)
+        def _crypto(_):
+            privkey = PrivateKey.generate()
+            box = Box(privkey, privkey.public_key)
+            nonce = "\x00"*Box.NONCE_SIZE
+            return e.run(box.encrypt, "hello", nonce)
+        d.addCallback(_crypto)
+        def _stats(boxed):
+            self.failUnlessEqual(len(boxed), 24+16+5)
+            stats = e.get_stats()
+            self.failUnlessEqual(stats["threads"], 2)
+            self.failUnlessEqual(stats["completed"], 3)
+            self.failUnlessEqual(stats["queued"], 0)
+            self.failUnlessEqual(stats["active"], 0)
+            self.failUnless(stats["max_queued"] >= 1)
+            self.failUnlessEqual(stats["inline"], 0)
+        d.addCallback(_stats)
+        return d
+
+    def test_stopped(self):
+        # before the executor starts (or after it stops), work runs inline
+        e = CryptoExecutor(2)
+        results = []
+        e.run(which_thread).addCallback(results.append)
+        self.failUnlessEqual(results, [threading.current_thread()])
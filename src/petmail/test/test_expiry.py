@@ -0,0 +1,80 @@
+import os
+from twisted.trial import unittest
+from twisted.internet import task
+from .common import BasedirMixin
+from ..database import make_observable_db
+from ..mailbox.expiry import ExpirySweeper
+from ..mailbox.store import SQLiteMessageStore
+from ..mailbox.transports import TransportRegistry
+
+class Expiry(BasedirMixin, unittest.TestCase):
+    def setUp(self):
+        dbfile = os.path.join(self.make_basedir(), "test.db")
+        self.db = make_observable_db(dbfile)
+        self.now = 1000
+        self.store = SQLiteMessageStore(self.db, clock=lambda: self.now)
+        self.transports = TransportRegistry(self.db)
+
+    def add_transport(self, retention=None):
+        tid = self.db.insert("INSERT INTO mailbox_server_transports"
+                             " (TTID, TT0, retention) VALUES (?,?,?)",
+                             (os.urandom(32).encode("hex"), "00", retention))
+        self.db.commit()
+        return tid
+
+    def remaining(self):
+        return [msgid for (arrived, msgid, tid, length)
+                in self.store.list_old_messages(self.now+1)]
+
+    def test_sweep(self):
+        tid1 = self.add_transport()
+        tid2 = self.add_transport(retention=50)
+        self.store.add_message(tid1, "old1")
+        self.store.add_message(tid2, "old2")
+        self.now = 1060
+        new1 = self.store.add_message(tid1, "new1")
+        self.store.add_message(tid2, "new2")
+        self.store.commit()
+        self.now = 1120
+        clock = task.Clock()
+        s = ExpirySweeper(self.store, self.db, self.transports, 100,
+                          batch_size=1, clock=lambda: self.now,
+                          reactor=clock)
+        reports = []
+        s.sweep().addCallback(reports.append)
+        # one batch at a time, with a trip through the reactor in between
+        self.failUnlessEqual(len(self.remaining()), 3)
+        self.failUnless(s.get_stats()["sweeping"])
+        # a second sweep() waits for the running one
+        s.sweep().addCallback(reports.append)
+        for i in range(3):
+            clock.advance(0)
+        self.failUnlessEqual(reports,
+                             [{"messages": 3, "bytes": 12,
+                               "transports": {tid1: 1, tid2: 2}}]*2)
+        self.failUnlessEqual(self.remaining(), [new1])
+        stats = s.get_stats()
+        self.failUnlessEqual((stats["sweeps"], stats["expired_messages"],
+                              stats["expired_bytes"], stats["sweeping"]),
+                             (1, 3, 12, False))
+
+    def test_keep_forever(self):
+        tid1 = self.add_transport()
+        self.store.add_message(tid1, "msgC1")
+        self.store.commit()
+        self.now = 100000
+        s = ExpirySweeper(self.store, self.db, self.transports, None)
+        reports = []
+        s.sweep().addCallback(reports.append)
+        self.failUnlessEqual(reports, [{"messages": 0, "bytes": 0,
+                                        "transports": {}}])
+        self.failUnlessEqual(len(self.remaining()), 1)
+        # unless the transport says otherwise
+        tid2 = self.add_transport(retention=3600)
+        self.store.add_message(tid2, "msgC2")
+        self.store.commit()
+        self.now += 3601
+        s.sweep().addCallback(reports.append)
+        self.failUnlessEqual(reports[-1], {"messages": 1, "bytes": 5,
+                                           "transports": {tid2: 1}})
+        self.failUnlessEqual(len(self.remaining()), 1)
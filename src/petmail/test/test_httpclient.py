@@ -0,0 +1,78 @@
+from twisted.trial import unittest
+from twisted.application import service, strports
+from twisted.internet import defer
+from twisted.web import server, resource, static, error
+from .. import util
+from ..httpclient import HTTPClient
+from .pollmixin import PollMixin
+
+class Slow(resource.Resource):
+    isLeaf = True
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.waiting = []
+    def render_GET(self, request):
+        self.waiting.append(request)
+        return server.NOT_DONE_YET
+
+class Client(PollMixin, unittest.TestCase):
+    def setUp(self):
+        self.sparent = service.MultiService()
+        self.sparent.startService()
+        root = resource.Resource()
+        root.putChild("hello", static.Data("Hello\n", "text/plain"))
+        self.slow = Slow()
+        root.putChild("slow", self.slow)
+        port = util.allocate_port()
+        s = strports.service("tcp:%d:interface=127.0.0.1" % port,
+                             server.Site(root))
+        s.setServiceParent(self.sparent)
+        self.baseurl = "http://127.0.0.1:%d/" % port
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def test_pool(self):
+        c = HTTPClient()
+        c.setServiceParent(self.sparent)
+        d = c.getPage(self.baseurl+"hello")
+        d.addCallback(lambda body: self.failUnlessEqual(body, "Hello\n"))
+        d.addCallback(lambda _: c.getPage(self.baseurl+"hello", method="POST",
+                                          postdata="ignored"))
+        d = self.failUnlessFailure(d, error.Error)
+        d.addCallback(lambda e: self.failUnlessEqual(e.status, "405"))
+        d.addCallback(lambda _: c.getPage(self.baseurl+"hello"))
+        def _then(_):
+            # all three requests used the same connection
+            stats = c.get_stats()
+            self.failUnlessEqual(stats["requests"], 3)
+            self.failUnlessEqual(stats["failed"], 1)
+            self.failUnlessEqual(stats["connections_opened"], 1)
+            self.failUnlessEqual(stats["idle_connections"], 1)
+        d.addCallback(_then)
+        return d
+
+    def test_per_host_limit(self):
+        c = HTTPClient(max_per_host=2)
+        c.setServiceParent(self.sparent)
+        dl = [c.getPage(self.baseurl+"slow") for i in range(3)]
+        d = self.poll(lambda: len(self.slow.waiting) == 2)
+        def _then1(_):
+            stats = c.get_stats()
+            self.failUnlessEqual(stats["active"], 2)
+            self.failUnlessEqual(stats["queued"], 1)
+            # finishing one lets the next one start
+            request = self.slow.waiting.pop(0)
+            request.write("done")
+            request.finish()
+            return self.poll(lambda: len(self.slow.waiting) == 2)
+        d.addCallback(_then1)
+        def _then2(_):
+            self.failUnlessEqual(c.get_stats()["queued"], 0)
+            for request in self.slow.waiting:
+                request.write("done")
+                request.finish()
+            return defer.gatherResults(dl)
+        d.addCallback(_then2)
+        d.addCallback(lambda bodies: self.failUnlessEqual(bodies,
+                                                          ["done"]*3))
+        return d
@@ -0,0 +1,120 @@
+import os
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.web.test.test_web import DummyRequest # not exactly stable
+from .common import BasedirMixin, TwoNodeMixin
+from .. import metrics
+from ..database import make_observable_db
+from ..web import MetricsResource
+
+class Registry(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.r = metrics.Registry(clock=lambda: self.now)
+
+    def test_disabled(self):
+        c = self.r.counter("requests_total", "requests")
+        h = self.r.histogram("latency_seconds", "latency")
+        c.inc()
+        started = h.start()
+        self.failUnlessEqual(started, None)
+        h.stop(started)
+        self.failUnlessEqual((c.value, h.count), (0, 0))
+        self.r.enable()
+        c.inc()
+        self.failUnlessEqual(c.value, 1)
+
+    def test_render(self):
+        self.r.enable()
+        c = self.r.counter("requests_total", "requests", ["resource"])
+        c.labels("fetch").inc()
+        c.labels("list").inc(2)
+        c.labels("fetch").inc()
+        g = self.r.gauge("depth", "queue depth", fn=lambda: 7)
+        h = self.r.histogram("latency_seconds", "latency", buckets=(0.1, 1))
+        started = h.start()
+        self.now += 0.5
+        h.stop(started)
+        h.observe(0.1)
+        h.observe(3)
+        self.failUnlessIdentical(self.r.gauge("depth", "queue depth"), g)
+        self.failUnlessEqual(self.r.render().splitlines(), [
+            '# HELP depth queue depth',
+            '# TYPE depth gauge',
+            'depth 7',
+            '# HELP latency_seconds latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            'latency_seconds_sum 3.6',
+            'latency_seconds_count 3',
+            '# HELP requests_total requests',
+            '# TYPE requests_total counter',
+            'requests_total{resource="fetch"} 2',
+            'requests_total{resource="list"} 2',
+            ])
+
+    def test_escape(self):
+        self.r.enable()
+        g = self.r.gauge("g", "help", ["name"])
+        g.labels('a "b"\\\n').set(1)
+        self.failUnlessIn('g{name="a \\"b\\"\\\\\\n"} 1',
+                          self.r.render().splitlines())
+
+    def test_set_function(self):
+        self.r.enable()
+        g = self.r.gauge("depth", "queue depth", ["queue"])
+        g.labels("a").set_function(lambda: 3)
+        g.labels("a").set_function(lambda: 4)
+        self.failUnlessIn('depth{queue="a"} 4', self.r.render().splitlines())
+
+    def test_track(self):
+        self.r.enable()
+        h = self.r.histogram("latency_seconds", "latency")
+        d = defer.Deferred()
+        self.failUnlessIdentical(h.track(d), d)
+        self.now += 2
+        d.errback(ValueError())
+        self.failUnlessFailure(d, ValueError)
+        self.failUnlessEqual((h.count, h.sum), (1, 2.0))
+        return d
+
+class Instrumented(BasedirMixin, unittest.TestCase):
+    def setUp(self):
+        metrics.registry.enable()
+        self.addCleanup(metrics.registry.disable)
+
+    def test_database(self):
+        dbfile = os.path.join(self.make_basedir(), "test.db")
+        db = make_observable_db(dbfile)
+        h = metrics.registry.metrics["petmail_db_seconds"]
+        before = h.labels("execute").count, h.labels("commit").count
+        db.execute("SELECT * FROM node").fetchall()
+        db.commit()
+        self.failUnlessEqual((h.labels("execute").count,
+                              h.labels("commit").count),
+                             (before[0]+1, before[1]+1))
+        req = DummyRequest([])
+        out = MetricsResource(metrics.registry).render_GET(req)
+        self.failUnlessEqual(req.responseHeaders.getRawHeaders("content-type"),
+                             ["text/plain; version=0.0.4"])
+        lines = out.splitlines()
+        self.failUnlessIn("# TYPE petmail_db_seconds histogram", lines)
+        self.failUnlessIn('petmail_db_seconds_count{method="execute"} %d'
+                          % (before[0]+1), lines)
+        self.failUnlessIn("# TYPE petmail_eventual_queue_depth gauge", lines)
+
+class NodeGauges(TwoNodeMixin, unittest.TestCase):
+    def test_node(self):
+        # the gauges follow whichever node was built last
+        n = self.make_nodes()[1]
+        self.patch(n.executor, "get_stats",
+                   lambda: {"queued": 5, "active": 2, "threads": 4})
+        lines = metrics.registry.render().splitlines()
+        self.failUnlessIn('petmail_executor_tasks{state="queued"} 5', lines)
+        self.failUnlessIn('petmail_executor_tasks{state="active"} 2', lines)
+        self.failUnlessIn("petmail_executor_threads 4", lines)
+        self.failUnlessIn('petmail_http_requests{state="active"} 0', lines)
+        self.failUnlessIn('petmail_http_requests{state="queued"} 0', lines)
+        self.failUnlessIn("petmail_http_idle_connections 0", lines)
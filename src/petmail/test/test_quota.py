@@ -0,0 +1,71 @@
+import os
+from twisted.trial import unittest
+from .common import BasedirMixin
+from ..database import make_observable_db
+from ..eventual import flushEventualQueue
+from ..mailbox.quota import QuotaTracker, QuotaExceeded
+from ..mailbox.store import SQLiteMessageStore
+from ..mailbox.transports import Transport
+
+class FakeTransports:
+    def __init__(self):
+        self.transports = {}
+    def get(self, tid):
+        return self.transports.get(tid)
+
+class Quota(BasedirMixin, unittest.TestCase):
+    def make_store(self):
+        dbfile = os.path.join(self.make_basedir(), "test.db")
+        return SQLiteMessageStore(make_observable_db(dbfile))
+
+    def test_limits(self):
+        s = self.make_store()
+        m1 = s.add_message(1, "msgC1")
+        s.add_message(1, "msgC2")
+        s.commit()
+        q = QuotaTracker(s, FakeTransports(), max_messages=2,
+                         retry_after=60)
+        changes = []
+        q.subscribe(lambda tid, full: changes.append((tid, full)))
+        # existing messages count
+        e = self.failUnlessRaises(QuotaExceeded, q.check, 1)
+        self.failUnlessEqual(e.retry_after, 60)
+        q.check(2)
+        s.delete_message(m1)
+        s.commit()
+        d = flushEventualQueue()
+        def _then(_):
+            q.check(1)
+            self.failUnlessEqual(changes, [(1, False)])
+            q.charge(1, 10)
+            self.failUnlessRaises(QuotaExceeded, q.check, 1)
+            # a failed commit gives it back
+            q.refund(1, 10)
+            q.check(1)
+            self.failUnlessEqual(changes, [(1, False), (1, True), (1, False)])
+            self.failUnlessEqual(q.get_stats(),
+                                 {"transports": 1, "messages": 1, "bytes": 5,
+                                  "full": 0})
+        d.addCallback(_then)
+        return d
+
+    def test_override(self):
+        transports = FakeTransports()
+        transports.transports[2] = Transport(2, "TTID", "TT0", "RT", "key",
+                                             None, 10, None)
+        q = QuotaTracker(self.make_store(), transports, max_messages=100)
+        q.charge(1, 50)
+        q.charge(2, 6)
+        q.check(2)
+        q.charge(2, 6)
+        self.failUnlessRaises(QuotaExceeded, q.check, 2)
+        # the server-wide limit on bytes is unlimited
+        q.check(1)
+        self.failUnlessEqual(q.get_usage(2),
+                             {"messages": 2, "bytes": 12,
+                              "max_messages": 100, "max_bytes": 10,
+                              "full": True})
+        self.failUnlessEqual(q.get_usage(3),
+                             {"messages": 0, "bytes": 0,
+                              "max_messages": 100, "max_bytes": None,
+                              "full": False})
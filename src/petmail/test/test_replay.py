@@ -0,0 +1,59 @@
+import os
+from twisted.trial import unittest
+from .common import BasedirMixin
+from ..database import make_observable_db
+from ..mailbox.replay import ReplayCache, ReplayCacheFull
+
+class Replay(BasedirMixin, unittest.TestCase):
+    def test_expire(self):
+        rc = ReplayCache(300, bucket_size=60)
+        now = 1000000
+        rc.add("old", now-290, now)
+        rc.add("new", now+290, now)
+        self.failUnless("old" in rc)
+        self.failUnless("new" in rc)
+        self.failIf("other" in rc)
+        self.failUnlessEqual(len(rc), 2)
+        # "old" stays until its timestamp is outside the window
+        rc.prune(now+5)
+        self.failUnless("old" in rc)
+        rc.prune(now+120)
+        self.failIf("old" in rc)
+        self.failUnless("new" in rc)
+        rc.prune(now+600)
+        self.failUnless("new" in rc)
+        rc.prune(now+660)
+        self.failUnlessEqual(len(rc), 0)
+        self.failUnlessEqual(rc.buckets, {})
+
+    def test_full(self):
+        rc = ReplayCache(300, bucket_size=60, max_entries=2)
+        now = 1000000
+        rc.add("one", now, now)
+        rc.add("two", now, now)
+        self.failUnlessRaises(ReplayCacheFull, rc.add, "three", now, now)
+        self.failIf("three" in rc)
+        # add() expires old entries itself, so room appears eventually
+        rc.add("three", now+400, now+400)
+        self.failUnlessEqual(len(rc), 1)
+
+    def test_persist(self):
+        dbfile = os.path.join(self.make_basedir(), "test.db")
+        db = make_observable_db(dbfile)
+        now = 1000000
+        rc = ReplayCache(300, db=db, now=now)
+        rc.add("one", now, now)
+        rc.add("two", now, now)
+        rc.add("three", now+200, now)
+        # a new server (e.g. after a restart) knows about them
+        rc2 = ReplayCache(300, db=db, now=now+100)
+        self.failUnlessEqual(len(rc2), 3)
+        self.failUnless("two" in rc2)
+        # and expired ones are removed from the table too
+        rc2.prune(now+400)
+        self.failUnlessEqual(len(rc2), 1)
+        rows = db.execute("SELECT * FROM retrieval_replay_tokens").fetchall()
+        self.failUnlessEqual([row["pubkey"] for row in rows],
+                             ["three".encode("hex")])
+        rc3 = ReplayCache(300, db=db, now=now+600)
+        self.failUnlessEqual(len(rc3), 0)
@@ -1,10 +1,14 @@
 import os
 from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.python import failure
 from nacl.public import PrivateKey
 from nacl.secret import SecretBox
 from nacl.exceptions import CryptoError
 from ..eventual import flushEventualQueue
 from ..mailbox import server, retrieval
+from ..netstring import netstring
+from ..errors import ReplayError
 from .common import flip_bit, TwoNodeMixin
 
 class Roundtrip(unittest.TestCase):
@@ -13,8 +17,28 @@ class Roundtrip(unittest.TestCase):
         RT = "01234567" # 8 bytes
         req, tmppub = retrieval.encrypt_list_request(serverkey.public_key.encode(), RT)
         got_tmppub, boxed0 = server.decrypt_list_request_1(req)
-        ts, got_RT = server.decrypt_list_request_2(got_tmppub, boxed0, serverkey)
+        ts, got_RT, options = server.decrypt_list_request_2(got_tmppub,
+                                                            boxed0, serverkey)
         self.failUnlessEqual(RT, got_RT)
+        self.failUnlessEqual(options, {})
+
+        req, tmppub = retrieval.encrypt_list_request(
+            serverkey.public_key.encode(), RT, options={"cursor": "abc"})
+        got_tmppub, boxed0 = server.decrypt_list_request_1(req)
+        ts, got_RT, options = server.decrypt_list_request_2(got_tmppub,
+                                                            boxed0, serverkey)
+        self.failUnlessEqual(RT, got_RT)
+        self.failUnlessEqual(options, {"cursor": "abc"})
+
+    def test_list_cursor(self):
+        sbox = SecretBox(os.urandom(32))
+        cursor = server.create_list_cursor(sbox, 1234)
+        self.failUnlessEqual(server.parse_list_cursor(sbox, cursor), 1234)
+        # cursors from other transports, or garbage, mean "start over"
+        other = server.create_list_cursor(SecretBox(os.urandom(32)), 1234)
+        self.failUnlessEqual(server.parse_list_cursor(sbox, other), 0)
+        self.failUnlessEqual(server.parse_list_cursor(sbox, "garbage!"), 0)
+        self.failUnlessEqual(server.parse_list_cursor(sbox, ""), 0)
 
     def test_list_entry(self):
         symkey = os.urandom(32)
@@ -33,6 +57,25 @@ class Roundtrip(unittest.TestCase):
         got_msgC = retrieval.decrypt_fetch_response(symkey, fetch_token, msg)
         self.failUnlessEqual(got_msgC, "message C")
 
+    def test_inline_entry(self):
+        symkey = os.urandom(32)
+        tmppub = PrivateKey.generate().public_key.encode()
+        entry, delete_token = server.create_inline_entry(SecretBox(symkey),
+                                                         tmppub, "message C")
+        got_delete_token, got_msgC = retrieval.decrypt_inline_entry(
+            entry, symkey, tmppub)
+        self.failUnlessEqual(got_delete_token, delete_token)
+        self.failUnlessEqual(got_msgC, "message C")
+        other = PrivateKey.generate().public_key.encode()
+        self.failUnlessRaises(retrieval.WrongPubkeyError,
+                              retrieval.decrypt_inline_entry,
+                              entry, symkey, other)
+        # a regular list entry is not an inline one
+        entry2 = server.create_list_entry(symkey, tmppub, 1234)[0]
+        self.failUnlessRaises(retrieval.NotInlineEntryError,
+                              retrieval.decrypt_inline_entry,
+                              entry2, symkey, tmppub)
+
 class More(unittest.TestCase):
     def test_list_request(self):
         now = 1379304213
@@ -50,7 +93,8 @@ class More(unittest.TestCase):
         self.failUnlessEqual(got_tmppub, tmppriv.public_key.encode())
         self.failUnlessEqual(boxed0.encode("hex"),
                              "c4e48bcd33137dfecd5f1cc7ec4f42db7424666235642a7eb23090dcbe8aaaae")
-        ts, got_RT = server.decrypt_list_request_2(got_tmppub, boxed0, serverkey)
+        ts, got_RT, options = server.decrypt_list_request_2(got_tmppub,
+                                                            boxed0, serverkey)
         self.failUnlessEqual(ts, now)
         self.failUnlessEqual(RT, got_RT)
 
@@ -119,6 +163,205 @@ class More(unittest.TestCase):
                               retrieval.decrypt_fetch_response,
                               symkey, fetch_token, flip_bit(msg))
 
+class FakeHTTP:
+    def __init__(self):
+        self.requests = []
+    def getPage(self, url, method="GET", postdata=None):
+        d = defer.Deferred()
+        self.requests.append((url, postdata, d))
+        return d
+
+class Pipeline(unittest.TestCase):
+    def test_in_order(self):
+        symkey = os.urandom(32)
+        desc = {"baseurl": "http://example.invalid/retrieval/",
+                "retrieval_pubkey": ("\x00"*32).encode("hex"),
+                "retrieval_symkey": symkey.encode("hex"),
+                "RT": ("\x00"*8).encode("hex")}
+        messages = []
+        http = FakeHTTP()
+        r = retrieval.HTTPRetriever(desc, messages.append, http)
+        r.source.deactivate()
+        r.startService()
+        self.addCleanup(r.stopService)
+        entries = [("F%031d" % i, "D%031d" % i, 10, None) for i in range(6)]
+        # the cursor from an event is adopted once its last entry is handled
+        entries[2] = entries[2][:3] + ("cursor1",)
+        r.fetchable.extend(entries)
+        done = r.fetch(None)
+        # two fetches at once, with the backlog split between them
+        self.failUnlessEqual(len(http.requests), 2)
+        self.failUnlessEqual(r.get_stats()["in_flight"], 2)
+        def respond((url, postdata, d), which):
+            self.failUnless(url.endswith("fetch-batch?acks=0"), url)
+            self.failUnlessEqual(postdata, "".join([entries[i][0]
+                                                    for i in which]))
+            d.callback("".join([netstring(server.encrypt_fetch_response(
+                symkey, entries[i][0], "msgC%d" % i)) for i in which]))
+        # the second batch can arrive first, but is held until the first
+        respond(http.requests[1], [3,4,5])
+        self.failUnlessEqual(messages, [])
+        self.failUnlessEqual(r.cursor, "")
+        respond(http.requests[0], [0,1,2])
+        stats = r.get_stats()
+        self.failUnlessEqual(stats["messages"], 6)
+        self.failUnlessEqual(stats["batches"], 2)
+        self.failUnlessEqual(stats["in_flight"], 0)
+        d = flushEventualQueue()
+        def _then(_):
+            self.failUnlessEqual(messages, ["msgC%d" % i for i in range(6)])
+            # nothing left to fetch, so the acks go out on their own
+            self.failUnlessEqual(len(http.requests), 3)
+            url, postdata, d1 = http.requests[2]
+            self.failUnless(url.endswith("delete-batch"), url)
+            self.failUnlessEqual(postdata, "".join([e[1] for e in entries]))
+            # the cursor waits until those messages are really gone
+            self.failUnlessEqual(r.cursor, "")
+            d1.callback("")
+            self.failUnlessEqual(r.acks, [])
+            self.failUnlessEqual(r.cursor, "cursor1")
+            return done
+        d.addCallback(_then)
+        return d
+
+    def test_batched(self):
+        symkey = os.urandom(32)
+        desc = {"baseurl": "http://example.invalid/retrieval/",
+                "retrieval_pubkey": ("\x00"*32).encode("hex"),
+                "retrieval_symkey": symkey.encode("hex"),
+                "RT": ("\x00"*8).encode("hex")}
+        calls = []
+        def got_msgCs(msgCs):
+            calls.append(msgCs)
+            # the middle one is a replay, which is logged but still deleted
+            return [("cid", 1, msgCs[0]), failure.Failure(ReplayError()),
+                    ("cid", 2, msgCs[2])]
+        http = FakeHTTP()
+        r = retrieval.HTTPRetriever(desc, None, http, got_msgCs=got_msgCs)
+        r.source.deactivate()
+        r.startService()
+        self.addCleanup(r.stopService)
+        entries = [("F%031d" % i, "D%031d" % i, 10, None) for i in range(3)]
+        entries[2] = entries[2][:3] + ("cursor1",)
+        r.fetchable.extend(entries)
+        # one fetch, so the whole backlog arrives as a single batch
+        r.window = 1
+        done = r.fetch(None)
+        self.failUnlessEqual(len(http.requests), 1)
+        url, postdata, d = http.requests[0]
+        d.callback("".join([netstring(server.encrypt_fetch_response(
+            symkey, e[0], "msgC%d" % i)) for (i, e) in enumerate(entries)]))
+        d = flushEventualQueue()
+        def _then(_):
+            self.failUnlessEqual(calls, [["msgC0", "msgC1", "msgC2"]])
+            self.failUnlessEqual(len(self.flushLoggedErrors(ReplayError)), 1)
+            self.failUnlessEqual(len(http.requests), 2)
+            url, postdata, d1 = http.requests[1]
+            self.failUnless(url.endswith("delete-batch"), url)
+            self.failUnlessEqual(postdata, "".join([e[1] for e in entries]))
+            d1.callback("")
+            self.failUnlessEqual(r.cursor, "cursor1")
+            return done
+        d.addCallback(_then)
+        return d
+
+    def make_retriever(self, messages):
+        symkey = os.urandom(32)
+        desc = {"baseurl": "http://example.invalid/retrieval/",
+                "retrieval_pubkey": PrivateKey.generate().public_key.encode(
+                    ).encode("hex"),
+                "retrieval_symkey": symkey.encode("hex"),
+                "RT": ("\x00"*8).encode("hex")}
+        http = FakeHTTP()
+        r = retrieval.HTTPRetriever(desc, messages.append, http)
+        r.source.deactivate()
+        r.startService()
+        self.addCleanup(r.stopService)
+        def respond(i, entry, msgC):
+            url, postdata, d = http.requests[i]
+            self.failUnless(url.endswith("fetch-batch?acks=0"), url)
+            d.callback(netstring(server.encrypt_fetch_response(
+                symkey, entry[0], msgC)))
+        return r, http, respond
+
+    def announce(self, r, entry):
+        # a list event, minus the encryption
+        r.fetchable.append(entry)
+        r.handle_SSE("data", "")
+
+    def test_announce_during_delete(self):
+        messages = []
+        r, http, respond = self.make_retriever(messages)
+        entries = [("F%031d" % i, "D%031d" % i, 10, None) for i in range(2)]
+        entries[0] = entries[0][:3] + ("cursor0",)
+        self.announce(r, entries[0])
+        respond(0, entries[0], "msgC0")
+        d = flushEventualQueue()
+        def _deleting(_):
+            self.failUnlessEqual(messages, ["msgC0"])
+            url, postdata, d1 = http.requests[1]
+            self.failUnless(url.endswith("delete-batch"), url)
+            # a new message is announced while the delete is outstanding
+            self.announce(r, entries[1])
+            self.failUnlessEqual(len(http.requests), 3)
+            self.failUnlessEqual(r.acks, [])
+            respond(2, entries[1], "msgC1")
+            d1.callback("")
+            self.failUnlessEqual(r.cursor, "cursor0")
+            return flushEventualQueue()
+        d.addCallback(_deleting)
+        def _fetched(_):
+            self.failUnlessEqual(messages, ["msgC0", "msgC1"])
+            self.failUnlessEqual(len(r.pipeline), 0)
+            # and only the second message is left to delete
+            url, postdata, d2 = http.requests[3]
+            self.failUnless(url.endswith("delete-batch"), url)
+            self.failUnlessEqual(postdata, entries[1][1])
+            d2.callback("")
+            self.failUnlessEqual(r.acks, [])
+            self.failUnlessEqual(r.fetching, None)
+        d.addCallback(_fetched)
+        return d
+
+    def test_cursor_waits_for_delete(self):
+        messages = []
+        r, http, respond = self.make_retriever(messages)
+        entry = ("F%031d" % 0, "D%031d" % 0, 10, "cursor0")
+        self.announce(r, entry)
+        respond(0, entry, "msgC0")
+        d = flushEventualQueue()
+        def _reconnect(_):
+            self.failUnlessEqual(messages, ["msgC0"])
+            url, postdata, d1 = http.requests[1]
+            self.failUnless(url.endswith("delete-batch"), url)
+            # reconnecting now revokes that delete token, so the new list
+            # request must not skip past the message
+            r.start_source()
+            self.failUnlessEqual(r.cursor, "")
+            d1.callback("")
+            self.failUnlessEqual(r.cursor, "")
+        d.addCallback(_reconnect)
+        return d
+
+    def test_window(self):
+        desc = {"baseurl": "http://example.invalid/retrieval/",
+                "retrieval_pubkey": ("\x00"*32).encode("hex"),
+                "retrieval_symkey": ("\x00"*32).encode("hex"),
+                "RT": ("\x00"*8).encode("hex")}
+        r = retrieval.HTTPRetriever(desc, None, FakeHTTP())
+        self.failUnlessEqual(r.window, 2)
+        # fetches that come back as quickly as ever open the window
+        for i in range(10):
+            r.fetch_finished(0.1, 1, 100)
+        self.failUnlessEqual(r.window, retrieval.MAX_FETCH_WINDOW)
+        # slow ones mean we're just queueing, so it closes quickly
+        r.fetch_finished(0.5, 1, 100)
+        self.failUnlessEqual(r.window, retrieval.MAX_FETCH_WINDOW//2)
+        for i in range(10):
+            r.fetch_finished(0.5, 1, 100)
+        self.failUnlessEqual(r.window, 1)
+        self.failUnlessEqual(r.get_stats()["bytes"], 2100)
+
 class Server(TwoNodeMixin, unittest.TestCase):
 
     def test_retrieval_client(self): # TODO: err here, eventsource.py#L166 assert
@@ -155,8 +398,14 @@ class Server(TwoNodeMixin, unittest.TestCase):
         d.addCallback(_then1)
         def _then2(_):
             self.failUnlessEqual(messages[2], "msgC1_third")
+            # we haven't needed a cursor: we stayed connected, and the new
+            # message was announced on our first list request
+            self.failUnlessEqual(len(ms.listres.old_requests), 1)
         d.addCallback(_then2)
         d.addCallback(lambda _: self.poll(_messages_deleted))
+        # but once the server has deleted them, the server's cursor lets our
+        # next list request skip them
+        d.addCallback(lambda _: self.poll(lambda: bool(r.cursor)))
 
         # wait for the ReconnectingEventSource to become active again, which
         # indicates that HTTPRetriever.fetch has finished grabbing all
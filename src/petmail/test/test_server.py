@@ -1,13 +1,25 @@
-import json, copy, base64, time
+import os, json, copy, base64, time
+from StringIO import StringIO
 from twisted.trial import unittest
-from twisted.web import http, client
+from twisted.web import http, client, error
+from twisted.web.http_headers import Headers
 from twisted.web.test.test_web import DummyRequest # not exactly stable
-from twisted.internet import defer
-from .common import TwoNodeMixin
-from .. import rrid, eventsource
-from ..database import Notice
+from twisted.web.test.requesthelper import DummyChannel
+from twisted.internet import defer, task
+from twisted.internet.error import ConnectionDone
+from twisted.python import failure
+from twisted.test.proto_helpers import StringTransport
+from .common import TwoNodeMixin, ShouldFailMixin
+from .. import rrid, eventsource, util
+from ..executor import CryptoExecutor
+from ..database import Notice, make_observable_db
 from ..eventual import flushEventualQueue
 from ..mailbox import delivery, retrieval
+from ..mailbox.ingest import GroupCommitter
+from ..mailbox.store import SQLiteMessageStore
+from ..mailbox.transports import TransportRegistry
+from ..netstring import split_netstrings
+from ..web import LimitedRequest
 from .test_eventsource import parse_events
 
 class Inbound(TwoNodeMixin, unittest.TestCase):
@@ -74,7 +86,7 @@ class Inbound(TwoNodeMixin, unittest.TestCase):
             self.failUnlessEqual(len(messages), 1)
             self.failUnlessEqual(messages[0]["tid"], tid)
             self.failUnlessEqual(messages[0]["length"], len(msgC))
-            self.failUnlessEqual(messages[0]["msgC"].decode("hex"), msgC)
+            self.failUnlessEqual(str(messages[0]["msgC"]), msgC)
         d.addCallback(_then)
         return d
 
@@ -96,25 +108,427 @@ class Inbound(TwoNodeMixin, unittest.TestCase):
                              " WHERE tid=?", (tid1,))
             messages = c.fetchall()
             self.failUnlessEqual(len(messages), 1)
-            self.failUnlessEqual(messages[0]["msgC"].decode("hex"), "msgC1")
+            self.failUnlessEqual(str(messages[0]["msgC"]), "msgC1")
 
             c = n.db.execute("SELECT * FROM mailbox_server_messages"
                              " WHERE tid=?", (tid2,))
             messages = c.fetchall()
             self.failUnlessEqual(len(messages), 1)
-            self.failUnlessEqual(messages[0]["msgC"].decode("hex"), "msgC2")
+            self.failUnlessEqual(str(messages[0]["msgC"]), "msgC2")
         d.addCallback(_then)
         return d
 
-def do_request(resource, t=None, method="GET"):
+    def test_post(self):
+        n = self.make_nodes(transport="local")[1]
+        tid, trec = self.add_recipient(n)
+        r = n.web.get_root().getStaticEntity("mailbox")
+        def post(msgA):
+            req = DummyRequest([])
+            req.method = "POST"
+            req.content = StringIO(msgA)
+            req.render(r)
+            return "".join(req.written), req
+        out, req = post(delivery.createMsgA(trec, "msgC"))
+        self.failUnlessEqual(out, "ok")
+        self.failUnlessEqual(req.finished, 1)
+        # the sender gets to hear about a corrupt msgA, but nothing later
+        out, req = post("a0:" + "\x00"*100)
+        self.failUnlessEqual(req.responseCode, http.BAD_REQUEST)
+        self.failUnlessEqual(out, "bad msgA")
+        d = flushEventualQueue()
+        def _then(_):
+            self.failUnlessEqual(len(n.mailbox_server.store.list_messages(tid)),
+                                 1)
+        d.addCallback(_then)
+        return d
+
+    def test_threaded_crypto(self):
+        n = self.make_nodes(transport="local")[1]
+        ms = n.mailbox_server
+        ms.executor = CryptoExecutor(2)
+        ms.executor.setServiceParent(self.sparent)
+        tid, trec = self.add_recipient(n)
+        msgs = ["msgC%d" % i for i in range(10)]
+        d = defer.gatherResults([ms.handle_msgA(delivery.createMsgA(trec, m))
+                                 for m in msgs])
+        d.addCallback(lambda _: flushEventualQueue())
+        def _then(_):
+            msgids = [msgid for (msgid, length)
+                      in ms.store.list_messages(tid)]
+            bodies = [ms.store.get_message(msgid)[1] for msgid in msgids]
+            self.failUnlessEqual(sorted(bodies), sorted(msgs))
+            self.failUnlessEqual(ms.executor.get_stats()["completed"], 10)
+        d.addCallback(_then)
+        return d
+
+class BodyLimits(TwoNodeMixin, ShouldFailMixin, unittest.TestCase):
+    def test_limits(self):
+        n = self.make_nodes(transport="local")[1]
+        tid, trec = self.add_recipient(n)
+        msgA = delivery.createMsgA(trec, "msgC")
+        n.web.limit_body("/mailbox", len(msgA), "a0:")
+        url = n.baseurl + "mailbox"
+        def post(msgA):
+            return client.getPage(url, method="POST", postdata=msgA)
+        def post_root(body):
+            return client.getPage(n.baseurl, method="POST", postdata=body)
+        d = post(msgA)
+        d.addCallback(lambda res: self.failUnlessEqual(res, "ok"))
+        # the declared Content-Length is too big
+        d.addCallback(lambda _: self.shouldFail(error.Error, "413",
+                                                "body too large",
+                                                post, msgA+"x"))
+        d.addCallback(lambda _: self.shouldFail(error.Error, "400",
+                                                "bad body prefix",
+                                                post, "b0:"+msgA[3:]))
+        # other resources are not limited: this one reads the whole body
+        # and then refuses the method
+        d.addCallback(lambda _: self.shouldFail(error.Error, "405", None,
+                                                post_root, "x"*len(msgA)*2))
+        d.addCallback(lambda _: flushEventualQueue())
+        def _then(_):
+            self.failUnlessEqual(len(n.mailbox_server.store.list_messages(tid)),
+                                 1)
+        d.addCallback(_then)
+        return d
+
+    def test_other_channel(self):
+        # a channel without HTTPChannel's private _path gets the usual
+        # buffered body, with no limit
+        req = LimitedRequest(DummyChannel())
+        req.gotLength(10)
+        self.failUnlessEqual(req.body_limit, None)
+        req.handleContentChunk("a1:body")
+        self.failUnlessEqual(req.content.getvalue(), "a1:body")
+
+    def test_chunks(self):
+        # chunked bodies are checked as each chunk arrives, before the
+        # request is complete
+        n = self.make_nodes(transport="local")[1]
+        n.web.limit_body("/mailbox", 10, "a0:")
+        def request(*chunks):
+            channel = n.web.site.buildProtocol(None)
+            t = StringTransport()
+            channel.makeConnection(t)
+            channel.dataReceived("POST /mailbox HTTP/1.1\r\nHost: x\r\n"
+                                 "Transfer-Encoding: chunked\r\n\r\n")
+            for chunk in chunks:
+                channel.dataReceived("%x\r\n%s\r\n" % (len(chunk), chunk))
+            out = t.value()
+            channel.connectionLost(failure.Failure(ConnectionDone()))
+            return out
+        self.failUnlessEqual(request("a", "0:12", "34567"), "")
+        out = request("a", "1:", "12")
+        self.failUnless(out.startswith("HTTP/1.1 400 Bad Request\r\n"), out)
+        self.failUnless(out.endswith("\r\n\r\nbad body prefix"), out)
+        out = request("a0:1234", "5678", "more")
+        self.failUnless(out.startswith("HTTP/1.1 413 "), out)
+        self.failUnless(out.endswith("\r\n\r\nbody too large"), out)
+
+class Quotas(TwoNodeMixin, unittest.TestCase):
+    def test_post(self):
+        n = self.make_nodes(transport="local")[1]
+        ms = n.mailbox_server
+        tid1, trec1 = self.add_recipient(n)
+        tid2, trec2 = self.add_recipient(n)
+        ms.set_transport_quota(tid1, max_messages=2)
+        r = n.web.get_root().getStaticEntity("mailbox")
+        def post(trec, msgC):
+            req = DummyRequest([])
+            req.method = "POST"
+            req.content = StringIO(delivery.createMsgA(trec, msgC))
+            req.render(r)
+            return "".join(req.written), req
+        self.failUnlessEqual(post(trec1, "msgC1")[0], "ok")
+        self.failUnlessEqual(post(trec1, "msgC2")[0], "ok")
+        # messages are charged when they are queued, just after the sender
+        # hears "ok"
+        d = flushEventualQueue()
+        def _then(_):
+            # tid1 is full now, so its senders are told to come back later
+            out, req = post(trec1, "msgC3")
+            self.failUnlessEqual(req.responseCode, http.SERVICE_UNAVAILABLE)
+            self.failUnlessEqual(out, "mailbox full")
+            self.failUnlessEqual(
+                req.responseHeaders.getRawHeaders("retry-after"), ["300"])
+            # other transports are unaffected
+            self.failUnlessEqual(post(trec2, "msgC4")[0], "ok")
+            return flushEventualQueue()
+        d.addCallback(_then)
+        def _then2(_):
+            self.failUnlessEqual(len(ms.store.list_messages(tid1)), 2)
+            usage = dict([(u["tid"], u) for u in ms.get_quota_usage()])
+            self.failUnlessEqual(usage[tid1],
+                                 {"tid": tid1, "messages": 2, "bytes": 10,
+                                  "max_messages": 2, "max_bytes": None,
+                                  "full": True})
+            self.failUnlessEqual(usage[tid2]["messages"], 1)
+            self.failIf(usage[tid2]["full"])
+            # retrieving (and deleting) a message makes room again
+            msgid = ms.store.list_messages(tid1)[0][0]
+            ms.store.delete_message(msgid)
+            ms.store.commit()
+            return flushEventualQueue()
+        d.addCallback(_then2)
+        def _then3(_):
+            self.failUnlessEqual(post(trec1, "msgC5")[0], "ok")
+            return flushEventualQueue()
+        d.addCallback(_then3)
+        def _then4(_):
+            self.failUnlessEqual(post(trec1, "msgC6")[1].responseCode,
+                                 http.SERVICE_UNAVAILABLE)
+            # and so does raising the limit
+            ms.set_transport_quota(tid1, max_messages=3)
+            self.failUnlessEqual(post(trec1, "msgC6")[0], "ok")
+        d.addCallback(_then4)
+        return d
+
+    def test_retry(self):
+        clock = task.Clock()
+        responses = []
+        class FakeHTTP:
+            def getPage(self, url, method, postdata):
+                return responses.pop(0)
+        def busy(retry_after):
+            e = error.Error("503", "mailbox full", "mailbox full")
+            e.headers = Headers({"Retry-After": [retry_after]})
+            return defer.fail(e)
+        t = delivery.OutboundHTTPTransport(None, {"url": "http://server/"},
+                                           http=FakeHTTP(), clock=clock)
+        responses.extend([busy("20"), busy("junk"), defer.succeed("ok")])
+        results = []
+        t.post("msgA", 3).addCallback(results.append)
+        clock.advance(19)
+        self.failUnlessEqual(len(responses), 2)
+        clock.advance(1)
+        # a Retry-After we can't parse gets the default delay
+        self.failUnlessEqual(len(responses), 1)
+        clock.advance(t.DEFAULT_RETRY_DELAY)
+        self.failUnlessEqual(results, ["ok"])
+        # we give up eventually
+        responses.extend([busy("1"), busy("1")])
+        failures = []
+        t.post("msgA", 1).addErrback(failures.append)
+        clock.advance(1)
+        self.failUnlessEqual(len(failures), 1)
+        self.failUnlessEqual(failures[0].value.status, "503")
+
+class IngestWorkers(TwoNodeMixin, ShouldFailMixin, unittest.TestCase):
+    def test_workers(self):
+        n = self.make_nodes(transport="local")[1]
+        ms = n.mailbox_server
+        tid, trec = self.add_recipient(n)
+        unknown_trec = dict(trec, STT=self.create_unknown_STT(n).encode("hex"))
+        unknowns = []
+        ms.signal_unrecognized_TTID = unknowns.append
+        port = util.allocate_port()
+        ms.enable_ingest_workers(n.dbfile, "tcp:%d:interface=127.0.0.1" % port,
+                                 2)
+        url = "http://127.0.0.1:%d/mailbox" % port
+        def post(msgA):
+            return client.getPage(url, method="POST", postdata=msgA)
+        # the socket is already listening, so these wait for a worker
+        d = defer.gatherResults([post(delivery.createMsgA(trec, "msgC%d" % i))
+                                 for i in range(4)])
+        d.addCallback(lambda res: self.failUnlessEqual(res, ["ok"]*4))
+        d.addCallback(lambda _:
+                      post(delivery.createMsgA(unknown_trec, "msgC")))
+        d.addCallback(lambda _: self.shouldFail(error.Error, "400", None,
+                                                post, "a0:" + "\x00"*100))
+        d.addCallback(lambda _:
+                      self.poll(lambda: (len(ms.store.list_messages(tid)) == 4
+                                         and len(unknowns) == 1)))
+        def _then(_):
+            bodies = [ms.store.get_message(msgid)[1]
+                      for (msgid, length) in ms.store.list_messages(tid)]
+            self.failUnlessEqual(sorted(bodies),
+                                 ["msgC%d" % i for i in range(4)])
+            self.failUnlessEqual(ms.ingest_workers.records_received, 5)
+        d.addCallback(_then)
+        return d
+
+    def test_worker_survives_unrecognized(self):
+        n = self.make_nodes(transport="local")[1]
+        ms = n.mailbox_server
+        tid, trec = self.add_recipient(n)
+        unknown_trec = dict(trec, STT=self.create_unknown_STT(n).encode("hex"))
+        port = util.allocate_port()
+        # the real signal_unrecognized_TTID raises, and the lone worker's
+        # pipe must stay open for the message that follows. The KeyError is
+        # logged while we poll.
+        self._poll_should_ignore_these_errors = [KeyError]
+        ms.enable_ingest_workers(n.dbfile, "tcp:%d:interface=127.0.0.1" % port,
+                                 1)
+        url = "http://127.0.0.1:%d/mailbox" % port
+        def post(msgA):
+            return client.getPage(url, method="POST", postdata=msgA)
+        d = post(delivery.createMsgA(unknown_trec, "msgC0"))
+        d.addCallback(lambda _: post(delivery.createMsgA(trec, "msgC1")))
+        d.addCallback(lambda _:
+                      self.poll(lambda: len(ms.store.list_messages(tid)) == 1))
+        def _then(_):
+            [(msgid, length)] = ms.store.list_messages(tid)
+            self.failUnlessEqual(ms.store.get_message(msgid)[1], "msgC1")
+            self.failUnlessEqual(ms.ingest_workers.records_received, 2)
+            self.failUnlessEqual(len(self.flushLoggedErrors(KeyError)), 1)
+        d.addCallback(_then)
+        return d
+
+class GroupCommit(TwoNodeMixin, unittest.TestCase):
+    def make_db(self):
+        dbfile = os.path.join(self.make_basedir(), "test.db")
+        return make_observable_db(dbfile)
+
+    def count_messages(self, db):
+        return db.execute("SELECT COUNT(*) FROM mailbox_server_messages"
+                          ).fetchone()[0]
+
+    def test_immediate(self):
+        db = self.make_db()
+        gc = GroupCommitter(SQLiteMessageStore(db))
+        d = gc.add(1, "msgC1")
+        self.failUnlessEqual(self.count_messages(db), 1)
+        msgids = []
+        d.addCallback(msgids.append)
+        self.failUnlessEqual(len(msgids), 1)
+
+    def test_count(self):
+        db = self.make_db()
+        clock = task.Clock()
+        gc = GroupCommitter(SQLiteMessageStore(db),
+                            max_messages=3, max_delay_ms=1000,
+                            clock=clock)
+        committed = []
+        for i in range(2):
+            gc.add(1, "msgC%d" % i).addCallback(committed.append)
+        # nothing is written until the batch fills up
+        self.failUnlessEqual(self.count_messages(db), 0)
+        self.failUnlessEqual(committed, [])
+        gc.add(2, "msgC2").addCallback(committed.append)
+        self.failUnlessEqual(self.count_messages(db), 3)
+        self.failUnlessEqual(len(committed), 3)
+        self.failIf(clock.getDelayedCalls())
+        rows = db.execute("SELECT * FROM mailbox_server_messages"
+                          " ORDER BY id").fetchall()
+        self.failUnlessEqual([r["id"] for r in rows], committed)
+        self.failUnlessEqual([str(r["msgC"]) for r in rows],
+                             ["msgC0", "msgC1", "msgC2"])
+
+    def test_delay(self):
+        db = self.make_db()
+        clock = task.Clock()
+        gc = GroupCommitter(SQLiteMessageStore(db),
+                            max_messages=100, max_delay_ms=50,
+                            clock=clock)
+        committed = []
+        gc.add(1, "msgC1").addCallback(committed.append)
+        clock.advance(0.030)
+        gc.add(1, "msgC2").addCallback(committed.append)
+        self.failUnlessEqual(self.count_messages(db), 0)
+        # the window is measured from the oldest message
+        clock.advance(0.020)
+        self.failUnlessEqual(self.count_messages(db), 2)
+        self.failUnlessEqual(len(committed), 2)
+        self.failIf(clock.getDelayedCalls())
+
+    def test_notifications(self):
+        db = self.make_db()
+        notices = []
+        db.subscribe("mailbox_server_messages", notices.append)
+        gc = GroupCommitter(SQLiteMessageStore(db),
+                            max_messages=2, max_delay_ms=1000,
+                            clock=task.Clock())
+        gc.add(4, "msgC1")
+        gc.add(5, "msgC22")
+        d = flushEventualQueue()
+        def _then(_):
+            self.failUnlessEqual(len(notices), 2)
+            self.failUnlessEqual([n.action for n in notices],
+                                 ["insert", "insert"])
+            v = notices[1].new_value
+            self.failUnlessEqual(v["id"], notices[1].id)
+            self.failUnlessEqual(v["tid"], 5)
+            self.failUnlessEqual(v["length"], len("msgC22"))
+        d.addCallback(_then)
+        return d
+
+    def test_flush_on_stop(self):
+        n = self.make_nodes(transport="local")[1]
+        ms = n.mailbox_server
+        ms.committer.max_messages = 10
+        ms.committer.max_delay = 60
+        tid, trec = self.add_recipient(n)
+        ms.queue_msgC(tid, "msgC1")
+        self.failUnlessEqual(self.count_messages(n.db), 0)
+        d = defer.maybeDeferred(ms.disownServiceParent)
+        d.addCallback(lambda _: self.failUnlessEqual(self.count_messages(n.db),
+                                                     1))
+        return d
+
+def do_request(resource, t=None, method="GET", accept=None, body=None):
     req = DummyRequest([])
     req.method = method
     req.args = {}
+    if body is not None:
+        req.content = StringIO(body)
+    if accept:
+        req.requestHeaders.setRawHeaders("accept", [accept])
     if t:
         req.args["t"] = [t]
     req.render(resource)
     return "".join(req.written), req
 
+class Transports(TwoNodeMixin, unittest.TestCase):
+    def test_lookup(self):
+        n = self.make_nodes(transport="local")[1]
+        ms = n.mailbox_server
+        tid = ms.allocate_transport()
+        TTID, TT0, RT, symkey = ms.get_tid_data(tid)
+        self.failUnlessEqual(len(symkey), 32)
+        # a fresh registry loads from the database, a warm one doesn't
+        for reg in [TransportRegistry(n.db), ms.transports]:
+            t = reg.lookup_TTID(TTID)
+            self.failUnlessEqual(t, (tid, TTID, TT0, RT, symkey,
+                                     None, None, None))
+            self.failUnlessEqual(reg.lookup_RT(RT), t)
+            self.failUnlessEqual(reg.get(tid), t)
+        self.failUnlessEqual(ms.transports.lookup_TTID("unknown"), None)
+        self.failUnlessEqual(ms.transports.lookup_RT("unknown0"), None)
+        self.failUnlessEqual(ms.transports.get(tid+100), None)
+
+    def test_eviction(self):
+        n = self.make_nodes(transport="local")[1]
+        ms = n.mailbox_server
+        tids = [ms.allocate_transport() for i in range(3)]
+        reg = TransportRegistry(n.db, max_entries=2)
+        reg.get(tids[0])
+        reg.get(tids[1])
+        reg.get(tids[0]) # now tids[1] is the least recently used
+        reg.get(tids[2])
+        self.failUnlessEqual(len(reg), 2)
+        self.failUnlessEqual(sorted(reg.entries.keys()),
+                             sorted([tids[0], tids[2]]))
+        TTID_1 = ms.get_tid_data(tids[1])[0]
+        self.failIf(TTID_1 in reg.by_TTID)
+        self.failUnlessEqual(reg.lookup_TTID(TTID_1).tid, tids[1])
+        self.failUnlessEqual(sorted(reg.entries.keys()),
+                             sorted([tids[1], tids[2]]))
+
+    def test_invalidate(self):
+        n = self.make_nodes(transport="local")[1]
+        ms = n.mailbox_server
+        tid = ms.allocate_transport()
+        TTID, TT0, RT, symkey = ms.get_tid_data(tid)
+        n.db.delete("DELETE FROM mailbox_server_transports WHERE id=?",
+                    (tid,), "mailbox_server_transports", tid)
+        n.db.commit()
+        d = flushEventualQueue()
+        def _then(_):
+            self.failUnlessEqual(ms.transports.lookup_TTID(TTID), None)
+            self.failUnlessEqual(ms.transports.lookup_RT(RT), None)
+        d.addCallback(_then)
+        return d
+
 class Retrieval(TwoNodeMixin, unittest.TestCase):
     def test_resource(self):
         n = self.make_nodes(transport="local")[1]
@@ -132,7 +546,7 @@ class Retrieval(TwoNodeMixin, unittest.TestCase):
                          " WHERE tid=?", (tid1,))
         messages = c.fetchall()
         self.failUnlessEqual(len(messages), 2)
-        bodies = set([m["msgC"].decode("hex") for m in messages])
+        bodies = set([str(m["msgC"]) for m in messages])
         self.failUnlessEqual(bodies, set(["msgC1_first", "msgC1_second"]))
 
         listres = ms.listres
@@ -142,11 +556,15 @@ class Retrieval(TwoNodeMixin, unittest.TestCase):
 
         # test 'list'
         out,req = do_request(listres, base64.urlsafe_b64encode(reqkey))
-        # that created the tokens, so now we check the DB
+        # that created the tokens, in memory, without touching the DB
         messages = n.db.execute("SELECT * FROM mailbox_server_messages"
                                 " WHERE tid=? ORDER BY id",
                                 (tid1,)).fetchall()
         self.failUnlessEqual(len(messages), 2)
+        self.failUnlessEqual(messages[0]["fetch_token"], None)
+        self.failUnlessEqual(messages[0]["delete_token"], None)
+        tokens = ms.tokens
+        self.failUnlessEqual(len(tokens), 2)
 
         self.failUnless(out.startswith("data: "), out)
         self.failUnless(out.endswith("\n\n"), out)
@@ -159,20 +577,20 @@ class Retrieval(TwoNodeMixin, unittest.TestCase):
         (fetch_token1, delete_token1, length1) = \
                        retrieval.decrypt_list_entry(r1, symkey_1, tmppub)
         self.failUnlessEqual(length1, len("msgC1_first"))
-        self.failUnlessEqual(str(messages[0]["fetch_token"]),
-                             fetch_token1.encode("hex"))
-        self.failUnlessEqual(str(messages[0]["delete_token"]),
-                             delete_token1.encode("hex"))
+        self.failUnlessEqual(tokens.fetch_tokens[fetch_token1],
+                             messages[0]["id"])
+        self.failUnlessEqual(tokens.delete_tokens[delete_token1],
+                             messages[0]["id"])
         self.failUnlessEqual(messages[0]["length"], length1)
 
         r2 = base64.b64decode(responses[1])
         (fetch_token2, delete_token2,
          length2) = retrieval.decrypt_list_entry(r2, symkey_1, tmppub)
         self.failUnlessEqual(length2, len("msgC1_second"))
-        self.failUnlessEqual(str(messages[1]["fetch_token"]),
-                             fetch_token2.encode("hex"))
-        self.failUnlessEqual(str(messages[1]["delete_token"]),
-                             delete_token2.encode("hex"))
+        self.failUnlessEqual(tokens.fetch_tokens[fetch_token2],
+                             messages[1]["id"])
+        self.failUnlessEqual(tokens.delete_tokens[delete_token2],
+                             messages[1]["id"])
         self.failUnlessEqual(messages[1]["length"], length2)
 
         r = n.web.get_root().getStaticEntity("retrieval")
@@ -197,7 +615,7 @@ class Retrieval(TwoNodeMixin, unittest.TestCase):
                                 " WHERE tid=? ORDER BY id",
                                 (tid1,)).fetchall()
         self.failUnlessEqual(len(messages), 2)
-        self.failUnlessEqual(messages[0]["fetch_token"], None)
+        self.failIf(fetch_token1 in tokens.fetch_tokens)
 
         # test delete_token
         out, req = do_request(deleteres,
@@ -255,21 +673,268 @@ class Retrieval(TwoNodeMixin, unittest.TestCase):
         # since none of those "list" requests were accepted, the fetch_token2
         # should still be valid. We don't spend it now, to test how a second
         # "list" should cancel it.
-        messages = n.db.execute("SELECT * FROM mailbox_server_messages"
-                                " WHERE tid=? ORDER BY id",
-                                (tid1,)).fetchall()
-        self.failUnlessEqual(len(messages), 1)
-        self.failUnlessEqual(messages[0]["fetch_token"],
-                             fetch_token2.encode("hex"))
+        self.failUnlessEqual(len(tokens), 1)
+        self.failUnlessEqual(tokens.find_fetch_token(fetch_token2),
+                             messages[0]["id"])
         # a second 'list' should revoke tokens from the first
         reqkey, tmppub = retrieval.encrypt_list_request(retrieval_pubkey, RT_1)
         out,req = do_request(listres, base64.urlsafe_b64encode(reqkey))
-        messages = n.db.execute("SELECT * FROM mailbox_server_messages"
-                                " WHERE tid=? ORDER BY id",
-                                (tid1,)).fetchall()
-        self.failUnlessEqual(len(messages), 1)
-        self.failIfEqual(messages[0]["fetch_token"],
-                         fetch_token2.encode("hex"))
+        self.failUnlessEqual(len(tokens), 1)
+        self.failUnlessEqual(tokens.find_fetch_token(fetch_token2), None)
+        out, req = do_request(fetchres,
+                              base64.urlsafe_b64encode(fetch_token2))
+        self.failUnlessEqual(req.responseCode, http.NOT_FOUND)
+
+    def test_cursor(self):
+        n = self.make_nodes(transport="local")[1]
+        ms = n.mailbox_server
+        tid1, trec1 = self.add_recipient(n)
+        TTID_1, TT0_1, RT_1, symkey_1 = ms.get_tid_data(tid1)
+        retrieval_pubkey = trec1["retrieval_pubkey"].decode("hex")
+        for i in range(12):
+            ms.queue_msgC(tid1, "msgC%d" % i)
+
+        def do_list(cursor):
+            reqkey, tmppub = retrieval.encrypt_list_request(
+                retrieval_pubkey, RT_1, options={"cursor": cursor})
+            out,req = do_request(ms.listres, base64.urlsafe_b64encode(reqkey))
+            lengths, cursors = [], []
+            for (name, data) in parse_events(out):
+                words = data.split()
+                # every event ends with a cursor
+                self.failUnless(words[-1].startswith("cursor:"), words)
+                cursors.append(words[-1][len("cursor:"):])
+                for w in words[:-1]:
+                    entry = retrieval.decrypt_list_entry(base64.b64decode(w),
+                                                         symkey_1, tmppub)
+                    lengths.append(entry[2])
+            return lengths, cursors
+
+        lengths, cursors = do_list("")
+        self.failUnlessEqual(len(lengths), 12)
+        self.failUnlessEqual(len(cursors), 2)
+        # the first event's cursor covers the first 10 messages
+        lengths, cursors2 = do_list(cursors[0])
+        self.failUnlessEqual(len(lengths), 2)
+        lengths, cursors3 = do_list(cursors[1])
+        self.failUnlessEqual(lengths, [])
+        self.failUnlessEqual(cursors3, [])
+        # new messages show up after the last cursor
+        ms.queue_msgC(tid1, "longer msgC")
+        lengths, cursors4 = do_list(cursors[1])
+        self.failUnlessEqual(lengths, [len("longer msgC")])
+        # a cursor that isn't ours lists everything
+        lengths, cursors5 = do_list(base64.b64encode("x"*40))
+        self.failUnlessEqual(len(lengths), 13)
+
+    def test_pages(self):
+        n = self.make_nodes(transport="local")[1]
+        ms = n.mailbox_server
+        tid1, trec1 = self.add_recipient(n)
+        TTID_1, TT0_1, RT_1, symkey_1 = ms.get_tid_data(tid1)
+        retrieval_pubkey = trec1["retrieval_pubkey"].decode("hex")
+        for i in range(7):
+            ms.queue_msgC(tid1, "msgC%d" % i)
+
+        def do_list(options, accept=None):
+            reqkey, tmppub = retrieval.encrypt_list_request(
+                retrieval_pubkey, RT_1, options=options)
+            out,req = do_request(ms.listres, base64.urlsafe_b64encode(reqkey),
+                                 accept=accept)
+            events = [data.split() for (name, data) in parse_events(out)
+                      if name == "data"]
+            return events, req
+
+        # a polling client that asks for a page size gets one page
+        events, req = do_list({"cursor": "", "page_size": 3})
+        self.failUnlessEqual(req.finished, 1)
+        self.failUnlessEqual([len(words) for words in events], [4])
+        cursor = events[0][-1][len("cursor:"):]
+        events, req = do_list({"cursor": cursor, "page_size": 3})
+        self.failUnlessEqual([len(words) for words in events], [4])
+        cursor = events[0][-1][len("cursor:"):]
+        events, req = do_list({"cursor": cursor, "page_size": 3})
+        self.failUnlessEqual([len(words) for words in events], [2])
+        # only the current page's tokens are handed out
+        self.failUnlessEqual(len(ms.tokens), 1)
+
+        # an EventSource client gets the whole backlog, one page per event,
+        # and then stays subscribed
+        events, req = do_list({"page_size": 3}, accept="text/event-stream")
+        self.failUnlessEqual([len(words) for words in events], [3, 3, 1])
+        self.failIf(req.finished)
+        listing = ms.listres.subscribers[tid1]
+        self.failIf(listing.producing)
+        def count_events():
+            return len([name for (name, data)
+                        in parse_events("".join(req.written))
+                        if name == "data"])
+        # it ignores notices for messages it has already announced
+        listing.new_message(listing.after, 10)
+        self.failUnlessEqual(count_events(), 3)
+        listing.new_message(listing.after+1, 10)
+        self.failUnlessEqual(count_events(), 4)
+        listing.stop()
+        self.failUnlessEqual(req.finished, 1)
+
+        # malformed options are refused, before any tokens are revoked
+        tokens = len(ms.tokens)
+        for options in [{"page_size": "abc"}, {"page_size": None},
+                        {"page_size": 0}, {"page_size": True}, ["page_size"]]:
+            events, req = do_list(options)
+            self.failUnlessEqual(req.responseCode, 400, options)
+            self.failUnlessEqual(events, [])
+        self.failUnlessEqual(len(ms.tokens), tokens)
+
+    def test_inline(self):
+        n = self.make_nodes(transport="local")[1]
+        ms = n.mailbox_server
+        tid1, trec1 = self.add_recipient(n)
+        TTID_1, TT0_1, RT_1, symkey_1 = ms.get_tid_data(tid1)
+        retrieval_pubkey = trec1["retrieval_pubkey"].decode("hex")
+        ms.listres.inline_size = 10
+        ms.queue_msgC(tid1, "small")
+        ms.queue_msgC(tid1, "not so small")
+
+        def do_list(options):
+            reqkey, tmppub = retrieval.encrypt_list_request(
+                retrieval_pubkey, RT_1, options=options)
+            out,req = do_request(ms.listres, base64.urlsafe_b64encode(reqkey))
+            return parse_events(out)[0][1].split(), tmppub
+
+        # only clients that ask get messages inline
+        words, tmppub = do_list({})
+        self.failIf([w for w in words if w.startswith("msgC:")], words)
+        words, tmppub = do_list({"inline": True})
+        self.failUnlessEqual(len(words), 2)
+        self.failUnless(words[0].startswith("msgC:"), words)
+        delete_token, msgC = retrieval.decrypt_inline_entry(
+            base64.b64decode(words[0][len("msgC:"):]), symkey_1, tmppub)
+        self.failUnlessEqual(msgC, "small")
+        entry = retrieval.decrypt_list_entry(base64.b64decode(words[1]),
+                                             symkey_1, tmppub)
+        self.failUnlessEqual(entry[2], len("not so small"))
+        # the inline message can be deleted like any other
+        self.failUnlessEqual(len(ms.tokens), 2)
+        r = n.web.get_root().getStaticEntity("retrieval")
+        do_request(r.getStaticEntity("delete-batch"), method="POST",
+                   body=delete_token)
+        self.failUnlessEqual([length for (msgid, length)
+                              in ms.store.list_messages(tid1)],
+                             [len("not so small")])
+
+    def test_batch(self):
+        n = self.make_nodes(transport="local")[1]
+        ms = n.mailbox_server
+        tid1, trec1 = self.add_recipient(n)
+        TTID_1, TT0_1, RT_1, symkey_1 = ms.get_tid_data(tid1)
+        retrieval_pubkey = trec1["retrieval_pubkey"].decode("hex")
+        for i in range(3):
+            ms.queue_msgC(tid1, "msgC%d" % i)
+        reqkey, tmppub = retrieval.encrypt_list_request(retrieval_pubkey, RT_1)
+        out,req = do_request(ms.listres, base64.urlsafe_b64encode(reqkey))
+        entries = [retrieval.decrypt_list_entry(base64.b64decode(w),
+                                                symkey_1, tmppub)
+                   for w in parse_events(out)[0][1].split()]
+        self.failUnlessEqual(len(entries), 3)
+
+        r = n.web.get_root().getStaticEntity("retrieval")
+        fetchres = r.getStaticEntity("fetch-batch")
+        deleteres = r.getStaticEntity("delete-batch")
+        # one response per token, in order, empty for unknown tokens
+        body = entries[2][0] + "\x00"*32 + entries[0][0]
+        out,req = do_request(fetchres, method="POST", body=body)
+        self.failUnlessEqual(req.finished, 1)
+        responses = split_netstrings(out)
+        self.failUnlessEqual(len(responses), 3)
+        self.failUnlessEqual(retrieval.decrypt_fetch_response(
+            symkey_1, entries[2][0], responses[0]), "msgC2")
+        self.failUnlessEqual(responses[1], "")
+        self.failUnlessEqual(retrieval.decrypt_fetch_response(
+            symkey_1, entries[0][0], responses[2]), "msgC0")
+        # fetch tokens are still single-use
+        out,req = do_request(fetchres, method="POST", body=entries[0][0])
+        self.failUnlessEqual(split_netstrings(out), [""])
+        out,req = do_request(fetchres, method="POST", body="short")
+        self.failUnlessEqual(req.responseCode, http.BAD_REQUEST)
+
+        body = "".join([delete_t for (fetch_t, delete_t, length)
+                        in entries[:2]]) + "\x00"*32
+        out,req = do_request(deleteres, method="POST", body=body)
+        self.failUnlessEqual(req.responseCode, http.OK)
+        self.failUnlessEqual(len(ms.store.list_messages(tid1)), 1)
+        self.failUnlessEqual(len(ms.tokens), 1)
+
+    def test_autodelete(self):
+        n = self.make_nodes(transport="local")[1]
+        ms = n.mailbox_server
+        tid1, trec1 = self.add_recipient(n)
+        TTID_1, TT0_1, RT_1, symkey_1 = ms.get_tid_data(tid1)
+        retrieval_pubkey = trec1["retrieval_pubkey"].decode("hex")
+        for i in range(4):
+            ms.queue_msgC(tid1, "msgC%d" % i)
+        reqkey, tmppub = retrieval.encrypt_list_request(retrieval_pubkey, RT_1)
+        out,req = do_request(ms.listres, base64.urlsafe_b64encode(reqkey))
+        entries = [retrieval.decrypt_list_entry(base64.b64decode(w),
+                                                symkey_1, tmppub)
+                   for w in parse_events(out)[0][1].split()]
+        msgids = [msgid for (msgid, length) in ms.store.list_messages(tid1)]
+        r = n.web.get_root().getStaticEntity("retrieval")
+        fetchres = r.getStaticEntity("fetch")
+        batchres = r.getStaticEntity("fetch-batch")
+
+        # a plain fetch leaves the message alone
+        out,req = do_request(fetchres, base64.urlsafe_b64encode(entries[0][0]))
+        self.failUnlessEqual(len(ms.store.list_messages(tid1)), 4)
+
+        # with autodelete, it's gone once the response has been written
+        req = DummyRequest([])
+        req.args = {"t": [base64.urlsafe_b64encode(entries[1][0])],
+                    "autodelete": ["1"]}
+        out = fetchres.render_GET(req)
+        self.failUnlessEqual(retrieval.decrypt_fetch_response(
+            symkey_1, entries[1][0], out), "msgC1")
+        self.failUnlessEqual(len(ms.store.list_messages(tid1)), 4)
+        req.finish()
+        self.failUnlessEqual([msgid for (msgid, length)
+                              in ms.store.list_messages(tid1)],
+                             [msgids[0], msgids[2], msgids[3]])
+        self.failUnlessEqual(ms.tokens.find_delete_token(entries[1][1]), None)
+
+        # a batch fetch can acknowledge earlier messages, and autodelete too
+        req = DummyRequest([])
+        req.method = "POST"
+        req.args = {"acks": ["1"], "autodelete": ["1"]}
+        req.content = StringIO(entries[0][1] + entries[2][0] + entries[3][0])
+        req.render(batchres)
+        responses = split_netstrings("".join(req.written))
+        fetch_tokens = [entries[2][0], entries[3][0]]
+        self.failUnlessEqual([retrieval.decrypt_fetch_response(symkey_1, ft,
+                                                               resp)
+                              for (ft, resp) in zip(fetch_tokens, responses)],
+                             ["msgC2", "msgC3"])
+        self.failUnlessEqual(ms.store.list_messages(tid1), [])
+        self.failUnlessEqual(len(ms.tokens), 0)
+
+        # but nothing is deleted if the connection is lost first
+        ms.queue_msgC(tid1, "msgC4")
+        reqkey, tmppub = retrieval.encrypt_list_request(retrieval_pubkey, RT_1)
+        out,req = do_request(ms.listres, base64.urlsafe_b64encode(reqkey))
+        entry = retrieval.decrypt_list_entry(
+            base64.b64decode(parse_events(out)[0][1]), symkey_1, tmppub)
+        req = DummyRequest([])
+        req.args = {"t": [base64.urlsafe_b64encode(entry[0])],
+                    "autodelete": ["1"]}
+        fetchres.render_GET(req)
+        req.processingFailed(failure.Failure(ConnectionDone()))
+        self.failUnlessEqual(len(ms.store.list_messages(tid1)), 1)
+        # and a bad acks= count is refused
+        req = DummyRequest([])
+        req.method = "POST"
+        req.args = {"acks": ["2"]}
+        req.content = StringIO(entry[1])
+        req.render(batchres)
+        self.failUnlessEqual(req.responseCode, http.BAD_REQUEST)
 
     def GET(self, url):
         return client.getPage(url, method="GET",
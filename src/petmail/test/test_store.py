@@ -0,0 +1,367 @@
+import os, time, base64
+from twisted.trial import unittest
+from twisted.web import http
+from twisted.internet import task
+from .common import BasedirMixin, TwoNodeMixin
+from ..database import make_observable_db
+from ..eventual import flushEventualQueue
+from ..mailbox import retrieval
+from ..mailbox.store import (SQLiteMessageStore, SegmentLogMessageStore,
+                             create_message_store, scan_segment)
+from ..mailbox.tokens import TokenTable
+from ..mailbox.server import (RetrievalListResource, RetrievalFetchResource,
+                              RetrievalDeleteResource)
+from .test_server import do_request
+from .test_eventsource import parse_events
+
+class StoreTests:
+    # subclasses provide make_store()
+
+    def test_add_list_get(self):
+        s = self.make_store()
+        m1 = s.add_message(1, "msgC1")
+        m2 = s.add_message(2, "msgC2")
+        m3 = s.add_message(1, "msgC3\x00\xff")
+        s.commit()
+        self.failUnless(m1 < m2 < m3)
+        self.failUnlessEqual(s.list_messages(1), [(m1, 5), (m3, 7)])
+        self.failUnlessEqual(s.list_messages(2), [(m2, 5)])
+        self.failUnlessEqual(s.list_messages(3), [])
+        self.failUnlessEqual(s.list_messages(1, after=m1), [(m3, 7)])
+        self.failUnlessEqual(s.list_messages(1, after=m3), [])
+        self.failUnlessEqual(s.list_messages(1, limit=1), [(m1, 5)])
+        self.failUnlessEqual(s.list_messages(1, after=m1, limit=1), [(m3, 7)])
+        self.failUnlessEqual(s.get_message(m3), (1, "msgC3\x00\xff"))
+        self.failUnlessEqual(s.get_message(m3+100), None)
+
+    def test_delete(self):
+        s = self.make_store()
+        m1 = s.add_message(1, "msgC1")
+        m2 = s.add_message(1, "msgC2")
+        s.commit()
+        s.delete_message(m1)
+        s.commit()
+        self.failUnlessEqual(s.list_messages(1), [(m2, 5)])
+        self.failUnlessEqual(s.get_message(m1), None)
+        # deleting an unknown message is ignored
+        s.delete_message(m1)
+        s.commit()
+        self.failUnlessEqual(s.list_messages(1), [(m2, 5)])
+
+    def test_notifications(self):
+        s = self.make_store()
+        notices = []
+        s.subscribe(notices.append)
+        m1 = s.add_message(4, "msgC1")
+        s.commit()
+        s.delete_message(m1)
+        s.commit()
+        d = flushEventualQueue()
+        def _then(_):
+            self.failUnlessEqual([n.action for n in notices],
+                                 ["insert", "delete"])
+            v = notices[0].new_value
+            self.failUnlessEqual((v["id"], v["tid"], v["length"]),
+                                 (m1, 4, 5))
+            self.failUnlessEqual(notices[1].tags, {"tid": 4, "length": 5})
+        d.addCallback(_then)
+        return d
+
+    def test_old_messages(self):
+        now = [1000]
+        s = self.make_store(clock=lambda: now[0])
+        m1 = s.add_message(1, "msgC1")
+        m2 = s.add_message(2, "msgC22")
+        now[0] = 1100
+        m3 = s.add_message(1, "msgC3")
+        s.commit()
+        self.failUnlessEqual(s.list_old_messages(1000), [])
+        self.failUnlessEqual(s.list_old_messages(1001),
+                             [(1000, m1, 1, 5), (1000, m2, 2, 6)])
+        self.failUnlessEqual(s.list_old_messages(2000, limit=1),
+                             [(1000, m1, 1, 5)])
+        self.failUnlessEqual(s.list_old_messages(2000, after=(1000, m1)),
+                             [(1000, m2, 2, 6), (1100, m3, 1, 5)])
+        s.delete_message(m2)
+        s.commit()
+        self.failUnlessEqual(s.list_old_messages(2000, after=(1000, m1)),
+                             [(1100, m3, 1, 5)])
+
+    def test_usage(self):
+        s = self.make_store()
+        self.failUnlessEqual(s.usage(), {})
+        m1 = s.add_message(1, "msgC1")
+        s.add_message(1, "msgC22")
+        s.add_message(2, "msgC3")
+        s.commit()
+        self.failUnlessEqual(s.usage(), {1: (2, 11), 2: (1, 5)})
+        s.delete_message(m1)
+        s.commit()
+        self.failUnlessEqual(s.usage(), {1: (1, 6), 2: (1, 5)})
+
+class SQLiteStore(StoreTests, BasedirMixin, unittest.TestCase):
+    def make_store(self, clock=time.time):
+        dbfile = os.path.join(self.make_basedir(), "test.db")
+        return SQLiteMessageStore(make_observable_db(dbfile), clock)
+
+class LogStore(StoreTests, BasedirMixin, unittest.TestCase):
+    def make_store(self, logdir=None, clock=time.time):
+        self.logdir = logdir or os.path.join(self.make_basedir(), "spool")
+        self.reactor = task.Clock()
+        s = SegmentLogMessageStore(self.logdir, fsync=False, clock=clock,
+                                   reactor=self.reactor)
+        self.addCleanup(s.active_file.close)
+        return s
+
+    def compact(self, s):
+        # run one compaction to the end, and return the segment it removed
+        results = []
+        s.compact().addBoth(results.append)
+        while not results:
+            self.reactor.advance(s.COMPACT_RETRY)
+        return results[0]
+
+    def test_arrival_replay(self):
+        now = [1000]
+        s = self.make_store(clock=lambda: now[0])
+        s.SEGMENT_SIZE = 200
+        msgids = []
+        for i in range(10):
+            msgids.append(s.add_message(1, "msgC%d" % i))
+            s.commit()
+            now[0] += 10
+        for msgid in msgids[:8]:
+            s.delete_message(msgid)
+            s.commit()
+        while self.compact(s) is not None:
+            pass
+        expected = [(1080, msgids[8], 1, 5), (1090, msgids[9], 1, 5)]
+        self.failUnlessEqual(s.list_old_messages(2000), expected)
+        s.active_file.close()
+        # arrival times survive a restart, including the ones that
+        # compaction moved
+        s2 = self.make_store(self.logdir, clock=lambda: 5000)
+        self.failUnlessEqual(s2.list_old_messages(2000), expected)
+
+    def test_replay(self):
+        s = self.make_store()
+        m1 = s.add_message(1, "msgC1")
+        m2 = s.add_message(1, "msgC2")
+        m3 = s.add_message(2, "msgC3")
+        s.commit()
+        s.delete_message(m2)
+        s.commit()
+        s.active_file.close()
+
+        s2 = self.make_store(self.logdir)
+        self.failUnlessEqual(s2.list_messages(1), [(m1, 5)])
+        self.failUnlessEqual(s2.list_messages(2), [(m3, 5)])
+        self.failUnlessEqual(s2.get_message(m3), (2, "msgC3"))
+        # ids are never reused
+        self.failUnless(s2.add_message(1, "msgC4") > m3)
+
+    def test_torn_write(self):
+        s = self.make_store()
+        m1 = s.add_message(1, "msgC1")
+        s.commit()
+        s.add_message(1, "msgC2")
+        s.active_file.flush()
+        size = os.path.getsize(s.active.path)
+        s.active_file.close()
+        # simulate a crash halfway through writing the second message
+        with open(s.active.path, "r+b") as f:
+            f.truncate(size-2)
+
+        s2 = self.make_store(self.logdir)
+        self.failUnlessEqual(s2.list_messages(1), [(m1, 5)])
+        self.failUnlessEqual(os.path.getsize(s2.active.path), size-30)
+        m3 = s2.add_message(1, "msgC3")
+        s2.commit()
+        self.failUnlessEqual(s2.get_message(m3), (1, "msgC3"))
+
+    def test_rollback(self):
+        s = self.make_store()
+        m1 = s.add_message(1, "msgC1")
+        s.commit()
+        s.add_message(1, "msgC2")
+        s.rollback()
+        self.failUnlessEqual(s.list_messages(1), [(m1, 5)])
+        m3 = s.add_message(1, "msgC3")
+        s.commit()
+        self.failUnlessEqual(s.get_message(m3), (1, "msgC3"))
+
+    def test_compact(self):
+        s = self.make_store()
+        s.SEGMENT_SIZE = 200
+        msgids = []
+        for i in range(20):
+            msgids.append(s.add_message(i%2, "msgC%02d" % i))
+            s.commit()
+        self.failUnless(len(s.segments) > 3)
+        first = min(s.segments)
+        # nothing is mostly dead yet
+        self.failUnlessEqual(self.compact(s), None)
+        # delete most of the messages, including everything in the first
+        # segment
+        for msgid in msgids[:15]:
+            s.delete_message(msgid)
+            s.commit()
+        before = s.get_stats()["total_bytes"]
+        compacted = []
+        while True:
+            segnum = self.compact(s)
+            if segnum is None:
+                break
+            compacted.append(segnum)
+        self.failUnlessEqual(compacted[0], first)
+        self.failIf(os.path.exists(s.segment_path(first)))
+        live = [(msgid, 6) for msgid in msgids[15:]]
+        self.failUnlessEqual(sorted(s.list_messages(0) + s.list_messages(1)),
+                             live)
+        for msgid in msgids[15:]:
+            tid, msgC = s.get_message(msgid)
+            self.failUnlessEqual(msgC, "msgC%02d" % msgids.index(msgid))
+        stats = s.get_stats()
+        self.failUnlessEqual(stats["messages"], 5)
+        self.failUnless(stats["total_bytes"] < before - 10*(25+6))
+        # what's left is live messages, and the tombstones that must outlive
+        # them, which compacting again would only copy forward
+        self.failUnlessEqual(self.compact(s), None)
+        s.active_file.close()
+
+        # the deleted messages must stay deleted after a restart
+        s2 = self.make_store(self.logdir)
+        self.failUnlessEqual(sorted(s2.list_messages(0) +
+                                    s2.list_messages(1)),
+                             live)
+        for msgid in msgids[15:]:
+            self.failUnlessEqual(s2.get_message(msgid)[1],
+                                 "msgC%02d" % msgids.index(msgid))
+
+    def test_compact_chunks(self):
+        s = self.make_store()
+        s.COMPACT_CHUNK = 100
+        msgids = []
+        for i in range(20):
+            msgids.append(s.add_message(1, "msgC%02d" % i))
+            s.commit()
+        for msgid in msgids[:15]:
+            s.delete_message(msgid)
+        s.commit()
+        old = s.active
+        s.roll_over()
+        records = len(scan_segment(old.path)[0])
+        done = []
+        chunks = []
+        real_copy = s.copy_records
+        def copy_records(*args):
+            chunks.append(len(args[2]))
+            return real_copy(*args)
+        self.patch(s, "copy_records", copy_records)
+        s.compact().addCallback(done.append)
+        # the rest waits for the reactor, and deliveries can get in first
+        self.failUnlessEqual(done, [])
+        self.failUnlessEqual(len(chunks), 1)
+        self.failUnless(s.get_stats()["compacting"])
+        m1 = s.add_message(2, "new1")
+        # a chunk won't run while a transaction is open
+        self.reactor.advance(0)
+        self.failUnlessEqual(done, [])
+        s.commit()
+        # each chunk schedules the next, so this runs them all
+        self.reactor.advance(s.COMPACT_RETRY)
+        self.failUnlessEqual(done, [old.segnum])
+        self.failUnless(len(chunks) > 2, chunks)
+        self.failUnlessEqual(sum(chunks), records)
+        self.failIf(os.path.exists(old.path))
+        self.failUnlessEqual(s.list_messages(1),
+                             [(msgid, 6) for msgid in msgids[15:]])
+        for msgid in msgids[15:]:
+            self.failUnlessEqual(s.get_message(msgid)[1],
+                                 "msgC%02d" % msgids.index(msgid))
+        self.failUnlessEqual(s.get_message(m1), (2, "new1"))
+        s.active_file.close()
+        s2 = self.make_store(self.logdir)
+        self.failUnlessEqual(s2.list_messages(1),
+                             [(msgid, 6) for msgid in msgids[15:]])
+        self.failUnlessEqual(s2.list_messages(2), [(m1, 4)])
+
+    def test_compact_active(self):
+        # a mostly-dead active segment gets sealed and reclaimed, even
+        # though it never filled up
+        s = self.make_store()
+        s.COMPACT_ACTIVE_SIZE = 300
+        msgids = []
+        for i in range(10):
+            msgids.append(s.add_message(1, "msgC%d" % i))
+            s.commit()
+        active = s.active
+        self.failUnlessEqual(self.compact(s), None) # all still live
+        self.failUnless(s.active is active)
+        for msgid in msgids[:8]:
+            s.delete_message(msgid)
+            s.commit()
+        self.failUnlessEqual(self.compact(s), active.segnum)
+        self.failIf(s.active is active)
+        self.failIf(os.path.exists(active.path))
+        self.failUnlessEqual(s.list_messages(1),
+                             [(msgid, 5) for msgid in msgids[8:]])
+        # the new active segment is small, so it stays put
+        self.failUnlessEqual(self.compact(s), None)
+        s.active_file.close()
+        s2 = self.make_store(self.logdir)
+        self.failUnlessEqual(s2.list_messages(1),
+                             [(msgid, 5) for msgid in msgids[8:]])
+        self.failUnlessEqual(s2.get_message(msgids[9]), (1, "msgC9"))
+
+    def test_create(self):
+        basedir = self.make_basedir()
+        s = create_message_store(None, basedir, {"message_store": "log"})
+        self.addCleanup(s.active_file.close)
+        self.failUnless(isinstance(s, SegmentLogMessageStore))
+        self.failUnless(os.path.isdir(os.path.join(basedir, "mailbox-spool")))
+        self.failUnlessRaises(ValueError, create_message_store, None, basedir,
+                              {"message_store": "bogus"})
+
+class LogStoreRetrieval(TwoNodeMixin, unittest.TestCase):
+    def test_resources(self):
+        n = self.make_nodes(transport="local")[1]
+        ms = n.mailbox_server
+        tid1, trec1 = self.add_recipient(n)
+        TTID_1, TT0_1, RT_1, symkey_1 = ms.get_tid_data(tid1)
+        store = SegmentLogMessageStore(os.path.join(n.basedir, "spool"),
+                                       fsync=False)
+        self.addCleanup(store.active_file.close)
+        store.add_message(tid1, "msgC1_first")
+        store.add_message(tid1, "msgC1_second")
+        store.commit()
+        tokens = TokenTable()
+        listres = RetrievalListResource(ms.transports, store, tokens,
+                                        ms.retrieval_privkey)
+        fetchres = RetrievalFetchResource(ms.transports, store, tokens)
+        deleteres = RetrievalDeleteResource(store, tokens)
+
+        retrieval_pubkey = trec1["retrieval_pubkey"].decode("hex")
+        reqkey, tmppub = retrieval.encrypt_list_request(retrieval_pubkey, RT_1)
+        out,req = do_request(listres, base64.urlsafe_b64encode(reqkey))
+        responses = parse_events(out)[0][1].split()
+        self.failUnlessEqual(len(responses), 2)
+        entries = [retrieval.decrypt_list_entry(base64.b64decode(r),
+                                                symkey_1, tmppub)
+                   for r in responses]
+        (fetch_token1, delete_token1, length1) = entries[0]
+        self.failUnlessEqual(length1, len("msgC1_first"))
+
+        out, req = do_request(fetchres,
+                              base64.urlsafe_b64encode(fetch_token1))
+        m1 = retrieval.decrypt_fetch_response(symkey_1, fetch_token1, out)
+        self.failUnlessEqual(m1, "msgC1_first")
+        out, req = do_request(fetchres,
+                              base64.urlsafe_b64encode(fetch_token1))
+        self.failUnlessEqual(req.responseCode, http.NOT_FOUND)
+
+        out, req = do_request(deleteres,
+                              base64.urlsafe_b64encode(delete_token1),
+                              method="POST")
+        self.failUnlessEqual(req.responseCode, http.OK)
+        self.failUnlessEqual(len(store.list_messages(tid1)), 1)
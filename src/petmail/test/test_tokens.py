@@ -0,0 +1,56 @@
+from twisted.trial import unittest
+from ..database import Notice
+from ..mailbox.tokens import TokenTable
+
+class Tokens(unittest.TestCase):
+    def test_lookup(self):
+        t = TokenTable()
+        t.start_session(1)
+        t.add(1, 10, "f1", "d1")
+        t.add(1, 11, "f2", "d2")
+        t.add(2, 12, "f3", "d3")
+        self.failUnlessEqual(len(t), 3)
+        self.failUnlessEqual(t.find_fetch_token("f1"), 10)
+        self.failUnlessEqual(t.find_delete_token("d2"), 11)
+        self.failUnlessEqual(t.find_fetch_token("d1"), None)
+        self.failUnlessEqual(t.find_fetch_token("x"), None)
+        # fetch tokens are single-use, delete tokens stay
+        t.clear_fetch_token(10)
+        self.failUnlessEqual(t.find_fetch_token("f1"), None)
+        self.failUnlessEqual(t.find_delete_token("d1"), 10)
+        # deleted messages lose their tokens
+        t.message_changed(Notice("mailbox_server_messages", "delete", 11,
+                                 None, {}))
+        self.failUnlessEqual(t.find_fetch_token("f2"), None)
+        self.failUnlessEqual(t.find_delete_token("d2"), None)
+        self.failUnlessEqual(len(t), 2)
+
+    def test_sessions(self):
+        t = TokenTable()
+        t.start_session(1)
+        t.add(1, 10, "f1", "d1")
+        t.add(2, 12, "f3", "d3")
+        # a new session for tid=1 revokes its old tokens, but not tid=2's
+        t.start_session(1)
+        t.add(1, 10, "f4", "d4")
+        self.failUnlessEqual(t.find_fetch_token("f1"), None)
+        self.failUnlessEqual(t.find_delete_token("d1"), None)
+        self.failUnlessEqual(t.find_fetch_token("f4"), 10)
+        self.failUnlessEqual(t.find_fetch_token("f3"), 12)
+        self.failUnlessEqual(len(t), 2)
+
+    def test_expire(self):
+        now = [1000]
+        t = TokenTable(lifetime=60, clock=lambda: now[0])
+        t.add(1, 10, "f1", "d1")
+        t.add(2, 12, "f3", "d3")
+        now[0] = 1050
+        # using a token keeps its session alive
+        self.failUnlessEqual(t.find_delete_token("d1"), 10)
+        now[0] = 1080
+        self.failUnlessEqual(t.find_fetch_token("f1"), 10)
+        self.failUnlessEqual(t.find_fetch_token("f3"), None)
+        self.failUnlessEqual(len(t), 1)
+        t.prune(now=1200)
+        self.failUnlessEqual(len(t), 0)
+        self.failUnlessEqual(t.sessions, {})
@@ -1,4 +1,5 @@
 import json, collections
+from cStringIO import StringIO
 from pkg_resources import resource_string, resource_filename
 from twisted.application import service, strports
 from twisted.web import server, static, resource, http
@@ -314,6 +315,12 @@ class FetchMessages(BaseHandler):
                 "messages": self.agent.command_fetch_all_messages()}
 handlers["fetch-messages"] = FetchMessages
 
+class MailboxUsage(BaseHandler):
+    def handle(self, payload):
+        return {"ok": "ok",
+                "transports": self.agent.command_mailbox_usage()}
+handlers["mailbox-usage"] = MailboxUsage
+
 class EventChannelCreate(BaseHandler):
     def handle(self, payload):
         esid = self.event_dispatcher.add_event_channel()
@@ -398,6 +405,94 @@ class Control(resource.Resource):
         return read_media("control.html") % {"token": token}
 
 
+class LimitedRequest(server.Request):
+    """I am a Request that can refuse its body while it is still arriving.
+    If my Site has a limit registered for my path (see LimitedSite), I hold
+    the body chunks in memory instead of a content file, answer 413 as soon
+    as the declared or received size goes over the limit, and answer 400 as
+    soon as the first bytes fail to match the required prefix. Either way
+    the connection is closed without reading the rest. Accepted bodies are
+    joined once into self.body ."""
+    body = None
+    body_limit = None
+    body_rejected = False
+
+    def gotLength(self, length):
+        # the channel has parsed the request line by now, but only keeps it
+        # privately until the whole body has arrived. This relies on
+        # twisted.web.http.HTTPChannel's private _path (present from 13.1
+        # through at least 20.3). Channels without it (like the HTTP/2
+        # H2Stream, or a future Twisted) just get the usual buffered body.
+        path = getattr(self.channel, "_path", None)
+        if path is None:
+            return server.Request.gotLength(self, length)
+        path = path.split("?", 1)[0]
+        self.body_limit = self.channel.site.body_limits.get(path)
+        if not self.body_limit:
+            return server.Request.gotLength(self, length)
+        self.body_chunks = []
+        self.body_size = 0
+        self.content = StringIO("")
+        max_size, prefix = self.body_limit
+        if length is not None and length > max_size:
+            # don't invite the client to send a body we've already refused
+            self.requestHeaders.removeHeader("expect")
+            self.reject_body(http.REQUEST_ENTITY_TOO_LARGE, "body too large")
+
+    def handleContentChunk(self, data):
+        if not self.body_limit:
+            return server.Request.handleContentChunk(self, data)
+        if self.body_rejected:
+            return
+        max_size, prefix = self.body_limit
+        if self.body_size < len(prefix):
+            head = ("".join(self.body_chunks) + data)[:len(prefix)]
+            if head != prefix[:len(head)]:
+                return self.reject_body(http.BAD_REQUEST, "bad body prefix")
+        self.body_size += len(data)
+        if self.body_size > max_size:
+            return self.reject_body(http.REQUEST_ENTITY_TOO_LARGE,
+                                    "body too large")
+        self.body_chunks.append(data)
+
+    def reject_body(self, code, message):
+        self.body_rejected = True
+        self.body_chunks = []
+        self.channel.transport.write("HTTP/1.1 %d %s\r\n"
+                                     "Connection: close\r\n"
+                                     "Content-Length: %d\r\n\r\n%s"
+                                     % (code, http.RESPONSES[code],
+                                        len(message), message))
+        self.channel.loseConnection()
+
+    def requestReceived(self, command, path, version):
+        if self.body_rejected:
+            return
+        if self.body_limit:
+            self.body = "".join(self.body_chunks)
+            del self.body_chunks
+            self.content = StringIO(self.body)
+        return server.Request.requestReceived(self, command, path, version)
+
+def read_body(request):
+    """Return the whole request body, without copying it if a LimitedRequest
+    already has it in one piece."""
+    if getattr(request, "body", None) is not None:
+        return request.body
+    return request.content.read()
+
+class LimitedSite(server.Site):
+    requestFactory = LimitedRequest
+
+    def __init__(self, resource, *args, **kwargs):
+        server.Site.__init__(self, resource, *args, **kwargs)
+        self.body_limits = {}
+
+    def limit_body(self, path, max_size, prefix=""):
+        """Refuse request bodies for 'path' (like '/mailbox') that are
+        larger than max_size bytes or that do not start with 'prefix'."""
+        self.body_limits[path] = (max_size, prefix)
+
 class Root(resource.Resource):
     # child_FOO is a nevow thing, not a twisted.web.resource thing
     def __init__(self):
@@ -405,13 +500,23 @@ class Root(resource.Resource):
         self.putChild("", static.Data("Hello\n", "text/plain"))
         self.putChild("media", static.File(MEDIA_DIRNAME))
 
+class MetricsResource(resource.Resource):
+    """I show the node's metrics, in the Prometheus text format."""
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader("content-type", "text/plain; version=0.0.4")
+        return self.registry.render()
+
 class WebPort(service.MultiService):
     def __init__(self, listenport, access_token):
         service.MultiService.__init__(self)
         self.root = Root()
-        site = server.Site(self.root)
+        self.site = LimitedSite(self.root)
         assert listenport != "tcp:0" # must be configured
-        self.port_service = strports.service(listenport, site)
+        self.port_service = strports.service(listenport, self.site)
         self.port_service.setServiceParent(self)
         self.access_token = access_token
 
@@ -421,5 +526,11 @@ class WebPort(service.MultiService):
         self.root.putChild("control", Control(token))
         self.root.putChild("api", API(token, db, agent))
 
+    def enable_metrics(self, registry):
+        self.root.putChild("metrics", MetricsResource(registry))
+
     def get_root(self):
         return self.root
+
+    def limit_body(self, path, max_size, prefix=""):
+        self.site.limit_body(path, max_size, prefix)